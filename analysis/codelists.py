@@ -1,8 +1,36 @@
-from cohortextractor import (
-    codelist,
-    codelist_from_csv,
-    combine_codelists
-)
+import cohortextractor
+
+
+# Codelists are loaded lazily: the codelists below are only defined here and
+# are loaded on first access (codelists.<name>, see __getattr__ at the end of
+# this file), so a study definition only parses the codelists it uses
+class DeferredCodelist:
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+
+    def load(self):
+        if self.value is None:
+            # arguments can be deferred codelists (e.g. combine_codelists)
+            args = [
+                arg.load() if isinstance(arg, DeferredCodelist) else arg
+                for arg in self.args
+            ]
+            self.value = self.function(*args, **self.kwargs)
+        return self.value
+
+
+def deferred(function):
+    def defer(*args, **kwargs):
+        return DeferredCodelist(function, *args, **kwargs)
+    return defer
+
+
+codelist = deferred(cohortextractor.codelist)
+codelist_from_csv = deferred(cohortextractor.codelist_from_csv)
+combine_codelists = deferred(cohortextractor.combine_codelists)
 
 ## HIGH RISK GROUPS ----
 downs_syndrome_nhsd_snomed_codes = codelist_from_csv(
@@ -491,4 +519,24 @@ covid_icd10_codes = codelist_from_csv(
 
 mabs_procedure_codes = codelist(
   ["X891", "X892"], system="opcs4"
-)
\ No newline at end of file
+)
+
+
+_deferred_codelists = {
+    name: value
+    for name, value in globals().items()
+    if isinstance(value, DeferredCodelist)
+}
+for name in _deferred_codelists:
+    del globals()[name]
+
+
+def __getattr__(name):
+    if name not in _deferred_codelists:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = globals()[name] = _deferred_codelists[name].load()
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_deferred_codelists))
@@ -0,0 +1,5 @@
+# Tools used to develop, test and profile the extraction of the study
+# definitions in analysis/ outside of the OpenSAFELY backend.
+#
+# Run from the root of the repository, e.g.
+# python -m analysis.extraction.<module> --help
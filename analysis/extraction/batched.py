@@ -0,0 +1,605 @@
+# Batched event queries: one scan of an events table for many variables
+#
+# The TPP backend runs one query per variable: every
+# patients.with_these_clinical_events variable uploads its codelist and scans
+# the events table (CodedEvent_SNOMED or CodedEvent) for its codes, e.g. the
+# ~40 high risk group flags and comorbidities on or before
+# covid_test_positive_date, and every patients.with_these_medications variable
+# scans MedicationIssue for its dm+d codes (e.g. the interaction lists
+# drugs_do_not_use, drugs_consider_risk, ..., and the flags and 3/12 month
+# counts of immunosuppressant and oral steroid drugs). BatchedQueries computes
+# these variables in batches of up to BATCH_SIZE variables on the same events
+# table:
+# - the codes of the codelists of the batch are uploaded once (interned with
+#   a CodelistIndex), each with a bitmask of the codelists it is in, so an
+#   event is tagged with every codelist matching its code; dm+d codelists are
+#   expanded with the previous codes of their VMPs first, as by the backend
+# - the events table is scanned once for the codes, and every variable of the
+#   batch is an aggregate over the events with its bit and in its own period:
+#   its flag, the date of its first or last match and its number of matches,
+#   one row per patient in the table of the batch
+# - the table of each variable (#<name>, read by the final join) is selected
+#   from the table of the batch, so the output of the extraction is unchanged
+# The ICD-10 admitted_to_hospital queries of the high risk groups (*_icd10,
+# matching the diagnoses of an admission, Der_Diagnosis_All, with LIKE
+# patterns) are batched the same way, as are the OPCS-4 ones (matching the
+# procedures, Der_Procedure_All, e.g. the per-code flags
+# solid_organ_transplant_nhsd_opcs4_<code>): the patterns of the codes of the
+# batch are uploaded once with their bitmasks, and one scan of the admissions
+# writes the admissions matching any of them (one row per admission and
+# matching pattern) to the table of the batch. Each variable (its flag, date
+# or primary diagnosis, e.g. decompensated_cirrhosis_icd10_code) is then the
+# query of the backend on the admissions of the batch with its bit.
+#
+# The admitted_to_hospital queries in a window of admissions, e.g. the
+# admission episodes, discharge dates, primary diagnoses and mabs procedure
+# dates in [covid_test_positive_date, covid_test_positive_date + 28 days] of
+# study_definition.py, are batched by window instead: one scan writes the
+# admissions in the window to the table of the batch (one row per admission,
+# with its dates, diagnoses and procedures, clustered by patient and admission
+# date), and each variable is the query of the backend on that table, with
+# its own codelists and period (e.g. from the day after the previous episode).
+#
+# A batch is computed at the first of its variables, so a variable only joins
+# a batch if the variables its dates refer to come before the first variable
+# of the batch (for a window, only its anchor).
+#
+# cohortextractor constructs the backend of a study definition itself:
+# batched_study() returns a copy of a study definition whose backend is
+# BatchedTPPBackend, batching the query types given. The study definitions
+# use it with --param batched=<query types> (comma separated, e.g.
+# with_these_clinical_events), as in project.yaml. The tools in this
+# directory batch all query types (e.g. local_backend.py --batched,
+# profiler.py --batched). check_batched.py checks that the batched queries
+# extract the same cohorts as the queries of the backend (on the local
+# stand-in of the backend); run it after a change to this file.
+#
+# Usage (from the root of the repository):
+# python -m analysis.extraction.batched --study-definition study_definition
+import argparse
+import copy
+from functools import partial
+
+import numpy as np
+
+from cohortextractor import StudyDefinition
+from cohortextractor.codelistlib import expand_dmd_codelist
+from cohortextractor.tpp_backend import (
+    TPPBackend,
+    coded_event_table_column,
+    codelist_to_like_patterns,
+    escape_identifer,
+    escape_like_query_fragment,
+    make_batches_of_insert_statements,
+    quote,
+    to_list,
+)
+
+from .codelist_index import CodelistIndex
+from .date_expressions import parse_date_expression
+from .prune import variable_dependencies
+from .study import load_study, study_definition_names
+
+# codelists per batch (bits of the BIGINT bitmask)
+BATCH_SIZE = 62
+BATCHED_RETURNING = ["binary_flag", "date", "number_of_matches_in_period"]
+# admissions can match several codes of a batch, so counts are not batched
+ADMISSIONS_RETURNING = ["binary_flag", "date_admitted", "date_discharged", "primary_diagnosis"]
+# conditions of admitted_to_hospital on the columns of the admissions, as
+# TPPBackend.patients_admitted_to_hospital
+ADMISSION_COLUMNS = {
+    "with_admission_method": "Admission_Method",
+    "with_source_of_admission": "Source_of_Admission",
+    "with_discharge_destination": "Discharge_Destination",
+    "with_patient_classification": "Patient_Classification",
+    "with_administrative_category": "Administrative_Category",
+}
+# codelists of admitted_to_hospital -> column matched and prefix of the LIKE
+# patterns, as TPPBackend.patients_admitted_to_hospital
+ADMISSION_CODELISTS = {
+    "with_these_primary_diagnoses": ("Spell_Primary_Diagnosis", ""),
+    "with_these_diagnoses": ("Der_Diagnosis_All", "%[^A-Za-z0-9]"),
+    "with_these_procedures": ("Der_Procedure_All", "%[^A-Za-z0-9]"),
+}
+# arguments that are not part of the query (popped by TPPBackend.get_queries)
+NOT_QUERY_ARGUMENTS = ["return_expectations", "hidden", "column_type", "date_format"]
+
+
+# Events table (and how to match codes) of a with_these_clinical_events query
+# Output:
+# - dict with the table, join, code column and case sensitivity of the codes,
+#   or None if the query cannot be batched
+def clinical_events_source(query_args):
+    if (
+        query_args["returning"] not in BATCHED_RETURNING
+        or query_args.get("include_reference_range_columns")
+        or query_args.get("ignore_days_where_these_codes_occur") is not None
+        or query_args.get("episode_defined_as") is not None
+    ):
+        return None
+    table, code_column = coded_event_table_column(query_args["codelist"])
+    return {
+        "kind": "events",
+        "codelist": "codelist",
+        "table": table,
+        "join": "",
+        "code_column": code_column,
+        "case_sensitive": True,
+        "dmd": False,
+    }
+
+
+# Events table of a with_these_medications query (MedicationIssue, with the
+# dm+d codes of MedicationDictionary)
+def medications_source(query_args):
+    if query_args["returning"] not in BATCHED_RETURNING or query_args.get("episode_defined_as") is not None:
+        return None
+    return {
+        "kind": "events",
+        "codelist": "codelist",
+        "table": "MedicationIssue",
+        "join": """
+            INNER JOIN MedicationDictionary
+            ON MedicationIssue.MultilexDrug_ID = MedicationDictionary.MultilexDrug_ID
+            """,
+        "code_column": "DMD_ID",
+        "case_sensitive": False,
+        "dmd": True,
+    }
+
+
+# Admissions (APCS) of an admitted_to_hospital query with_these_diagnoses or
+# with_these_procedures (and no other conditions on the admissions)
+def admissions_source(query_args):
+    conditions = [key for key, value in query_args.items() if key.startswith("with_") and value]
+    if query_args["returning"] not in ADMISSIONS_RETURNING or len(conditions) != 1:
+        return None
+    code_column = {
+        "with_these_diagnoses": "Der_Diagnosis_All",
+        "with_these_procedures": "Der_Procedure_All",
+    }.get(conditions[0])
+    if code_column is None:
+        return None
+    return {"kind": "admissions", "codelist": conditions[0], "table": "APCS_ARCHIVED", "code_column": code_column}
+
+
+# Window of admissions of an admitted_to_hospital query: the admissions from
+# an anchor (a date variable) up to a number of days after it, e.g.
+# [covid_test_positive_date, covid_test_positive_date + 28 days]. A query is in
+# a window if its period is the window, or its period is bounded by the dates
+# of variables admitted in the window (e.g. from the day after the previous
+# admission up to the end of the window, or the day of an admission)
+# Input:
+# - between: period of the query
+# - windows: dict of name -> window of the date_admitted variables in a window
+# Output:
+# - tuple (anchor, days) or None
+def admissions_window(between, windows):
+    if not between or None in between:
+        return None
+    start, end = map(parse_date_expression, between)
+    if start is None or end is None or start["function"] or end["function"]:
+        return None
+    window = windows.get(start["name"]) or windows.get(end["name"])
+    if window is None:
+        if start["operator"] is None and end["name"] == start["name"] and end["operator"] == "+" \
+                and end["units"].rstrip("s") == "day":
+            return start["name"], int(end["quantity"])
+        return None
+    anchor, days = window
+    # an offset on a date of the window only moves a bound into the window
+    starts_in = (start["name"] == anchor or windows.get(start["name"]) == window) and start["operator"] != "-"
+    ends_in = (
+        end["name"] == anchor and end["operator"] == "+" and end["units"].rstrip("s") == "day"
+        and int(end["quantity"]) == days
+    ) or (windows.get(end["name"]) == window and end["operator"] != "+")
+    return window if starts_in and ends_in else None
+
+
+# Admissions (APCS) in a window of an admitted_to_hospital query, with any
+# codelists and conditions on the columns of the admissions
+def window_source(query_args, windows):
+    conditions = {key for key, value in query_args.items() if key.startswith("with_") and value}
+    if query_args["returning"] not in ADMISSIONS_RETURNING or conditions - set(ADMISSION_COLUMNS) - set(
+        ADMISSION_CODELISTS
+    ):
+        return None
+    window = admissions_window(query_args.get("between"), windows)
+    if window is None:
+        return None
+    columns = tuple(
+        (key, tuple(to_list(query_args[key]))) for key in sorted(conditions) if key in ADMISSION_COLUMNS
+    )
+    return {"kind": "window", "table": "APCS_ARCHIVED", "window": window, "columns": columns}
+
+
+# query type -> function of the query arguments returning the source of its
+# events
+EVENT_SOURCES = {
+    "with_these_clinical_events": clinical_events_source,
+    "with_these_medications": medications_source,
+    "admitted_to_hospital": admissions_source,
+}
+
+
+# Batches of the variables of a study definition
+# admitted_to_hospital queries in a window of admissions are batched by
+# window (window_source()) rather than by codes
+# Input:
+# - covariate_definitions: dict of name -> (query_type, query_args) as in
+#   study.covariate_definitions
+# - query_types: query types batched (keys of EVENT_SOURCES)
+# Output:
+# - list of dicts with the source and the names of the variables, in the order
+#   of their first variable; batches of one variable are left out
+def plan_batches(covariate_definitions, query_types=tuple(EVENT_SOURCES)):
+    dependencies = variable_dependencies(covariate_definitions)
+    position = {name: i for i, name in enumerate(covariate_definitions)}
+    batches = []
+    open_batches = {}
+    windows = {}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        if query_type not in query_types:
+            continue
+        source = None
+        if query_type == "admitted_to_hospital":
+            source = window_source(query_args, windows)
+            if source is not None and query_args["returning"] == "date_admitted":
+                windows[name] = source["window"]
+        source = source or EVENT_SOURCES[query_type](query_args)
+        if source is None:
+            continue
+        key = tuple(sorted(source.items()))
+        batch = open_batches.get(key)
+        last_dependency = max((position[reference] for reference in dependencies[name]), default=-1)
+        # the admissions of a window only depend on its anchor (before the
+        # first variable), the variables are queried from them in their turn
+        if source["kind"] == "window":
+            last_dependency = -1
+        if batch is None or len(batch["names"]) == BATCH_SIZE or last_dependency >= position[batch["names"][0]]:
+            batch = {"source": source, "names": []}
+            batches.append(batch)
+            open_batches[key] = batch
+        batch["names"].append(name)
+    return [batch for batch in batches if len(batch["names"]) > 1]
+
+
+# Mixin of a TPPBackend computing the variables of a batch in one query
+# - query_types: query types batched, all by default
+class BatchedQueries:
+    def __init__(self, *args, query_types=tuple(EVENT_SOURCES), **kwargs):
+        self.query_types = query_types
+        super().__init__(*args, **kwargs)
+
+    def get_queries(self, covariate_definitions):
+        self.batches = {}
+        self.batch_args = {}
+        for batch in plan_batches(covariate_definitions, self.query_types):
+            for name in batch["names"]:
+                self.batches[name] = batch
+                query_args = covariate_definitions[name][1]
+                self.batch_args[name] = {
+                    key: value for key, value in query_args.items() if key not in NOT_QUERY_ARGUMENTS
+                }
+        return super().get_queries(covariate_definitions)
+
+    def get_queries_for_column(self, column_name, query_type, query_args, output_columns):
+        batch = getattr(self, "batches", {}).get(column_name)
+        if batch is None:
+            return super().get_queries_for_column(column_name, query_type, query_args, output_columns)
+        kind = batch["source"]["kind"]
+        self.output_columns = output_columns
+        self._current_column_name = column_name
+        queries = []
+        if batch["names"][0] == column_name:
+            queries = getattr(self, f"{kind}_batch_queries")(batch)
+        queries.append(getattr(self, f"{kind}_variable_query")(batch, column_name))
+        self._current_column_name = None
+        return queries
+
+    # Codes of the codelists of a batch
+    # Output:
+    # - list of (code, bitmask of the codelists with the code)
+    def batch_codes(self, batch):
+        source = batch["source"]
+        codelists = {name: self.batch_args[name][source["codelist"]] for name in batch["names"]}
+        if source.get("dmd"):
+            codelists = {
+                name: expand_dmd_codelist(codelist, self.vmp_mapping) for name, codelist in codelists.items()
+            }
+        index = CodelistIndex(codelists)
+        bits = np.left_shift(np.int64(1), np.arange(len(codelists), dtype=np.int64))
+        bitmasks = (index.membership * bits).sum(axis=1)
+        return [(code, int(bitmask)) for code, bitmask in zip(index.codes, bitmasks)]
+
+    # Upload of the codes (or patterns) of a batch, with their bitmasks
+    def create_batch_codelist_table(self, values, column, collation):
+        table_name = self.get_temp_table_name("batch_codelist")
+        max_len = max(len(value) for value, _ in values)
+        queries = [
+            f"""
+            -- Uploading codelists of the batch of {self._current_column_name}
+            CREATE TABLE {table_name} (
+              {column} VARCHAR({max_len}) COLLATE {collation} NOT NULL PRIMARY KEY,
+              codelists BIGINT NOT NULL
+            )
+            """
+        ]
+        queries += make_batches_of_insert_statements(table_name, (column, "codelists"), values)
+        return table_name, queries
+
+    # Date conditions of the variables of a batch on a date column of a table
+    # Output:
+    # - tuple (dict of name -> condition, joins of the tables the conditions
+    #   refer to, one per table)
+    # The joins of get_date_condition() are one string per variable, so
+    # variables referring to different (but overlapping) sets of tables would
+    # join a table twice
+    def batch_date_conditions(self, table, date_column, names):
+        conditions = {}
+        join_tables = []
+        for name in names:
+            between = self.batch_args[name].get("between")
+            conditions[name], _ = self.get_date_condition(table, f"{table}.{date_column}", between)
+            for date in between or []:
+                for join_table in self.date_ref_to_sql_expr(date)[1]:
+                    if join_table not in join_tables:
+                        join_tables.append(join_table)
+        joins = "\n".join(
+            f"LEFT JOIN {join_table}\nON {join_table}.patient_id = {table}.patient_id" for join_table in join_tables
+        )
+        return conditions, joins
+
+    # Queries of a batch of events: upload of its codes and the scan of the
+    # events table into the table of the batch (one row per patient)
+    def events_batch_queries(self, batch):
+        source = batch["source"]
+        from_table = source["table"]
+        collation = "Latin1_General_BIN" if source["case_sensitive"] else "Latin1_General_CI_AS"
+        codelist_table, queries = self.create_batch_codelist_table(self.batch_codes(batch), "code", collation)
+        date_conditions, joins_sql = self.batch_date_conditions(from_table, "ConsultationDate", batch["names"])
+        columns = []
+        for bit, name in enumerate(batch["names"]):
+            query_args = self.batch_args[name]
+            date_condition = date_conditions[name]
+            missing_value_condition = "NumericValue != 0" if query_args.get("ignore_missing_values") else "1 = 1"
+            match = (
+                f"({codelist_table}.codelists & {1 << bit}) <> 0 "
+                f"AND {date_condition} AND {missing_value_condition}"
+            )
+            date_aggregate = "MIN" if query_args.get("find_first_match_in_period") else "MAX"
+            columns += [
+                f"MAX(CASE WHEN {match} THEN 1 END) AS {escape_identifer(f'{name}_flag')}",
+                f"{date_aggregate}(CASE WHEN {match} THEN {from_table}.ConsultationDate END) AS {escape_identifer(f'{name}_date')}",
+            ]
+            if query_args["returning"] == "number_of_matches_in_period":
+                columns.append(f"COUNT(CASE WHEN {match} THEN 1 END) AS {escape_identifer(f'{name}_count')}")
+        batch["table"] = self.get_temp_table_name("batch")
+        columns_sql = ",\n              ".join(columns)
+        conditions_sql = " OR ".join(f"({condition})" for condition in dict.fromkeys(date_conditions.values()))
+        queries += [
+            f"""
+            -- Query for the batch of {', '.join(batch['names'])}
+            SELECT
+              {from_table}.Patient_ID AS patient_id,
+              {columns_sql}
+            INTO {batch['table']}
+            FROM {from_table}{source['join']}
+            INNER JOIN {codelist_table}
+            ON {source['code_column']} = {codelist_table}.code
+            {joins_sql}
+            WHERE {conditions_sql}
+            GROUP BY {from_table}.Patient_ID
+            """,
+            f"CREATE CLUSTERED INDEX patient_id_ix ON {batch['table']} (patient_id)",
+        ]
+        return queries
+
+    # Query of a variable of a batch of events, from the table of the batch
+    def events_variable_query(self, batch, name):
+        returning = self.batch_args[name]["returning"]
+        if returning == "number_of_matches_in_period":
+            value_column, condition = f"[{name}_count] AS {returning}", f"[{name}_count] > 0"
+        else:
+            value_column, condition = "1 AS binary_flag", f"[{name}_flag] = 1"
+        return f"""
+            SELECT patient_id, {value_column}, [{name}_date] AS date
+            FROM {batch['table']}
+            WHERE {condition}
+            """
+
+    # Queries of a batch of admissions: upload of the LIKE patterns of its
+    # ICD-10 or OPCS-4 codes (as matched against Der_Diagnosis_All or
+    # Der_Procedure_All by the backend) and one scan of the admissions into the
+    # table of the batch, one row per admission and matching code
+    def admissions_batch_queries(self, batch):
+        values = [
+            (f"%[^A-Za-z0-9]{escape_like_query_fragment(code)}%", bitmask) for code, bitmask in self.batch_codes(batch)
+        ]
+        codelist_table, queries = self.create_batch_codelist_table(values, "pattern", "Latin1_General_CI_AS")
+        date_conditions, joins_sql = self.batch_date_conditions("APCS_ARCHIVED", "Admission_Date", batch["names"])
+        batch["table"] = self.get_temp_table_name("batch")
+        conditions_sql = " OR ".join(f"({condition})" for condition in dict.fromkeys(date_conditions.values()))
+        queries += [
+            f"""
+            -- Query for the batch of {', '.join(batch['names'])}
+            SELECT DISTINCT
+              APCS_ARCHIVED.Patient_ID AS patient_id,
+              APCS_ARCHIVED.APCS_Ident,
+              APCS_ARCHIVED.Admission_Date,
+              APCS_ARCHIVED.Discharge_Date,
+              APCS_Der_ARCHIVED.Spell_Primary_Diagnosis,
+              {codelist_table}.codelists
+            INTO {batch['table']}
+            FROM APCS_ARCHIVED
+            INNER JOIN APCS_Der_ARCHIVED
+              ON APCS_ARCHIVED.APCS_Ident = APCS_Der_ARCHIVED.APCS_Ident
+            INNER JOIN {codelist_table}
+              ON {batch['source']['code_column']} COLLATE Latin1_General_CI_AS LIKE {codelist_table}.pattern ESCAPE '!'
+            {joins_sql}
+            WHERE {conditions_sql}
+            """,
+            f"CREATE CLUSTERED INDEX patient_id_ix ON {batch['table']} (patient_id)",
+        ]
+        return queries
+
+    # Query of a variable of a batch of admissions, as the backend's query of
+    # admitted_to_hospital on the admissions of the batch with its codes
+    def admissions_variable_query(self, batch, name):
+        table = batch["table"]
+        date_condition, date_joins = self.get_date_condition(
+            table, f"{table}.Admission_Date", self.batch_args[name].get("between")
+        )
+        conditions = f"({table}.codelists & {1 << batch['names'].index(name)}) <> 0 AND {date_condition}"
+        return self.admissions_query(table, self.batch_args[name], conditions, date_joins)
+
+    # Queries of a window of admissions: one scan of the admissions in the
+    # window (with the conditions on their columns shared by the variables of
+    # the batch) into the table of the batch, one row per admission, clustered
+    # by patient and admission date
+    def window_batch_queries(self, batch):
+        anchor, days = batch["source"]["window"]
+        date_condition, date_joins = self.get_date_condition(
+            "APCS_ARCHIVED", "APCS_ARCHIVED.Admission_Date", [anchor, f"{anchor} + {days} days"]
+        )
+        conditions = [date_condition]
+        for key, values in batch["source"]["columns"]:
+            conditions.append(f"{ADMISSION_COLUMNS[key]} IN ({', '.join(map(quote, values))})")
+        conditions_sql = " AND ".join(conditions)
+        batch["table"] = self.get_temp_table_name("batch")
+        return [
+            f"""
+            -- Query for the admissions in the window of {', '.join(batch['names'])}
+            SELECT
+              APCS_ARCHIVED.Patient_ID AS patient_id,
+              APCS_ARCHIVED.APCS_Ident,
+              APCS_ARCHIVED.Admission_Date,
+              APCS_ARCHIVED.Discharge_Date,
+              APCS_ARCHIVED.Der_Diagnosis_All,
+              APCS_ARCHIVED.Der_Procedure_All,
+              APCS_Der_ARCHIVED.Spell_Primary_Diagnosis
+            INTO {batch['table']}
+            FROM APCS_ARCHIVED
+            INNER JOIN APCS_Der_ARCHIVED
+              ON APCS_ARCHIVED.APCS_Ident = APCS_Der_ARCHIVED.APCS_Ident
+            {date_joins}
+            WHERE {conditions_sql}
+            """,
+            f"CREATE CLUSTERED INDEX patient_id_ix ON {batch['table']} (patient_id, Admission_Date, APCS_Ident)",
+        ]
+
+    # Query of a variable of a window of admissions, as the backend's query of
+    # admitted_to_hospital on the admissions of the window
+    def window_variable_query(self, batch, name):
+        query_args = self.batch_args[name]
+        table = batch["table"]
+        date_condition, date_joins = self.get_date_condition(
+            table, f"{table}.Admission_Date", query_args.get("between")
+        )
+        conditions = [date_condition]
+        for key, (column, prefix) in ADMISSION_CODELISTS.items():
+            if query_args.get(key):
+                fragments = [
+                    f"{table}.{column} LIKE {pattern} ESCAPE '!'"
+                    for pattern in codelist_to_like_patterns(query_args[key], prefix=prefix, suffix="%")
+                ]
+                conditions.append("(" + " OR ".join(fragments) + ")")
+        return self.admissions_query(table, query_args, " AND ".join(conditions), date_joins)
+
+    # Query of admitted_to_hospital (binary_flag, date_admitted,
+    # date_discharged or primary_diagnosis) on the admissions of a table of
+    # admissions, as TPPBackend.patients_admitted_to_hospital
+    def admissions_query(self, table, query_args, conditions, date_joins):
+        returning = query_args["returning"]
+        if returning == "primary_diagnosis":
+            ordering = "ASC" if query_args.get("find_first_match_in_period") else "DESC"
+            return f"""
+            SELECT t.patient_id, t.primary_diagnosis
+            FROM (
+              SELECT {table}.patient_id, Spell_Primary_Diagnosis AS primary_diagnosis,
+              ROW_NUMBER() OVER (
+                PARTITION BY {table}.patient_id
+                ORDER BY {table}.Admission_Date {ordering}, {table}.APCS_Ident
+              ) AS rownum
+              FROM {table}
+              {date_joins}
+              WHERE {conditions}
+            ) t
+            WHERE rownum = 1
+            """
+        date_aggregate = "MIN" if query_args.get("find_first_match_in_period") else "MAX"
+        returning_column = {
+            "binary_flag": "1",
+            "date_admitted": f"{date_aggregate}({table}.Admission_Date)",
+            "date_discharged": f"{date_aggregate}({table}.Discharge_Date)",
+        }[returning]
+        return f"""
+            SELECT {table}.patient_id, {returning_column} AS {returning}
+            FROM {table}
+            {date_joins}
+            WHERE {conditions}
+            GROUP BY {table}.patient_id
+            """
+
+
+class BatchedTPPBackend(BatchedQueries, TPPBackend):
+    pass
+
+
+# Copy of a study definition extracted with BatchedTPPBackend
+# Input:
+# - query_types: query types batched (keys of EVENT_SOURCES)
+# Output:
+# - StudyDefinition whose backend (constructed by cohortextractor from
+#   get_backend_for_database_url) batches the queries of query_types on the
+#   TPP database
+def batched_study(study, query_types):
+    unknown = set(query_types) - set(EVENT_SOURCES)
+    if unknown:
+        raise ValueError(f"Query types that cannot be batched: {', '.join(sorted(unknown))}")
+
+    def get_backend_for_database_url(database_url):
+        backend_class = StudyDefinition.get_backend_for_database_url(database_url)
+        if backend_class is not TPPBackend:
+            return backend_class
+        return partial(BatchedTPPBackend, query_types=tuple(query_types))
+
+    new_study = copy.copy(study)
+    new_study.get_backend_for_database_url = get_backend_for_database_url
+    if study.backend:
+        new_study.backend = new_study.create_backend()
+    return new_study
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batches of the event queries of a study definition")
+    parser.add_argument("--study-definition", default="study_definition", choices=study_definition_names())
+    parser.add_argument("--query-types", nargs="+", choices=list(EVENT_SOURCES), default=list(EVENT_SOURCES))
+    args = parser.parse_args()
+
+    study = load_study(args.study_definition)
+    batches = plan_batches(study.covariate_definitions, args.query_types)
+    for batch in batches:
+        if batch["source"]["kind"] == "window":
+            anchor, days = batch["source"]["window"]
+            print(
+                f"{batch['source']['table']} [{anchor}, {anchor} + {days} days]: "
+                f"{len(batch['names'])} variables from one scan of the window"
+            )
+        else:
+            codelists = [
+                study.covariate_definitions[name][1][batch["source"]["codelist"]] for name in batch["names"]
+            ]
+            codes = len(CodelistIndex(dict(zip(batch["names"], codelists))))
+            table = " ".join(filter(None, [batch["source"]["table"], batch["source"].get("code_column")]))
+            print(
+                f"{table}: {len(batch['names'])} variables in one scan, "
+                f"{codes} codes uploaded ({sum(map(len, codelists))} one query per variable)"
+            )
+        for name in batch["names"]:
+            print(f"  {name}")
+    print(f"{sum(len(batch['names']) for batch in batches)} variables in {len(batches)} batches")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+# Benchmarks of the construction of the study definitions and of the import
+# of the cohorts
+#
+# Benchmarks (each repeated, the median of the runs is reported):
+# - 'import codelists': import of analysis/codelists.py, in a new python
+#   process (cold imports of cohortextractor and of the codelists)
+# - 'construct <study definition>': import of each study definition (the
+#   construction of its StudyDefinition), in a new python process after
+#   'import codelists', so only the study definition itself is timed
+# - 'dummy data <population>': generation of dummy data of
+#   --study-definition (dummy_data.py), written to output/benchmark/
+# - 'extract_data.R <population>': extract_data() of
+#   analysis/data_import/extract_data.R (the read and parse of the columns
+#   with their column types) on the dummy data of the same population, skipped
+#   if Rscript is not available
+# The counts of variables and of queries of the TPP backend of each study
+# definition are recorded too: they do not depend on the host and double if
+# an added variable doubles the number of queries of the extraction.
+# The study definitions are imported once before the runs, so the timings
+# are of files in the cache of the operating system.
+#
+# The results (with the git sha and the host) are written as json. The
+# benchmarks more than --threshold times those of a baseline (results of an
+# earlier run on the same host, saved with --save-baseline) and the counts
+# more than --threshold times those of analysis/extraction/
+# benchmark_counts.json (checked in, as they do not depend on the host,
+# rewritten with --save-counts when a change of the counts is intended) are
+# reported as regressions, and the exit code is 1.
+#
+# Usage (from the root of the repository):
+# python -m analysis.extraction.benchmark [--repeat 3]
+#   [--populations 5000 100000 1000000] [--baseline output/benchmark/baseline.json]
+#   [--save-baseline] [--save-counts]
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from functools import partial
+from pathlib import Path
+
+from .study import ANALYSIS_DIR, REPO_DIR, load_study, study_definition_names
+
+OUTPUT_DIR = REPO_DIR / "output" / "benchmark"
+COUNTS_FILE = ANALYSIS_DIR / "extraction" / "benchmark_counts.json"
+POPULATIONS = [5000, 100000, 1000000]
+BENCHMARKS = ["import", "construct", "dummy_data", "extract_data"]
+# differences in seconds smaller than this are noise, not regressions
+MIN_SECONDS = 0.05
+
+# Timed in a new python process, prints the seconds of 'statement' after
+# 'setup'
+TIMER = """
+import os, sys, time
+sys.path.insert(0, {analysis_dir!r})
+os.chdir({repo_dir!r})
+{setup}
+start = time.perf_counter()
+{statement}
+print(time.perf_counter() - start)
+"""
+
+# Timed in R, prints the seconds of extract_data()
+R_TIMER = """
+source(here::here("analysis", "data_import", "extract_data.R"))
+seconds <- system.time(extract_data("{input_filename}"))[["elapsed"]]
+cat(seconds)
+"""
+
+
+def run_python(statement, setup=""):
+    code = TIMER.format(analysis_dir=str(ANALYSIS_DIR), repo_dir=str(REPO_DIR), setup=setup, statement=statement)
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=REPO_DIR
+    ).stdout
+    return float(output.split()[-1])
+
+
+def run_r(input_filename):
+    code = R_TIMER.format(input_filename=input_filename)
+    output = subprocess.run(
+        ["Rscript", "-e", code], capture_output=True, text=True, check=True, cwd=REPO_DIR
+    ).stdout
+    return float(output.split()[-1])
+
+
+def time_dummy_data(study, population, filename):
+    from .dummy_data import DummyDataGenerator, write_dummy_data
+
+    start = time.perf_counter()
+    write_dummy_data(DummyDataGenerator(study, seed=0), population, filename)
+    return time.perf_counter() - start
+
+
+# Median of 'repeat' runs of 'measure'
+# Output:
+# - dict with seconds (median) and runs (seconds of each run)
+def measure(run, repeat):
+    runs = [run() for _ in range(repeat)]
+    return {"seconds": statistics.median(runs), "runs": runs}
+
+
+# Number of variables and of queries of the TPP backend of a study definition
+def query_counts(name):
+    from .local_backend import backend_for_url
+    from .profiler import variable_queries
+
+    covariate_definitions = load_study(name).covariate_definitions
+    queries, final_join = variable_queries(backend_for_url(None, dummy_data=True), covariate_definitions)
+    return {
+        "variables": len(covariate_definitions),
+        "queries": sum(len(sql_list) for sql_list in queries.values()) + 1,
+    }
+
+
+def git_revision():
+    def git(*args):
+        return subprocess.run(["git", *args], capture_output=True, text=True, cwd=REPO_DIR).stdout.strip()
+
+    return {"sha": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def host_info():
+    import numpy
+    import pandas
+    import pyarrow
+
+    return {
+        "node": platform.node(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "pandas": pandas.__version__,
+        "pyarrow": pyarrow.__version__,
+    }
+
+
+# Run the benchmarks
+# Input:
+# - benchmarks: subset of BENCHMARKS
+# - populations: numbers of patients of the dummy data (and extract_data.R)
+# - study_definition: study definition of the dummy data
+# - repeat: number of runs of each benchmark
+# Output:
+# - dict with git, host, date, repeat, benchmarks (name -> dict with seconds
+#   and runs, or skipped) and counts (study definition -> dict of counts)
+def run_benchmarks(benchmarks, populations, study_definition, repeat):
+    results = {}
+    names = study_definition_names()
+    # reads the files of the study definitions and codelists once
+    run_python(";".join(f"import {name}" for name in names))
+    if "import" in benchmarks:
+        results["import codelists"] = measure(lambda: run_python("import codelists"), repeat)
+        print(f"import codelists: {results['import codelists']['seconds']:.2f}s")
+    if "construct" in benchmarks:
+        for name in names:
+            key = f"construct {name}"
+            results[key] = measure(lambda: run_python(f"import {name}", setup="import codelists"), repeat)
+            print(f"{key}: {results[key]['seconds']:.2f}s")
+    files = {}
+    if "dummy_data" in benchmarks or "extract_data" in benchmarks:
+        OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+        study = load_study(study_definition)
+        for population in populations:
+            files[population] = OUTPUT_DIR / f"input_{population}.feather"
+            run = partial(time_dummy_data, study, population, files[population])
+            if "dummy_data" in benchmarks:
+                key = f"dummy data {population}"
+                results[key] = measure(run, repeat)
+                print(f"{key}: {results[key]['seconds']:.2f}s")
+            else:
+                run()
+    if "extract_data" in benchmarks:
+        rscript = shutil.which("Rscript")
+        for population in populations:
+            key = f"extract_data.R {population}"
+            if rscript is None:
+                results[key] = {"skipped": "Rscript not found"}
+                print(f"{key}: skipped, Rscript not found")
+                continue
+            # extract_data() reads output/<input_filename>
+            input_filename = str(files[population].relative_to(REPO_DIR / "output"))
+            results[key] = measure(lambda: run_r(input_filename), repeat)
+            print(f"{key}: {results[key]['seconds']:.2f}s")
+    return {
+        "git": git_revision(),
+        "host": host_info(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "repeat": repeat,
+        "benchmarks": results,
+        "counts": {name: query_counts(name) for name in names},
+    }
+
+
+# Benchmarks and counts of 'results' more than 'threshold' times those of
+# 'baseline'
+# Output:
+# - list of dicts with name, baseline, value and ratio
+def regressions(results, baseline, threshold):
+    compared = []
+    for name, result in results["benchmarks"].items():
+        before = baseline["benchmarks"].get(name, {}).get("seconds")
+        if before is not None and "seconds" in result and result["seconds"] - before > MIN_SECONDS:
+            compared.append((name, before, result["seconds"]))
+    for study, counts in results["counts"].items():
+        for count, value in counts.items():
+            before = baseline["counts"].get(study, {}).get(count)
+            if before:
+                compared.append((f"{count} of {study}", before, value))
+    return [
+        {"name": name, "baseline": before, "value": value, "ratio": value / before}
+        for name, before, value in compared
+        if value > threshold * before
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of the construction of the study definitions and of the import of the cohorts"
+    )
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--populations", nargs="+", type=int, default=POPULATIONS)
+    parser.add_argument("--study-definition", default="study_definition", choices=study_definition_names())
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=str(OUTPUT_DIR / "results.json"))
+    parser.add_argument("--baseline", default=str(OUTPUT_DIR / "baseline.json"))
+    parser.add_argument("--threshold", type=float, default=1.25, help="ratio to the baseline reported as a regression")
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the baseline")
+    parser.add_argument("--save-counts", action="store_true", help=f"save the counts to {COUNTS_FILE.name}")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.benchmarks, args.populations, args.study_definition, args.repeat)
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results of {results['git']['sha'][:12]} written to {output}")
+
+    baseline_file = Path(args.baseline)
+    if args.save_baseline:
+        baseline_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(baseline_file, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"baseline saved to {baseline_file}")
+    if args.save_counts:
+        with open(COUNTS_FILE, "w") as f:
+            json.dump(results["counts"], f, indent=2)
+            f.write("\n")
+        print(f"counts saved to {COUNTS_FILE.relative_to(REPO_DIR)}")
+    if args.save_baseline or args.save_counts:
+        return
+    with open(COUNTS_FILE) as f:
+        baseline = {"benchmarks": {}, "counts": json.load(f)}
+    if baseline_file.exists():
+        with open(baseline_file) as f:
+            timings = json.load(f)
+        if timings["host"]["node"] != results["host"]["node"]:
+            print(f"warning: the baseline was run on another host ({timings['host']['node']})")
+        baseline["benchmarks"] = timings["benchmarks"]
+        print(f"benchmarks compared to the baseline of {timings['git']['sha'][:12]}")
+    else:
+        print(f"no baseline in {baseline_file}, save one with --save-baseline (only the counts are compared)")
+    found = regressions(results, baseline, args.threshold)
+    print(f"{len(found)} regressions against the baseline and {COUNTS_FILE.relative_to(REPO_DIR)}")
+    for regression in found:
+        print(
+            f"  {regression['name']}: {regression['value']:.4g} "
+            f"(baseline {regression['baseline']:.4g}, x{regression['ratio']:.2f})"
+        )
+    if found:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
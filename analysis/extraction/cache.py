@@ -0,0 +1,209 @@
+# Content-addressed cache of the extracted variables
+#
+# Every column of the cohort of study_definition is cached in
+# output/cache/variables/<key>.feather (patient_id and value), where the
+# key is a hash of everything the values of the column depend on:
+# - the query of the variable (type and arguments, with the dates evaluated
+#   and the codelists replaced by a hash of their system and codes)
+# - the keys of the variables it refers to (date expressions, expressions,
+#   sources), so a change to a variable changes the keys of the variables
+#   derived from it
+# - the key of the population, as the values are those of its patients
+# - the study dates (lib/design/study-dates.json)
+# - the snapshot of the backend (e.g. the date the database was built), as
+#   the same query returns other values on another snapshot
+# Changing e.g. the window of any_covid_hosp_prev_90_days only changes its
+# key, so a re-run only extracts that variable (with --param
+# variables=any_covid_hosp_prev_90_days, extracting it and the variables it
+# depends on) and takes the other columns from the cache. Only variables of
+# the study definition can be extracted this way: columns derived in R (e.g.
+# covid_hosp_admission_first_date7_28, derived from the admission episodes in
+# analysis/data_import/functions/add_hosp_admission_days.R) are not cached and
+# change with the R code.
+#
+# The variables are extracted with the params of generate_study_population in
+# project.yaml (e.g. the batched queries) but the population: the key of the
+# population is that of the population variable of study_definition.
+#
+# Usage (from the root of the repository):
+# python -m analysis.extraction.cache --snapshot 2023-06-20
+#   [--output output/input.feather] [--expectations-population 5000]
+import argparse
+import hashlib
+import json
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+from .prune import variable_dependencies
+from .study import REPO_DIR, generate_cohort, load_study, project_action
+
+CACHE_DIR = Path("output") / "cache"
+# arguments that do not change the values of a variable on the backend
+IGNORED_ARGUMENTS = ["return_expectations", "hidden"]
+
+
+def hash_of(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+# Arguments of a query as json values, codelists are replaced by a hash of
+# their codes
+def canonical(value):
+    if isinstance(value, list) and hasattr(value, "system"):
+        return {
+            "system": value.system,
+            "codes": hash_of(sorted(map(canonical, value), key=json.dumps)),
+        }
+    if isinstance(value, dict):
+        return {str(key): canonical(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return repr(value)
+
+
+# Cache key of every variable
+# The key of a query is a hash of the query, the keys of the variables it
+# refers to and the context; the key of a variable is the key of its query and
+# the key of the population (that depends on the variables it refers to)
+# Input:
+# - covariate_definitions: dict of name -> (query_type, query_args), as in
+#   study.covariate_definitions (evaluated with the index date)
+# - context: json value of what all variables depend on (study dates, backend
+#   snapshot)
+# Output:
+# - dict of name -> key
+def variable_keys(covariate_definitions, context):
+    dependencies = variable_dependencies(covariate_definitions)
+    query_keys = {}
+
+    def key_of(name, visiting=()):
+        if name not in query_keys:
+            if name in visiting:
+                raise ValueError(f"Circular references: {' -> '.join(visiting + (name,))}")
+            query_type, query_args = covariate_definitions[name]
+            query_keys[name] = hash_of(
+                {
+                    "context": context,
+                    "query_type": query_type,
+                    "query_args": canonical(
+                        {key: value for key, value in query_args.items() if key not in IGNORED_ARGUMENTS}
+                    ),
+                    "references": {
+                        reference: key_of(reference, visiting + (name,))
+                        for reference in sorted(dependencies[name])
+                    },
+                }
+            )
+        return query_keys[name]
+
+    population_key = key_of("population")
+    return {
+        name: population_key if name == "population" else hash_of([key_of(name), population_key])
+        for name in covariate_definitions
+    }
+
+
+def output_columns(covariate_definitions):
+    return [
+        name
+        for name, (_, query_args) in covariate_definitions.items()
+        if name != "population" and not query_args.get("hidden")
+    ]
+
+
+def cache_file(key):
+    return REPO_DIR / CACHE_DIR / "variables" / f"{key}.feather"
+
+
+# Cache the columns of an extracted cohort
+# Input:
+# - cohort: data.frame with patient_id and the columns of variables
+# - keys: dict of name -> key
+def store(cohort, keys):
+    (REPO_DIR / CACHE_DIR / "variables").mkdir(parents=True, exist_ok=True)
+    # the patients are cached under the key of the population
+    cohort[["patient_id"]].to_feather(cache_file(keys["population"]), compression="zstd")
+    for name in cohort.columns.drop("patient_id"):
+        path = cache_file(keys[name])
+        # variables with the same query (and population) share an entry
+        cohort[["patient_id", name]].rename(columns={name: "value"}).to_feather(
+            f"{path}.tmp", compression="zstd"
+        )
+        Path(f"{path}.tmp").replace(path)
+
+
+# Cohort assembled from the cache
+def assemble(columns, keys):
+    patient_ids = pd.read_feather(cache_file(keys["population"]))["patient_id"]
+    values = [
+        pd.read_feather(cache_file(keys[name])).set_index("patient_id")["value"].reindex(patient_ids).rename(name)
+        for name in columns
+    ]
+    return pd.concat(values, axis=1).reset_index()
+
+
+# Extract the cohort of study_definition, running the queries of the columns
+# that are not in the cache only
+# Output:
+# - tuple (list of names of the variables extracted, list of names taken
+#   from the cache)
+def extract_cached(study, snapshot, output, expectations_population=None):
+    with open(REPO_DIR / "lib" / "design" / "study-dates.json") as f:
+        context = {"study_dates": json.load(f), "snapshot": snapshot}
+    keys = variable_keys(study.covariate_definitions, context)
+    columns = output_columns(study.covariate_definitions)
+    missing = [name for name in ["population", *columns] if not cache_file(keys[name]).exists()]
+    if "population" in missing:
+        # other patients, none of the cached columns can be used
+        missing = ["population", *columns]
+    if missing:
+        output_dir = CACHE_DIR / "extract"
+        params = project_action("study_definition")["params"]
+        params.pop("population", None)
+        if "population" not in missing:
+            params["variables"] = ",".join(missing)
+        returncode, _ = generate_cohort(
+            "study_definition", output_dir, params, expectations_population=expectations_population
+        )
+        if returncode != 0:
+            raise RuntimeError(f"Extraction failed, see {output_dir / 'extract.log'}")
+        extracted = pd.read_feather(REPO_DIR / output_dir / "input.feather")
+        if "population" not in missing:
+            cached_ids = pd.read_feather(cache_file(keys["population"]))["patient_id"]
+            if expectations_population:
+                # dummy data has other patients in every run
+                extracted["patient_id"] = cached_ids.to_numpy()
+            elif set(extracted["patient_id"]) != set(cached_ids):
+                raise RuntimeError("The population differs from the cached population")
+        store(extracted, keys)
+    assemble(columns, keys).to_feather(REPO_DIR / output, compression="zstd")
+    return [name for name in missing if name != "population"], [
+        name for name in columns if name not in missing
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract study_definition, running the queries of the variables that are not cached only"
+    )
+    parser.add_argument("--snapshot", help="id of the snapshot of the backend (e.g. the date it was built)")
+    parser.add_argument("--output", default="output/input.feather")
+    parser.add_argument("--expectations-population", type=int)
+    args = parser.parse_args()
+    if args.snapshot is None and args.expectations_population is None:
+        sys.exit("--snapshot is required to extract from the backend")
+    snapshot = args.snapshot or f"expectations-{args.expectations_population}"
+
+    study = load_study("study_definition")
+    extracted, cached = extract_cached(study, snapshot, args.output, args.expectations_population)
+    print(f"{len(extracted)} variables extracted, {len(cached)} from the cache")
+    for name in extracted:
+        print(f"  extracted {name}")
+
+
+if __name__ == "__main__":
+    main()
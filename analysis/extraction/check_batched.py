@@ -0,0 +1,166 @@
+# Check of the batched queries against the queries of the backend
+#
+# Extracts study definitions on the local stand-in of the TPP database
+# (local_backend.py) twice, with the queries of the backend and with the
+# batched queries (batched.py, all query types), and compares the columns:
+# batching must not change the output. Checked are the study definitions in
+# analysis/ and mixed_references_study(), where the variables of each batch
+# refer to different (overlapping) sets of variables in their dates, so the
+# scan of a batch joins the tables of the union of these sets. The risk groups
+# of high_risk_cohort_covid_therapeutics are compared as sets, as the order of
+# the groups in the string is not defined.
+#
+# The exit code is 1 if a column differs.
+#
+# Usage (from the root of the repository):
+# python -m analysis.extraction.check_batched [--patients 5000]
+#   [--study-definition study_definition] [--database output/local/check_batched.sqlite]
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from .local_backend import SQLITE_URL, backend_for_url, populate
+from .study import REPO_DIR, add_analysis_dir_to_path, load_study, study_definition_names
+
+DEFAULT_DATABASE = Path("output") / "local" / "check_batched.sqlite"
+MIXED_REFERENCES = "mixed_references"
+# columns with a list of values in an undefined order (comma separated)
+SET_COLUMNS = ["high_risk_cohort_covid_therapeutics"]
+
+
+def study_dates():
+    with open(REPO_DIR / "lib" / "design" / "study-dates.json") as f:
+        return json.load(f)
+
+
+# Study definition with batches of variables referring to different sets of
+# variables: covid_test_positive_date, covid_admission_date or both
+def mixed_references_study():
+    add_analysis_dir_to_path()
+    import codelists
+    from cohortextractor import StudyDefinition, patients
+
+    dates = study_dates()
+    window = ["covid_test_positive_date", "covid_test_positive_date + 28 days"]
+    before_test = ["covid_test_positive_date - 365 days", "covid_test_positive_date"]
+    test_to_admission = ["covid_test_positive_date", "covid_admission_date"]
+    after_admission = ["covid_admission_date", "covid_admission_date + 28 days"]
+
+    def events(codelist, between, **kwargs):
+        return patients.with_these_clinical_events(codelist, between=between, returning="binary_flag", **kwargs)
+
+    def medications(codelist, between):
+        return patients.with_these_medications(codelist, between=between, returning="date", date_format="YYYY-MM-DD")
+
+    def admissions(codelist, between):
+        return patients.admitted_to_hospital(
+            with_these_diagnoses=codelist, between=between, returning="date_admitted", date_format="YYYY-MM-DD"
+        )
+
+    return StudyDefinition(
+        default_expectations={
+            "date": {"earliest": dates["start_date"], "latest": dates["end_date"]},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        index_date=dates["start_date"],
+        population=patients.satisfying("covid_test_positive_date"),
+        covid_test_positive_date=patients.with_test_result_in_sgss(
+            pathogen="SARS-CoV-2",
+            test_result="positive",
+            find_first_match_in_period=True,
+            restrict_to_earliest_specimen_date=False,
+            returning="date",
+            date_format="YYYY-MM-DD",
+            between=["index_date", dates["end_date"]],
+        ),
+        covid_admission_date=admissions(codelists.covid_icd10_codes, window),
+        dementia_before_test=events(codelists.dementia_nhsd_snomed_codes, before_test),
+        dementia_test_to_admission=events(codelists.dementia_nhsd_snomed_codes, test_to_admission),
+        dementia_after_admission=events(codelists.dementia_nhsd_snomed_codes, after_admission),
+        diabetes_after_admission=events(codelists.diabetes_codes, after_admission),
+        diabetes_before_test=events(codelists.diabetes_codes, before_test),
+        steroids_before_test=medications(codelists.oral_steroid_drugs_dmd_codes, before_test),
+        steroids_test_to_admission=medications(codelists.oral_steroid_drugs_dmd_codes, test_to_admission),
+        steroids_after_admission=medications(codelists.oral_steroid_drugs_dmd_codes, after_admission),
+        cirrhosis_test_to_admission=admissions(codelists.advanced_decompensated_cirrhosis_icd10_codes, test_to_admission),
+        cirrhosis_after_admission=admissions(codelists.advanced_decompensated_cirrhosis_icd10_codes, after_admission),
+        cirrhosis_before_test=admissions(codelists.advanced_decompensated_cirrhosis_icd10_codes, before_test),
+    )
+
+
+def load_check_study(name):
+    return mixed_references_study() if name == MIXED_REFERENCES else load_study(name)
+
+
+# Cohort extracted on the local database
+# Output:
+# - data.frame indexed by patient_id
+def extract(database_url, covariate_definitions, batched):
+    backend = backend_for_url(database_url, covariate_definitions, batched=batched)
+    try:
+        rows = backend.to_dicts(convert_to_strings=False)
+    finally:
+        backend.close()
+    return pd.DataFrame(rows).set_index("patient_id").sort_index()
+
+
+# Columns that differ between two cohorts
+# Output:
+# - dict of column -> number of patients with another value (or a message)
+def differences(expected, actual):
+    found = {}
+    if set(expected.index) != set(actual.index):
+        found["patient_id"] = len(set(expected.index) ^ set(actual.index))
+        return found
+    for column in expected.columns:
+        if column not in actual.columns:
+            found[column] = "not extracted"
+            continue
+        left, right = expected[column], actual[column].reindex(expected.index)
+        if column in SET_COLUMNS:
+            left, right = (values.map(lambda value: frozenset(str(value).split(","))) for values in (left, right))
+        same = (left == right) | (left.isna() & right.isna())
+        if not same.all():
+            found[column] = int((~same).sum())
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that the batched queries extract the same cohort as the queries of the backend"
+    )
+    parser.add_argument(
+        "--study-definition",
+        action="append",
+        choices=[*study_definition_names(), MIXED_REFERENCES],
+        help="default all study definitions and the mixed references",
+    )
+    parser.add_argument("--patients", type=int, default=5000)
+    parser.add_argument("--database", default=str(DEFAULT_DATABASE))
+    args = parser.parse_args()
+
+    failed = False
+    for name in args.study_definition or [*study_definition_names(), MIXED_REFERENCES]:
+        study = load_check_study(name)
+        start = time.perf_counter()
+        populate(args.database, study.covariate_definitions, args.patients, study_dates())
+        database_url = f"{SQLITE_URL}{args.database}"
+        expected = extract(database_url, study.covariate_definitions, batched=False)
+        actual = extract(database_url, study.covariate_definitions, batched=True)
+        found = differences(expected, actual)
+        seconds = time.perf_counter() - start
+        print(f"{name}: {len(expected)} patients, {len(expected.columns)} columns ({seconds:.1f}s)")
+        for column, difference in found.items():
+            print(f"  {column}: {difference}")
+        failed = failed or bool(found)
+    if failed:
+        sys.exit("The batched queries extract another cohort")
+
+
+if __name__ == "__main__":
+    main()
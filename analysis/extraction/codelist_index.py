@@ -0,0 +1,128 @@
+# Integer index of the codes in the codelists of codelists.py
+#
+# Every code of a coding system is interned once to an integer id (its rank
+# in the sorted array of all codes of that system in the index). Each
+# codelist is stored as a sorted array of ids, and a (codes x codelists)
+# membership matrix is kept, so that union, intersection and 'which codelists
+# does this code belong to' are vectorised numpy operations. Columns of codes
+# (e.g. of an events table) are converted to ids once, after which they can be
+# matched against many codelists in one pass.
+import numpy as np
+
+# ids of codes that are not in any codelist of the index
+MISSING_ID = -1
+
+
+class CodelistIndex:
+    # codelists: dict of name -> cohortextractor Codelist, all of one system
+    def __init__(self, codelists):
+        systems = {codelist.system for codelist in codelists.values()}
+        if len(systems) > 1:
+            raise ValueError(
+                f"Cannot index codelists from different systems: {', '.join(sorted(systems))}"
+            )
+        self.system = systems.pop() if systems else None
+        self.names = list(codelists)
+        self.positions = {name: i for i, name in enumerate(self.names)}
+        codes_per_codelist = {
+            name: [code[0] if codelist.has_categories else code for code in codelist]
+            for name, codelist in codelists.items()
+        }
+        all_codes = sorted({code for codes in codes_per_codelist.values() for code in codes})
+        self.codes = np.array(all_codes, dtype=object)
+        self._sorted_codes = np.array(all_codes, dtype=str)
+        self.ids = {}
+        self.categories = {}
+        self.membership = np.zeros((len(all_codes), len(self.names)), dtype=bool)
+        for name, codelist in codelists.items():
+            ids = self.lookup(codes_per_codelist[name])
+            order = np.argsort(ids, kind="stable")
+            ids = ids[order]
+            # codelists can contain duplicate codes
+            ids, first = np.unique(ids, return_index=True)
+            self.ids[name] = ids
+            self.membership[ids, self.positions[name]] = True
+            if codelist.has_categories:
+                categories = np.array([code[1] for code in codelist], dtype=object)
+                self.categories[name] = categories[order][first]
+
+    # Build one index per coding system
+    # Output:
+    # - dict of system -> CodelistIndex
+    @classmethod
+    def per_system(cls, codelists):
+        by_system = {}
+        for name, codelist in codelists.items():
+            by_system.setdefault(codelist.system, {})[name] = codelist
+        return {system: cls(lists) for system, lists in by_system.items()}
+
+    def __len__(self):
+        return len(self.codes)
+
+    # Convert codes to ids
+    # Input:
+    # - codes: iterable or array of code strings
+    # Output:
+    # - int array of ids, MISSING_ID for codes not in the index
+    def lookup(self, codes):
+        codes = np.asarray(codes, dtype=str)
+        if len(self._sorted_codes) == 0:
+            return np.full(codes.shape, MISSING_ID, dtype=np.int64)
+        ids = np.searchsorted(self._sorted_codes, codes)
+        ids[ids == len(self._sorted_codes)] = 0
+        return np.where(self._sorted_codes[ids] == codes, ids, MISSING_ID)
+
+    # Convert ids to code strings
+    def code(self, ids):
+        return self.codes[np.asarray(ids)]
+
+    # Ids of the codes in the union/intersection of codelists
+    def union(self, *names):
+        return np.flatnonzero(self.membership[:, self._columns(names)].any(axis=1))
+
+    def intersection(self, *names):
+        return np.flatnonzero(self.membership[:, self._columns(names)].all(axis=1))
+
+    # Which codes are in a codelist
+    # Input:
+    # - name: name of the codelist
+    # - ids: int array of ids (may include MISSING_ID)
+    # Output:
+    # - boolean array
+    def contains(self, name, ids):
+        return self.matches(ids)[:, self.positions[name]]
+
+    # Membership of codes in all codelists
+    # Input:
+    # - ids: int array of ids (may include MISSING_ID)
+    # Output:
+    # - boolean array of shape (len(ids), number of codelists), column j is
+    #   True if the code is in codelist self.names[j]
+    def matches(self, ids, names=None):
+        ids = np.asarray(ids)
+        membership = self.membership
+        if names is not None:
+            membership = membership[:, self._columns(names)]
+        matched = np.zeros((len(ids), membership.shape[1]), dtype=bool)
+        known = ids != MISSING_ID
+        matched[known] = membership[ids[known]]
+        return matched
+
+    # Names of the codelists a code belongs to
+    def codelists_of(self, code):
+        code_id = self.lookup([code])[0]
+        if code_id == MISSING_ID:
+            return []
+        return [self.names[j] for j in np.flatnonzero(self.membership[code_id])]
+
+    # Category of codes in a categorised codelist (None if not in the codelist)
+    def category(self, name, ids):
+        ids = np.asarray(ids)
+        codelist_ids = self.ids[name]
+        positions = np.searchsorted(codelist_ids, ids)
+        positions[positions == len(codelist_ids)] = 0
+        found = (len(codelist_ids) > 0) & (codelist_ids[positions] == ids)
+        return np.where(found, self.categories[name][positions], None)
+
+    def _columns(self, names):
+        return [self.positions[name] for name in names]
@@ -0,0 +1,95 @@
+# Date expressions referencing other variables, evaluated per patient
+#
+# Study definitions use date expressions such as
+# 'covid_test_positive_date + 28 days' or 'covid_vax_1 + 19 days' in
+# 'between', 'on_or_before' and 'on_or_after'. cohortextractor evaluates
+# expressions without a reference to a variable (e.g. 'index_date + 1 month')
+# when the study definition is loaded and keeps the ones with a reference, the
+# functions below parse and evaluate those on columns of dates.
+import re
+
+import numpy as np
+from cohortextractor.date_expressions import DateExpressionEvaluator
+
+ISO_DATE = re.compile(r"^\d\d\d\d-\d\d-\d\d$")
+
+
+# Parse a date expression
+# Output:
+# - dict with 'name', 'function', 'operator', 'quantity', 'units' or None if
+#   the expression is a date (or None)
+def parse_date_expression(expression):
+    if expression is None or ISO_DATE.match(expression):
+        return None
+    match = DateExpressionEvaluator.regex.match(expression.replace(" ", ""))
+    if not match:
+        raise ValueError(f"Unparseable date expression: {expression}")
+    return match.groupdict()
+
+
+# Name of the variable a date expression refers to (None for dates)
+def referenced_variable(expression):
+    parsed = parse_date_expression(expression)
+    return parsed["name"] if parsed else None
+
+
+# Names of the variables referenced in 'between' (a pair of date expressions)
+def referenced_variables(between):
+    if not between:
+        return []
+    return [name for name in map(referenced_variable, between) if name]
+
+
+# Evaluate a date expression
+# Input:
+# - expression: date expression or date (YYYY-MM-DD)
+# - columns: dict of name -> datetime64[D] array of the referenced variables
+# Output:
+# - datetime64[D] array (expression referencing a variable), datetime64[D]
+#   scalar (date) or None
+def evaluate_date_expression(expression, columns):
+    parsed = parse_date_expression(expression)
+    if parsed is None:
+        return np.datetime64(expression, "D") if expression else None
+    dates = np.asarray(columns[parsed["name"]], dtype="datetime64[D]")
+    if parsed["function"]:
+        dates = apply_date_function(dates, parsed["function"])
+    if parsed["operator"]:
+        quantity = int(parsed["quantity"])
+        if parsed["operator"] == "-":
+            quantity = -quantity
+        dates = add_to_dates(dates, quantity, parsed["units"])
+    return dates
+
+
+def apply_date_function(dates, function):
+    months = dates.astype("datetime64[M]")
+    years = dates.astype("datetime64[Y]")
+    if function == "first_day_of_month":
+        return months.astype("datetime64[D]")
+    if function == "last_day_of_month":
+        return (months + 1).astype("datetime64[D]") - 1
+    if function == "first_day_of_year":
+        return years.astype("datetime64[D]")
+    if function == "last_day_of_year":
+        return (years + 1).astype("datetime64[D]") - 1
+    raise ValueError(f"Unsupported date function '{function}'")
+
+
+# Add days, months or years, as cohortextractor does (dates that do not exist,
+# e.g. 31 Feb, are moved to the last day of the month)
+def add_to_dates(dates, quantity, units):
+    units = units.rstrip("s")
+    if units == "day":
+        return dates + np.timedelta64(quantity, "D")
+    if units == "month":
+        months = quantity
+    elif units == "year":
+        months = 12 * quantity
+    else:
+        raise ValueError(f"Unknown date unit '{units}'")
+    first_of_month = dates.astype("datetime64[M]")
+    day = dates - first_of_month.astype("datetime64[D]")
+    shifted = first_of_month + np.timedelta64(months, "M")
+    last_day = (shifted + 1).astype("datetime64[D]") - shifted.astype("datetime64[D]") - 1
+    return shifted.astype("datetime64[D]") + np.minimum(day, last_day)
@@ -0,0 +1,541 @@
+# Vectorised dummy data for the study definitions
+#
+# Drop-in replacement of cohortextractor's dummy data generation
+# (generate_cohort --expectations-population) that generates every column
+# at once with numpy, so dummy cohorts of millions of patients can be used to
+# load test the R actions (data_process.R, prepare_data.R, ...).
+#
+# Columns are generated from the 'return_expectations' of each variable
+# (merged with the study's 'default_expectations') the same way as
+# cohortextractor does:
+# - dates: 'date' {'earliest', 'latest'}, 'rate' ('uniform' or
+#   'exponential_increase') and 'incidence', filtered on fixed 'between' dates
+# - bools: 1 with probability 'incidence' (universal: always 1), 0 otherwise
+# - categories: sampled from 'category' {'ratios'}
+# - ints: 'int' {'distribution': 'normal', 'poisson' or 'population_ages'}
+# - floats: 'float' {'distribution': 'normal'}
+# Missing values are 0 for bools/ints/floats and empty for dates/categories.
+# The number of missing values follows 'incidence' per patient rather than
+# exactly (cohortextractor empties exactly (1 - incidence) * population rows).
+#
+# With --consistent-dates, dates respect the date expressions referencing other
+# variables in the study definition (e.g. between=['covid_test_positive_date',
+# 'covid_test_positive_date + 28 days']): a date is drawn per patient in its
+# window, and is missing if a date it refers to is missing (as when extracting
+# from the backend). Other variables with such a window are missing if the
+# window is. A window from a referenced date to a fixed date (e.g. date_treated
+# and the *_covid_therapeutics dates, between the positive test and the end of
+# the study) ends FOLLOW_UP_DAYS after the referenced date, the follow-up of
+# the analyses. Without it, these expressions are ignored (as by
+# cohortextractor).
+#
+# With --evaluate-expressions, patients.satisfying/categorised_as variables
+# (e.g. high_risk_group, eligible, imdQ5) are evaluated from the variables in
+# their expressions (see expressions.py) instead of sampled from their ratios,
+# so they are consistent with the other columns. Variables with an expression
+# on a hidden variable without expectations are sampled.
+#
+# Cohorts are generated and written in chunks (--chunk-size), so cohorts of
+# tens of millions of patients can be written with flat memory use.
+#
+# Usage (from the root of the repository):
+# python -m analysis.extraction.dummy_data --study-definition study_definition
+#   --population 1000000 --output output/input.feather
+import argparse
+import gzip
+import os
+import time
+from contextlib import ExitStack
+from pathlib import Path
+
+import cohortextractor
+import numpy as np
+import pandas as pd
+from cohortextractor.study_definition import StudyDefinition, merge
+
+from .date_expressions import evaluate_date_expression, referenced_variables
+from .expressions import column_values, compile_categories
+from .study import load_study
+
+# functions of which dummy data is not generated from expectations
+UNSUPPORTED_FUNCTIONS = ["with_value_from_file", "which_exist_in_file"]
+# days from 'earliest' to 'latest' is scaled to 10 x the scale of the
+# exponential distribution (see cohortextractor.expectation_generators)
+EXPONENTIAL_SCALE = 0.1
+# days after a referenced date of a window ending on a fixed date
+# (consistent_dates), the 28 days of follow-up after the positive test
+FOLLOW_UP_DAYS = 28
+# patients generated and written at a time
+DEFAULT_CHUNK_SIZE = 100_000
+# fast compression, dummy data is written for testing, not for storage
+GZIP_LEVEL = 1
+
+
+# Probabilities of age 0 to max_age - 1, approximating the UK population
+# (same as cohortextractor.expectation_generators.generate_ages)
+def population_age_probabilities(max_age=110):
+    bands = pd.read_csv(
+        os.path.join(os.path.dirname(cohortextractor.__file__), "uk_population_bands_2018.csv")
+    )
+    band_end = bands["band"].str.split("-").str[1].astype(int).to_numpy()
+    count = bands["range"].str.replace(",", "").astype(int).to_numpy()
+    ages = np.arange(max_age)
+    # count of the first band with age <= end of band
+    p = count[np.searchsorted(band_end, ages)] / count.sum() / 5
+    p[np.argmax(p)] -= p.sum() - 1
+    return p
+
+
+class DummyDataGenerator:
+    # study: cohortextractor StudyDefinition
+    # seed: seed of the random number generator
+    # consistent_dates: respect date expressions referencing other variables
+    # evaluate_expressions: evaluate categorised_as variables from the
+    #   variables in their expressions
+    def __init__(self, study, seed=None, consistent_dates=False, evaluate_expressions=False):
+        self.study = study
+        self.consistent_dates = consistent_dates
+        self.evaluate_expressions = evaluate_expressions
+        self.rng = np.random.default_rng(seed)
+        self._population_age_probabilities = None
+        self.columns = self.column_specs(study.pandas_csv_args)
+        # hidden columns are only generated if an aggregate needs them
+        hidden = {
+            name: (funcname, {**kwargs, "hidden": False})
+            for name, (funcname, kwargs) in study.covariate_definitions.items()
+            if name != "population" and kwargs.get("hidden")
+        }
+        self.hidden_columns = self.column_specs(StudyDefinition.get_pandas_csv_args(hidden))
+
+    # Type and expectations of each column
+    # Output:
+    # - dict of name -> dict with 'kind' (date, bool, int, float, category),
+    #   'args' (arguments of the variable) and 'expectations'
+    def column_specs(self, pandas_csv_args):
+        specs = {}
+        for name, args in pandas_csv_args["args"].items():
+            if args["funcname"] in UNSUPPORTED_FUNCTIONS:
+                raise ValueError(f"Dummy data of {name} ({args['funcname']}) is not supported")
+            if name in pandas_csv_args["parse_dates"]:
+                kind = "date"
+            else:
+                kind = {
+                    "bool": "bool",
+                    "Int64": "int",
+                    "float": "float",
+                    "category": "category",
+                }[pandas_csv_args["dtype"][name]]
+            return_expectations = args.get("return_expectations")
+            between = args.get("between")
+            if "source" in args and kind == "date":
+                # date of a value, uses the expectations and period of the value
+                source_args = pandas_csv_args["args"][args["source"]]
+                return_expectations = source_args["return_expectations"]
+                between = source_args.get("between")
+            expectations = merge(self.study.default_expectations, return_expectations or {})
+            if args["funcname"] not in ["aggregate_of", "fixed_value"]:
+                if not self.study.default_expectations and not return_expectations:
+                    raise ValueError(
+                        f"No `return_expectations` defined for {name} "
+                        "and no `default_expectations` defined for the study"
+                    )
+            specs[name] = {
+                "kind": kind,
+                "args": args,
+                "expectations": expectations,
+                "between": between,
+                "match_incidence": pandas_csv_args["date_col_for"].get(name),
+            }
+        return specs
+
+    # Generate a dummy cohort
+    # Input:
+    # - population: number of patients
+    # - first_patient_id: patient_id of the first patient, patient ids are
+    #   first_patient_id, first_patient_id + 1, ...
+    # Output:
+    # - pandas.DataFrame with column patient_id and a column per variable
+    def generate(self, population, first_patient_id=1):
+        columns = {"patient_id": np.arange(first_patient_id, first_patient_id + population)}
+        columns.update(self.generate_columns(self.columns, population))
+        return pd.DataFrame(columns)
+
+    def generate_columns(self, specs, population):
+        columns = {}
+        # dates first, values of a date (e.g. creatinine and its date) are
+        # present if the date is present
+        for name, spec in self.dates_in_order(specs):
+            columns[name] = self.generate_date(name, spec, population, columns)
+        for name, spec in specs.items():
+            if self.is_evaluated(spec):
+                continue
+            if spec["kind"] != "date" and spec["args"]["funcname"] not in ["aggregate_of", "fixed_value"]:
+                present = None
+                if spec["match_incidence"]:
+                    present = ~np.isnat(columns[spec["match_incidence"]])
+                if self.consistent_dates and referenced_variables(spec["between"]):
+                    lower, upper = self.window(spec["between"], columns)
+                    in_window = window_exists(lower, upper)
+                    if present is None:
+                        present = self.present(name, spec["expectations"], population)
+                    present = present & in_window
+                columns[name] = self.generate_value(name, spec, population, present)
+        for name, spec in specs.items():
+            if spec["args"]["funcname"] == "fixed_value":
+                columns[name] = self.generate_fixed_value(spec, population)
+        for name, spec in specs.items():
+            if spec["args"]["funcname"] == "aggregate_of":
+                columns[name] = self.generate_aggregate(spec, columns, population)
+        for name, spec in specs.items():
+            if self.is_evaluated(spec):
+                columns[name] = self.generate_categorised(name, spec, columns, population)
+        for name, spec in specs.items():
+            if spec["kind"] == "date":
+                columns[name] = truncate_dates(columns[name], spec["args"].get("date_format"))
+        return {name: columns[name] for name in specs}
+
+    # Dates generated from expectations, in an order such that the dates a
+    # date refers to are generated first (consistent_dates)
+    # Output:
+    # - list of (name, spec), including hidden variables that are referred to
+    def dates_in_order(self, specs):
+        def is_generated(spec):
+            return spec["kind"] == "date" and spec["args"]["funcname"] not in ["aggregate_of", "fixed_value"]
+
+        if not self.consistent_dates:
+            return [(name, spec) for name, spec in specs.items() if is_generated(spec)]
+        ordered = {}
+
+        def visit(name, spec, visiting=()):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError(f"Circular date references: {' -> '.join(visiting + (name,))}")
+            for reference in referenced_variables(spec["between"]):
+                reference_spec = specs.get(reference) or self.columns.get(reference) or self.hidden_columns[reference]
+                if reference_spec["kind"] == "date":
+                    visit(reference, reference_spec, visiting + (name,))
+            ordered[name] = spec
+
+        for name, spec in specs.items():
+            if is_generated(spec) or (spec["kind"] != "date" and referenced_variables(spec["between"])):
+                visit(name, spec)
+        return [(name, spec) for name, spec in ordered.items() if is_generated(spec)]
+
+    # Window of a variable per patient from its 'between' (consistent_dates)
+    # Output:
+    # - lower, upper: datetime64[D] arrays, scalars or None
+    def window(self, between, columns):
+        return tuple(evaluate_date_expression(bound, columns) for bound in between)
+
+    def generate_date(self, name, spec, population, columns=None):
+        expectations = spec["expectations"]
+        if "date" not in expectations:
+            raise ValueError(f"{name} must define a date expectation")
+        for key in ["earliest", "latest"]:
+            if key not in expectations["date"]:
+                raise ValueError(f"{name} must define a date[{key}] expectation")
+        earliest = np.datetime64(expectations["date"]["earliest"], "D")
+        latest = np.datetime64(expectations["date"]["latest"], "D")
+        present = self.present(name, expectations, population)
+        if self.consistent_dates and referenced_variables(spec["between"]):
+            lower, upper = self.window(spec["between"], columns)
+            # the expectations only give the length of a window with one
+            # referenced bound (e.g. on_or_before='covid_test_positive_date')
+            if lower is None:
+                lower = upper - (latest - earliest)
+            if upper is None:
+                upper = lower + (latest - earliest)
+            elif referenced_variables(spec["between"][:1]) and not referenced_variables(spec["between"][1:]):
+                upper = np.minimum(upper, lower + np.timedelta64(FOLLOW_UP_DAYS, "D"))
+            earliest, latest = np.broadcast_arrays(lower, upper)
+            present &= window_exists(earliest, latest)
+            # no window (NaT) for patients without a date
+            elapsed_days = np.where(present, (latest - earliest).astype(int), 0)
+        else:
+            elapsed_days = (latest - earliest).astype(int)
+        rate = expectations.get("rate", "exponential_increase")
+        uniform = self.rng.random(population)
+        # days in [0, elapsed_days + 1), so both bounds of the window are drawn
+        window_days = elapsed_days + 1
+        if rate == "exponential_increase":
+            # exponential distribution truncated at window_days
+            truncation = 1 - np.exp(-1 / EXPONENTIAL_SCALE)
+            days = -EXPONENTIAL_SCALE * window_days * np.log1p(-uniform * truncation)
+        elif rate == "uniform":
+            days = uniform * window_days
+        else:
+            raise ValueError(
+                "Only exponential_increase and uniform distributions currently supported"
+            )
+        dates = latest - days.astype("timedelta64[D]")
+        dates[~present] = np.datetime64("NaT")
+        min_date, max_date = StudyDefinition.filter_date_range(spec["between"])
+        if min_date:
+            dates[dates < np.datetime64(min_date, "D")] = np.datetime64("NaT")
+        if max_date:
+            dates[dates > np.datetime64(max_date, "D")] = np.datetime64("NaT")
+        return dates
+
+    def generate_value(self, name, spec, population, present=None):
+        expectations = spec["expectations"]
+        if present is None:
+            present = self.present(name, expectations, population)
+        kind = spec["kind"]
+        if kind == "bool":
+            return present
+        if kind == "category":
+            if "category" not in expectations:
+                raise ValueError(f"Column definition {name} does not return expected type category")
+            return self.generate_category(expectations["category"]["ratios"], population, present)
+        distribution = expectations.get(kind)
+        if distribution is None:
+            raise ValueError(f"Column definition {name} does not return expected type {kind}")
+        if kind == "int":
+            values = self.generate_int(distribution, population)
+        else:
+            if distribution["distribution"] != "normal":
+                raise ValueError("Only `normal` distributions currently supported for floats")
+            values = self.rng.normal(distribution["mean"], distribution["stddev"], population)
+        values[~present] = 0
+        return values
+
+    def generate_int(self, distribution, population):
+        if distribution["distribution"] == "normal":
+            return self.rng.normal(
+                distribution["mean"], distribution["stddev"], population
+            ).astype(np.int64)
+        elif distribution["distribution"] == "poisson":
+            return self.rng.poisson(distribution["mean"], population)
+        elif distribution["distribution"] == "population_ages":
+            if self._population_age_probabilities is None:
+                self._population_age_probabilities = population_age_probabilities()
+            p = self._population_age_probabilities
+            return self.rng.choice(len(p), size=population, p=p)
+        raise ValueError(
+            "Only `normal`, `poisson`, and `population_ages` distributions currently supported for ints"
+        )
+
+    def generate_category(self, ratios, population, present):
+        labels = list(ratios)
+        p = np.array(list(ratios.values()), dtype=float)
+        sampled = self.rng.choice(len(labels), size=population, p=p / p.sum())
+        # None (e.g. no comparator) is a missing value
+        categories = [str(label) for label in labels if label is not None]
+        codes = np.array(
+            [categories.index(str(label)) if label is not None else -1 for label in labels]
+        )[sampled]
+        codes[~present] = -1
+        return pd.Categorical.from_codes(codes, categories=categories)
+
+    def generate_fixed_value(self, spec, population):
+        value = spec["args"]["value"]
+        if spec["kind"] == "date":
+            return np.full(population, np.datetime64(value, "D"))
+        return np.full(population, value)
+
+    def generate_aggregate(self, spec, columns, population):
+        args = spec["args"]
+        missing = [name for name in args["column_names"] if name not in columns]
+        if missing:
+            hidden = {name: self.hidden_columns[name] for name in missing}
+            columns = {**columns, **self.generate_columns(hidden, population)}
+        values = pd.DataFrame({name: columns[name] for name in args["column_names"]})
+        if args["aggregate_function"] == "MIN":
+            aggregate = values.min(axis=1)
+        elif args["aggregate_function"] == "MAX":
+            aggregate = values.max(axis=1)
+        else:
+            raise ValueError(f"Unsupported aggregate function '{args['aggregate_function']}'")
+        if spec["kind"] == "date":
+            return aggregate.to_numpy(dtype="datetime64[D]")
+        return aggregate.to_numpy()
+
+    def is_evaluated(self, spec):
+        return self.evaluate_expressions and spec["args"]["funcname"] == "categorised_as"
+
+    # Evaluate a categorised_as variable (evaluate_expressions), the hidden and
+    # categorised_as variables of its expressions are generated if needed
+    # ('columns' is updated with these)
+    def generate_categorised(self, name, spec, columns, population, visiting=()):
+        if name in visiting:
+            raise ValueError(f"Circular references: {' -> '.join(visiting + (name,))}")
+        category_definitions = spec["args"]["category_definitions"]
+        evaluate = compile_categories(tuple(category_definitions.items()))
+        try:
+            for reference in evaluate.names:
+                if reference in columns:
+                    continue
+                reference_spec = self.columns.get(reference) or self.hidden_columns[reference]
+                if self.is_evaluated(reference_spec):
+                    columns[reference] = self.generate_categorised(
+                        reference, reference_spec, columns, population, visiting + (name,)
+                    )
+                else:
+                    columns.update(self.generate_columns({reference: reference_spec}, population))
+        except ValueError:
+            # no expectations of a hidden variable
+            return self.generate_value(name, spec, population)
+        chosen = evaluate({reference: column_values(columns[reference]) for reference in evaluate.names})
+        if spec["kind"] == "category":
+            # None (no DEFAULT) is a missing value
+            labels = [str(label) for label in evaluate.labels if label is not None]
+            codes = np.array([labels.index(str(label)) if label is not None else -1 for label in evaluate.labels])
+            return pd.Categorical.from_codes(codes[chosen], categories=labels)
+        values = np.array([0 if label is None else label for label in evaluate.labels])[chosen]
+        if spec["kind"] == "bool":
+            return values.astype(int).astype(bool)
+        return values.astype(float if spec["kind"] == "float" else np.int64)
+
+    # Which patients have a value, following 'incidence' (or 'rate' universal)
+    def present(self, name, expectations, population):
+        incidence = expectations.get("incidence")
+        universal = expectations.get("rate") == "universal"
+        if not (incidence or universal):
+            raise ValueError(
+                f"You must specify an incidence, or a `universal` rate for {name}: "
+                f"got {incidence} and {expectations.get('rate')}"
+            )
+        if universal:
+            return np.ones(population, dtype=bool)
+        return self.rng.random(population) < incidence
+
+
+# Which patients have a window with at least one day (both bounds of a window
+# referencing a missing date are missing)
+def window_exists(lower, upper):
+    exists = True
+    for bound in (lower, upper):
+        if bound is not None:
+            exists = exists & ~np.isnat(bound)
+    if lower is not None and upper is not None:
+        exists = exists & (lower <= upper)
+    return exists
+
+
+# Reduce dates to the precision of 'date_format' (first day of month/year)
+def truncate_dates(dates, date_format):
+    if date_format == "YYYY-MM-DD":
+        return dates
+    unit = "M" if date_format == "YYYY-MM" else "Y"
+    return dates.astype(f"datetime64[{unit}]").astype("datetime64[D]")
+
+
+# Format dates as strings in 'date_format', missing dates are empty strings
+def format_dates(dates, date_format):
+    unit = {"YYYY-MM-DD": "D", "YYYY-MM": "M"}.get(date_format, "Y")
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    strings = np.datetime_as_string(dates.astype(f"datetime64[{unit}]"), unit=unit)
+    return np.where(np.isnat(dates), "", strings)
+
+
+# Dummy cohort as an arrow record batch
+# - csv: values as written to csv by cohortextractor, i.e. bools as 0/1 and
+#   dates that are not YYYY-MM-DD as strings in the variable's date_format
+# - otherwise: typed columns (dates as date32, bools as booleans and
+#   categories dictionary encoded)
+# The schema only depends on the study definition, so batches of all chunks
+# of a cohort have the same schema
+def to_record_batch(df, generator, csv=False):
+    import pyarrow as pa
+
+    arrays = {"patient_id": pa.array(df["patient_id"].to_numpy())}
+    for name, spec in generator.columns.items():
+        values = df[name]
+        if spec["kind"] == "date":
+            date_format = spec["args"].get("date_format")
+            if csv and date_format != "YYYY-MM-DD":
+                strings = format_dates(values.to_numpy(), date_format)
+                arrays[name] = pa.array(strings, mask=strings == "")
+            else:
+                arrays[name] = pa.array(values.to_numpy(dtype="datetime64[D]"))
+        elif spec["kind"] == "bool":
+            arrays[name] = pa.array(values.to_numpy().astype(np.int8) if csv else values.to_numpy())
+        elif spec["kind"] == "category":
+            codes = values.cat.codes.to_numpy()
+            categories = pa.array(list(values.cat.categories), type=pa.string())
+            array = pa.DictionaryArray.from_arrays(pa.array(codes, mask=codes == -1), categories)
+            arrays[name] = array.cast(pa.string()) if csv else array
+        else:
+            arrays[name] = pa.array(values.to_numpy())
+    return pa.RecordBatch.from_arrays(list(arrays.values()), names=list(arrays))
+
+
+# Generate a dummy cohort and write it in chunks
+# Chunks of chunk_size patients are generated and written one at a time, so
+# memory use does not depend on the size of the cohort
+# Input:
+# - generator: DummyDataGenerator
+# - population: number of patients
+# - filename: .csv, .csv.gz or .feather (arrow ipc) file
+# - chunk_size: number of patients per chunk
+def write_dummy_data(generator, population, filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+
+    filename = str(filename)
+    csv = filename.endswith(".csv") or filename.endswith(".csv.gz")
+    if not csv and not filename.endswith(".feather"):
+        raise ValueError(f"Unsupported output format: {filename}")
+    Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    writer = None
+    with ExitStack() as stack:
+        if filename.endswith(".csv.gz"):
+            sink = stack.enter_context(gzip.open(filename, "wb", compresslevel=GZIP_LEVEL))
+        else:
+            sink = filename
+        for first in range(0, population, chunk_size):
+            n = min(chunk_size, population - first)
+            batch = to_record_batch(
+                generator.generate(n, first_patient_id=first + 1), generator, csv=csv
+            )
+            if writer is None:
+                if csv:
+                    writer = pa_csv.CSVWriter(
+                        sink, batch.schema, write_options=pa_csv.WriteOptions(quoting_style="needed")
+                    )
+                else:
+                    writer = pa.ipc.new_file(sink, batch.schema)
+                stack.enter_context(writer)
+            writer.write_batch(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate dummy data of a study definition from its return_expectations"
+    )
+    parser.add_argument("--study-definition", default="study_definition")
+    parser.add_argument("--population", type=int, default=5000)
+    parser.add_argument("--output", default="output/input.feather")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--consistent-dates",
+        action="store_true",
+        help="respect date expressions referencing other variables (e.g. 'covid_test_positive_date + 28 days')",
+    )
+    parser.add_argument(
+        "--evaluate-expressions",
+        action="store_true",
+        help="evaluate satisfying/categorised_as variables from the variables in their expressions",
+    )
+    args = parser.parse_args()
+
+    study = load_study(args.study_definition)
+    start = time.perf_counter()
+    generator = DummyDataGenerator(
+        study,
+        seed=args.seed,
+        consistent_dates=args.consistent_dates,
+        evaluate_expressions=args.evaluate_expressions,
+    )
+    write_dummy_data(generator, args.population, args.output, chunk_size=args.chunk_size)
+    print(
+        f"{args.study_definition}: {args.population} patients, "
+        f"{len(generator.columns) + 1} columns written to {args.output} "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
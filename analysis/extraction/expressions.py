@@ -0,0 +1,437 @@
+# Vectorised evaluation of the expressions of patients.satisfying and
+# patients.categorised_as
+#
+# Expressions (e.g. 'age >= 18 AND NOT has_died AND (sex = "M" OR sex = "F")')
+# are tokenised as cohortextractor does (sqlparse), parsed once into a tree and
+# compiled into a function of the columns of a cohort that evaluates the
+# expression with numpy operations on whole columns. Compiled expressions are
+# cached by their text, so expressions shared by study definitions (e.g. the
+# categories of ethnicity) are compiled once.
+#
+# As on the backend, a variable that is not compared is true if it is not
+# empty (not 0, '' or a missing date) and comparisons with a missing date are
+# false.
+#
+# Usage (from the root of the repository):
+# python -m analysis.extraction.expressions --rows 5000000
+import argparse
+import functools
+import operator
+import time
+
+import numpy as np
+import pandas as pd
+import sqlparse
+from sqlparse import tokens as ttypes
+
+COMPARISONS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+FLIPPED = {"=": "=", "!=": "!=", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
+ARITHMETIC = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.truediv,
+}
+
+
+def tokenise(expression):
+    tokens = []
+    for token in sqlparse.parse(expression)[0].flatten():
+        if token.ttype in ttypes.Whitespace or token.ttype in ttypes.Comment:
+            continue
+        if token.ttype in ttypes.Literal.String:
+            tokens.append(("literal", token.value[1:-1]))
+        elif token.ttype in ttypes.Number.Integer:
+            tokens.append(("literal", int(token.value)))
+        elif token.ttype in ttypes.Number.Float:
+            tokens.append(("literal", float(token.value)))
+        elif token.ttype is ttypes.Name:
+            tokens.append(("name", token.value))
+        elif token.ttype in ttypes.Keyword and token.value.upper() in ("AND", "OR", "NOT"):
+            tokens.append((token.value.upper(), None))
+        elif token.ttype in ttypes.Comparison or token.ttype in ttypes.Operator or token.value in "()":
+            tokens.append((token.value, None))
+        else:
+            raise ValueError(f"Disallowed token {token.value!r} in expression: {expression}")
+    return tokens
+
+
+class Parser:
+    # Recursive descent parser, from lowest to highest precedence:
+    # OR, AND, NOT, comparisons, + and -, * and /
+    # Output of parse(): tree of tuples
+    # - ('or' | 'and', left, right), ('not', operand)
+    # - ('compare' | 'arithmetic', operator, left, right)
+    # - ('name', name), ('literal', value)
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenise(expression)
+        self.position = 0
+
+    def parse(self):
+        tree = self.parse_or()
+        if self.position != len(self.tokens):
+            self.error()
+        return tree
+
+    def peek(self):
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def take(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def error(self):
+        raise ValueError(f"Invalid expression: {self.expression}")
+
+    def parse_or(self):
+        tree = self.parse_and()
+        while self.peek() == "OR":
+            self.take()
+            tree = ("or", tree, self.parse_and())
+        return tree
+
+    def parse_and(self):
+        tree = self.parse_not()
+        while self.peek() == "AND":
+            self.take()
+            tree = ("and", tree, self.parse_not())
+        return tree
+
+    def parse_not(self):
+        if self.peek() == "NOT":
+            self.take()
+            return ("not", self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        tree = self.parse_sum()
+        if self.peek() in COMPARISONS:
+            comparison = self.take()[0]
+            tree = ("compare", comparison, tree, self.parse_sum())
+        return tree
+
+    def parse_sum(self):
+        tree = self.parse_product()
+        while True:
+            if self.peek() in ("+", "-"):
+                arithmetic = self.take()[0]
+                tree = ("arithmetic", arithmetic, tree, self.parse_product())
+            elif self.peek() == "literal" and self.negative_number_follows():
+                # sqlparse tokenises 'a -1' as a name and the number -1
+                _, value = self.take()
+                tree = ("arithmetic", "-", tree, ("literal", -value))
+            else:
+                return tree
+
+    def negative_number_follows(self):
+        value = self.tokens[self.position][1]
+        return isinstance(value, (int, float)) and value < 0
+
+    def parse_product(self):
+        tree = self.parse_atom()
+        while self.peek() in ("*", "/"):
+            arithmetic = self.take()[0]
+            tree = ("arithmetic", arithmetic, tree, self.parse_atom())
+        return tree
+
+    def parse_atom(self):
+        kind = self.peek()
+        if kind == "(":
+            self.take()
+            tree = self.parse_or()
+            if self.peek() != ")":
+                self.error()
+            self.take()
+            return tree
+        if kind in ("name", "literal"):
+            return self.take()
+        self.error()
+
+
+def parse_expression(expression):
+    return Parser(expression).parse()
+
+
+# Names of the variables in an expression tree
+def tree_names(tree):
+    if tree[0] == "name":
+        return {tree[1]}
+    if tree[0] == "literal":
+        return set()
+    return set().union(*(tree_names(node) for node in tree[1:] if isinstance(node, tuple)))
+
+
+# Values of a column: categories and strings as pandas.Categorical with string
+# categories (compared through their codes), bools as ints, numbers with
+# missing values as 0, dates as datetime64[D]
+def column_values(values):
+    if isinstance(values, (pd.Series, pd.Index)):
+        values = values.array
+    if isinstance(values, pd.Categorical):
+        return values.rename_categories([str(category) for category in values.categories])
+    values = np.asarray(values)
+    if values.dtype.kind in "OUS":
+        return pd.Categorical(np.where(pd.isna(values), "", values).astype(str))
+    if values.dtype.kind == "M":
+        return values.astype("datetime64[D]")
+    if values.dtype.kind == "b":
+        return values.astype(np.int8)
+    if values.dtype.kind == "f":
+        return np.nan_to_num(values)
+    return values
+
+
+# Which values are not empty
+def is_set(values):
+    if isinstance(values, pd.Categorical):
+        return per_category(values, values.categories != "", False)
+    if isinstance(values, np.ndarray) and values.dtype.kind == "M":
+        return ~np.isnat(values)
+    return values != 0
+
+
+# Value per patient from a value per category (missing: value of patients
+# without a category)
+def per_category(categorical, values, missing):
+    return np.append(np.asarray(values), missing)[categorical.codes]
+
+
+# Comparison of categories to a literal, evaluated once per category
+# (categories are compared to numbers as numbers, e.g. ckd_primis_stage >= 3)
+def compare_categories(comparison, categorical, literal):
+    categories = categorical.categories
+    if comparison in ("=", "!="):
+        if isinstance(literal, float) and literal.is_integer():
+            literal = int(literal)
+        matches = COMPARISONS[comparison](np.asarray(categories, dtype=str), str(literal))
+        return per_category(categorical, matches, COMPARISONS[comparison]("", str(literal)))
+    numbers = pd.to_numeric(categories, errors="coerce").to_numpy(dtype=float)
+    return per_category(categorical, COMPARISONS[comparison](numbers, float(literal)), False)
+
+
+# Literal as the type of the values it is compared to
+def as_type_of(literal, values):
+    if isinstance(values, np.ndarray) and values.dtype.kind == "M" and isinstance(literal, str):
+        return np.datetime64(literal, "D") if literal else np.datetime64("NaT")
+    if isinstance(values, np.ndarray) and values.dtype.kind in "iuf" and isinstance(literal, str):
+        try:
+            return float(literal) if literal else 0
+        except ValueError:
+            # never equal to a number
+            return None
+    return literal
+
+
+def compare(comparison, left, right):
+    # values computed from literals only (e.g. 32800*1/5) are literals
+    left, right = (("literal", values) if np.isscalar(values) else values for values in (left, right))
+    if isinstance(left, tuple) and not isinstance(right, tuple):
+        # literal on the right
+        left, right = right, left
+        comparison = FLIPPED[comparison]
+    if isinstance(right, tuple):
+        right = right[1]
+        if isinstance(left, tuple):
+            return COMPARISONS[comparison](left[1], right)
+        if isinstance(left, pd.Categorical):
+            return compare_categories(comparison, left, right)
+        right = as_type_of(right, left)
+        if right is None:
+            if comparison not in ("=", "!="):
+                raise ValueError(f"Cannot compare numbers {comparison} a string")
+            return np.full(len(left), comparison == "!=")
+    left, right = (
+        per_category(values, np.asarray(values.categories, dtype=object), "")
+        if isinstance(values, pd.Categorical) else values
+        for values in (left, right)
+    )
+    result = COMPARISONS[comparison](left, right)
+    # comparisons with a missing date are false (NULL on the backend)
+    for values in (left, right):
+        if isinstance(values, np.ndarray) and values.dtype.kind == "M":
+            result = result & ~np.isnat(values)
+    return result
+
+
+# Compile an expression tree into a function of the columns
+# Output:
+# - function(columns) -> value; columns is a dict of name -> array of values
+#   (see column_values()) and the value a boolean array for conditions
+def compile_tree(tree):
+    kind = tree[0]
+    if kind == "name":
+        name = tree[1]
+        return lambda columns: columns[name]
+    if kind == "literal":
+        # literals are typed when compared to the values of a column
+        return lambda columns: tree
+    if kind == "not":
+        operand = compile_condition(tree[1])
+        return lambda columns: ~operand(columns)
+    if kind in ("and", "or"):
+        left, right = compile_condition(tree[1]), compile_condition(tree[2])
+        combine = operator.and_ if kind == "and" else operator.or_
+        return lambda columns: combine(left(columns), right(columns))
+    if kind == "compare":
+        comparison = tree[1]
+        left, right = compile_tree(tree[2]), compile_tree(tree[3])
+        return lambda columns: compare(comparison, left(columns), right(columns))
+    if kind == "arithmetic":
+        arithmetic = ARITHMETIC[tree[1]]
+        left, right = compile_value(tree[2]), compile_value(tree[3])
+        return lambda columns: arithmetic(left(columns), right(columns))
+    raise ValueError(f"Unknown expression node '{kind}'")
+
+
+# Compile a tree used as a condition, values that are not compared are true if
+# they are not empty
+def compile_condition(tree):
+    function = compile_tree(tree)
+    if tree[0] in ("name", "arithmetic"):
+        return lambda columns: is_set(function(columns))
+    if tree[0] == "literal":
+        return lambda columns: bool(tree[1])
+    return function
+
+
+def compile_value(tree):
+    function = compile_tree(tree)
+    if tree[0] == "literal":
+        return lambda columns: tree[1]
+    return function
+
+
+# Compiled expression (cached by the text of the expression)
+# Output:
+# - function(columns) -> boolean array
+@functools.lru_cache(maxsize=None)
+def compile_expression(expression):
+    tree = parse_expression(expression)
+    condition = compile_condition(tree)
+
+    def evaluate(columns):
+        n = len(next(iter(columns.values())))
+        return np.broadcast_to(condition(columns), (n,))
+
+    evaluate.names = tree_names(tree)
+    return evaluate
+
+
+# Compiled categories of patients.categorised_as (cached by the definitions)
+# Input:
+# - category_definitions: tuple of (category, expression), 'DEFAULT' for the
+#   category of patients not in any other category
+# Output:
+# - function(columns) -> int array, per patient the position in
+#   function.labels of its category (the first category of which the
+#   expression is true)
+@functools.lru_cache(maxsize=None)
+def compile_categories(category_definitions):
+    default = None
+    conditions = []
+    for category, expression in category_definitions:
+        if expression.strip() == "DEFAULT":
+            default = category
+        else:
+            conditions.append((category, compile_expression(expression)))
+
+    def evaluate(columns):
+        n = len(next(iter(columns.values())))
+        chosen = np.full(n, len(conditions))
+        # last to first, so the first true condition is chosen
+        for i in reversed(range(len(conditions))):
+            chosen[conditions[i][1](columns)] = i
+        return chosen
+
+    evaluate.labels = np.array([category for category, _ in conditions] + [default], dtype=object)
+    evaluate.names = set().union(*(condition.names for _, condition in conditions))
+    return evaluate
+
+
+# Evaluate patients.categorised_as (patients.satisfying is categorised_as with
+# categories 1 and 0)
+# Input:
+# - category_definitions: dict of category -> expression
+# - columns: dict of name -> values (numpy arrays, pandas Series or
+#   Categorical) of the variables in the expressions
+# Output:
+# - object array of categories
+def evaluate_categories(category_definitions, columns):
+    evaluate = compile_categories(tuple(category_definitions.items()))
+    chosen = evaluate({name: column_values(columns[name]) for name in evaluate.names})
+    return evaluate.labels[chosen]
+
+
+def main():
+    from .dummy_data import DummyDataGenerator
+    from .study import load_study, study_definition_names
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the evaluation of the expressions of the study definitions"
+    )
+    parser.add_argument("--rows", type=int, default=5_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    definitions = {}
+    for name in study_definition_names():
+        study = load_study(name)
+        for variable, (query_type, query_args) in study.covariate_definitions.items():
+            if query_type == "categorised_as":
+                definitions[(name, variable)] = tuple(query_args["category_definitions"].items())
+    expressions = {expression for categories in definitions.values() for _, expression in categories}
+    print(
+        f"{len(definitions)} categorised_as/satisfying variables in {len(study_definition_names())} "
+        f"study definitions, {len(set(definitions.values()))} distinct, "
+        f"{len(expressions)} distinct expressions"
+    )
+
+    start = time.perf_counter()
+    for categories in set(definitions.values()):
+        compile_categories(categories)
+    print(f"parse and compile: {1000 * (time.perf_counter() - start):.1f}ms")
+
+    study = load_study("study_definition")
+    generator = DummyDataGenerator(study, seed=args.seed)
+    start = time.perf_counter()
+    df = generator.generate(args.rows)
+    columns = {name: column_values(df[name]) for name in df.columns}
+    # hidden variables do not need expectations, these are random flags
+    for name, spec in generator.hidden_columns.items():
+        try:
+            values = generator.generate_columns({name: spec}, args.rows)[name]
+        except ValueError:
+            values = generator.rng.random(args.rows) < 0.5
+        columns[name] = column_values(values)
+    print(f"{args.rows} rows of dummy data of study_definition: {time.perf_counter() - start:.1f}s")
+
+    own = {key: categories for key, categories in definitions.items() if key[0] == "study_definition"}
+    def compile_uncached(categories):
+        compile_expression.cache_clear()
+        compile_categories.cache_clear()
+        return compile_categories(categories)
+
+    for label, compile_function in [
+        ("compiled once", compile_categories),
+        ("parsed and compiled per evaluation", compile_uncached),
+    ]:
+        start = time.perf_counter()
+        for categories in own.values():
+            compile_function(categories)(columns)
+        seconds = time.perf_counter() - start
+        print(
+            f"{len(own)} variables of study_definition on {args.rows} rows, {label}: "
+            f"{seconds:.2f}s ({args.rows * len(own) / seconds / 1e6:.0f}M values/s)"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,752 @@
+# Local stand-in of the TPP backend
+#
+# LocalBackend is cohortextractor's TPPBackend with the database replaced by an
+# embedded SQLite database: the queries are generated by cohortextractor as for
+# the TPP database (T-SQL), translated to SQLite (translate()) and run on a
+# local file. The database has the TPP tables the study definitions use
+# (SCHEMA), populated with synthetic patients by populate(): registrations,
+# addresses, positive SGSS tests, clinical events and medications with the
+# codes of the codelists of the study definition, APCS/SUS admissions with its
+# ICD-10 and OPCS-4 codes (for part of the patients several on different days
+# in the 28 days after the positive test), COVID therapeutics, vaccinations and
+# ONS deaths.
+#
+# This runs the real query generation end to end without access to the
+# backend: to extract a cohort (the same output as cohortextractor), to
+# profile the queries (python -m analysis.extraction.profiler --database-url
+# sqlite:///output/local/tpp.sqlite) and to compare query plans (EXPLAIN QUERY
+# PLAN of every variable, written to a text file to diff between versions of a
+# study definition). Timings are those of SQLite, so only relative costs of
+# the queries mean something.
+#
+# Usage (from the root of the repository):
+# python -m analysis.extraction.local_backend --patients 10000
+#   [--study-definition study_definition] [--database output/local/tpp.sqlite]
+#   [--plans output/local/plans.txt] [--reuse] [--batched]
+import argparse
+import calendar
+import datetime
+import re
+import sqlite3
+import time
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+from cohortextractor.tpp_backend import TPPBackend
+
+from .batched import BatchedQueries, BatchedTPPBackend
+from .study import load_study, study_definition_names
+
+DEFAULT_DATABASE = Path("output") / "local" / "tpp.sqlite"
+SQLITE_URL = "sqlite:///"
+
+# Tables (and columns) of the TPP database used by the study definitions
+SCHEMA = {
+    "Patient": ["Patient_ID INTEGER PRIMARY KEY", "DateOfBirth TEXT", "Sex TEXT"],
+    "AllowedPatientsWithTypeOneDissent": ["Patient_ID INTEGER PRIMARY KEY"],
+    "Organisation": ["Organisation_ID INTEGER PRIMARY KEY", "STPCode TEXT", "Region TEXT", "MSOACode TEXT"],
+    "RegistrationHistory": [
+        "Registration_ID INTEGER PRIMARY KEY", "Patient_ID INTEGER", "Organisation_ID INTEGER",
+        "StartDate TEXT", "EndDate TEXT",
+    ],
+    "PatientAddress": [
+        "PatientAddress_ID INTEGER PRIMARY KEY", "Patient_ID INTEGER", "StartDate TEXT", "EndDate TEXT",
+        "ImdRankRounded INTEGER", "RuralUrbanClassificationCode INTEGER", "MSOACode TEXT",
+    ],
+    "SGSS_AllTests_Positive": [
+        "Patient_ID INTEGER", "Specimen_Date TEXT", "Variant TEXT", "VariantDetectionMethod TEXT",
+        "Symptomatic TEXT", "SGTF TEXT",
+    ],
+    "CodedEvent": [
+        "CodedEvent_ID INTEGER PRIMARY KEY", "Patient_ID INTEGER", "CTV3Code TEXT", "NumericValue REAL",
+        "ConsultationDate TEXT",
+    ],
+    "CodedEventRange": [
+        "CodedEventRange_ID INTEGER PRIMARY KEY", "CodedEvent_ID INTEGER", "LowerBound REAL",
+        "UpperBound REAL", "Comparator INTEGER",
+    ],
+    "CodedEvent_SNOMED": [
+        "CodedEvent_ID INTEGER PRIMARY KEY", "Patient_ID INTEGER", "ConceptID TEXT", "NumericValue REAL",
+        "ConsultationDate TEXT",
+    ],
+    "MedicationDictionary": ["MultilexDrug_ID TEXT PRIMARY KEY", "DMD_ID TEXT", "FullName TEXT"],
+    "MedicationIssue": [
+        "MedicationIssue_ID INTEGER PRIMARY KEY", "Patient_ID INTEGER", "MultilexDrug_ID TEXT",
+        "ConsultationDate TEXT",
+    ],
+    "VmpMapping": ["id TEXT", "prev_id TEXT"],
+    "APCS_ARCHIVED": [
+        "APCS_Ident INTEGER PRIMARY KEY", "Patient_ID INTEGER", "Admission_Date TEXT", "Discharge_Date TEXT",
+        "Admission_Method TEXT", "Source_of_Admission TEXT", "Discharge_Destination TEXT",
+        "Patient_Classification TEXT", "Administrative_Category TEXT", "Der_Diagnosis_All TEXT",
+        "Der_Procedure_All TEXT", "Ethnic_group TEXT",
+    ],
+    "APCS_Der_ARCHIVED": [
+        "APCS_Ident INTEGER PRIMARY KEY", "Spell_PbR_CC_Day TEXT", "Spell_Primary_Diagnosis TEXT",
+        "Spell_Secondary_Diagnosis TEXT",
+    ],
+    "EC_ARCHIVED": ["EC_Ident INTEGER PRIMARY KEY", "Patient_ID INTEGER", "Ethnic_Category TEXT"],
+    "OPA_ARCHIVED": ["OPA_Ident INTEGER PRIMARY KEY", "Patient_ID INTEGER", "Ethnic_Category TEXT"],
+    "Therapeutics": [
+        "Patient_ID INTEGER", "TreatmentStartDate TEXT", "Received TEXT", "Intervention TEXT",
+        "CurrentStatus TEXT", "COVID_Indication TEXT", "Region TEXT", "MOL1_high_risk_cohort TEXT",
+        "SOT02_risk_cohorts TEXT", "CASIM05_risk_cohort TEXT", "AgeAtReceivedDate INTEGER",
+        "FormName TEXT", "MOL1_onset_of_symptoms TEXT", "SOT02_onset_of_symptoms TEXT", "Count INTEGER",
+        "Der_LoadDate TEXT",
+    ],
+    "VaccinationReference": ["VaccinationName_ID INTEGER PRIMARY KEY", "VaccinationName TEXT", "VaccinationContent TEXT"],
+    "Vaccination": [
+        "Vaccination_ID INTEGER PRIMARY KEY", "Patient_ID INTEGER", "VaccinationName_ID INTEGER",
+        "VaccinationDate TEXT",
+    ],
+    "ONS_Deaths": [
+        "Patient_ID INTEGER", "dod TEXT", "icd10u TEXT",
+        *(f"ICD10{i:03d} TEXT" for i in range(1, 16)),
+    ],
+}
+# indexes of the TPP database on the columns the queries filter on
+INDEXES = {
+    "RegistrationHistory": ["Patient_ID"],
+    "PatientAddress": ["Patient_ID"],
+    "SGSS_AllTests_Positive": ["Patient_ID"],
+    "CodedEvent": ["CTV3Code", "Patient_ID"],
+    "CodedEventRange": ["CodedEvent_ID"],
+    "CodedEvent_SNOMED": ["ConceptID", "Patient_ID"],
+    "MedicationIssue": ["MultilexDrug_ID", "Patient_ID"],
+    "APCS_ARCHIVED": ["Patient_ID"],
+    "Vaccination": ["Patient_ID"],
+    "ONS_Deaths": ["Patient_ID"],
+}
+
+
+###############################################################################
+# Translation of the T-SQL of cohortextractor to SQLite
+###############################################################################
+TEMP_TABLE = re.compile(r"#(\w+)")
+SELECT_INTO = re.compile(r"^(\s*(?:--[^\n]*\n\s*)*)SELECT\b(.*?)\bINTO\s+(\w+)\s+FROM\b", re.DOTALL | re.IGNORECASE)
+CREATE_TEMP = re.compile(r"^(\s*(?:--[^\n]*\n\s*)*)CREATE TABLE\b", re.IGNORECASE)
+CREATE_INDEX = re.compile(r"CREATE\s+(?:CLUSTERED\s+|NONCLUSTERED\s+)?INDEX\s+(\w+)\s+ON\s+(\w+)", re.IGNORECASE)
+SELECT_TOP = re.compile(r"^\s*SELECT\s+TOP\s+(\d+)\b(.*)$", re.DOTALL | re.IGNORECASE)
+COLLATIONS = {"Latin1_General_BIN": "BINARY", "Latin1_General_CI_AS": "NOCASE"}
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+
+def quoted_spans(sql):
+    return [match.span() for match in STRING_LITERAL.finditer(sql)]
+
+
+# Split the arguments of a function call at the commas outside parentheses
+# and string literals
+def split_arguments(text, separator=","):
+    arguments, depth, start, i = [], 0, 0, 0
+    while i < len(text):
+        char = text[i]
+        if char == "'":
+            i = text.index("'", i + 1)
+            while text[i + 1 : i + 2] == "'":
+                i = text.index("'", i + 2)
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif depth == 0 and text.startswith(separator, i):
+            arguments.append(text[start:i].strip())
+            start = i + len(separator)
+        i += 1
+    arguments.append(text[start:].strip())
+    return arguments
+
+
+# Rewrite the calls of a T-SQL function (innermost first)
+# Input:
+# - sql: sql string
+# - name: name of the function (case insensitive)
+# - rewrite: function of the list of (rewritten) arguments -> sql
+def rewrite_calls(sql, name, rewrite, separator=","):
+    pattern = re.compile(rf"\b{name}\s*\(", re.IGNORECASE)
+    position = 0
+    while True:
+        match = pattern.search(sql, position)
+        if match is None:
+            return sql
+        if any(start <= match.start() < end for start, end in quoted_spans(sql)):
+            position = match.end()
+            continue
+        depth, i = 1, match.end()
+        while depth:
+            if sql[i] == "'":
+                i = sql.index("'", i + 1)
+            elif sql[i] == "(":
+                depth += 1
+            elif sql[i] == ")":
+                depth -= 1
+            i += 1
+        inner = rewrite_calls(sql[match.end() : i - 1], name, rewrite, separator)
+        replacement = rewrite(split_arguments(inner, separator))
+        sql = sql[: match.start()] + replacement + sql[i:]
+        position = match.start() + len(replacement)
+
+
+def date_literal(text):
+    value = text.strip("'")
+    if re.fullmatch(r"\d{8}", value):
+        value = f"{value[:4]}-{value[4:6]}-{value[6:]}"
+    return f"'{value[:10]}'"
+
+
+def cast(arguments):
+    expression, type_name = split_arguments(arguments[0], " AS ") if len(arguments) == 1 else arguments
+    if type_name.lower() == "date":
+        if STRING_LITERAL.fullmatch(expression):
+            return date_literal(expression)
+        # dates are stored as 'YYYY-MM-DD' (and maybe a time)
+        return f"substr({expression}, 1, 10)"
+    return f"CAST({expression} AS {type_name})"
+
+
+def convert(arguments):
+    type_name, expression = arguments[0], arguments[1]
+    length = re.fullmatch(r"VARCHAR\((\d+)\)", type_name, re.IGNORECASE)
+    if length:
+        # style 23: yyyy-mm-dd
+        return f"substr({expression}, 1, {length.group(1)})"
+    return f"CAST({expression} AS {type_name})"
+
+
+def dateadd(arguments):
+    unit, number, date = arguments
+    if unit.upper() == "DAY":
+        return f"date({date}, ({number}) || ' days')"
+    return f"TSQL_DATEADD('{unit.upper()}', {number}, {date})"
+
+
+def datediff(arguments):
+    unit, start, end = arguments
+    if unit.upper() == "YEAR":
+        # the number of year boundaries crossed
+        return f"(CAST(substr({end}, 1, 4) AS INTEGER) - CAST(substr({start}, 1, 4) AS INTEGER))"
+    return f"TSQL_DATEDIFF('{unit.upper()}', {start}, {end})"
+
+
+def temp_table(name):
+    return f"temp_{name}"
+
+
+# Translate a query of the TPP backend to SQLite
+def translate(sql):
+    sql = TEMP_TABLE.sub(lambda match: temp_table(match.group(1)), sql)
+    for collation, sqlite_collation in COLLATIONS.items():
+        sql = sql.replace(f"COLLATE {collation}", f"COLLATE {sqlite_collation}")
+    sql = sql.replace("VARCHAR(MAX)", "TEXT")
+    # string concatenation (in the therapeutics query)
+    sql = re.sub(r"'\s*\+\s*(?=NULLIF\()", "' || ", sql)
+    sql = re.sub(r"\)\s*\+\s*(?=coalesce\()", ") || ", sql)
+    sql = rewrite_calls(sql, "CAST", cast)
+    sql = rewrite_calls(sql, "CONVERT", convert)
+    sql = rewrite_calls(sql, "DATEADD", dateadd)
+    sql = rewrite_calls(sql, "DATEDIFF", datediff)
+    sql = rewrite_calls(sql, "ISNULL", lambda arguments: f"IFNULL({', '.join(arguments)})")
+    sql = SELECT_INTO.sub(r"\1CREATE TEMP TABLE \3 AS SELECT\2 FROM", sql, count=1)
+    sql = CREATE_TEMP.sub(r"\1CREATE TEMP TABLE", sql, count=1)
+    sql = CREATE_INDEX.sub(r"CREATE INDEX \2_\1 ON \2", sql)
+    top = SELECT_TOP.match(sql)
+    if top:
+        sql = f"SELECT {top.group(2)} LIMIT {top.group(1)}"
+    return sql
+
+
+# T-SQL functions without an SQLite equivalent
+def tsql_dateadd(unit, number, date):
+    if date is None or number is None:
+        return None
+    date = datetime.date.fromisoformat(date[:10])
+    months = number * 12 if unit == "YEAR" else number
+    month = date.month - 1 + months
+    year, month = date.year + month // 12, month % 12 + 1
+    # the last day of the month if the day is not in the month
+    day = min(date.day, calendar.monthrange(year, month)[1])
+    return datetime.date(year, month, day).isoformat()
+
+
+def tsql_datediff(unit, start, end):
+    if start is None or end is None:
+        return None
+    start, end = datetime.date.fromisoformat(start[:10]), datetime.date.fromisoformat(end[:10])
+    if unit == "MONTH":
+        return (end.year - start.year) * 12 + end.month - start.month
+    return (end - start).days
+
+
+def tsql_stuff(string, start, length, replacement):
+    if string is None or start < 1 or start > len(string):
+        return None
+    return string[: start - 1] + replacement + string[start - 1 + length :]
+
+
+def tsql_charindex(substring, string):
+    if substring is None or string is None:
+        return None
+    return string.find(substring) + 1
+
+
+# LIKE with the character classes of T-SQL ('%[^A-Za-z0-9]U071%')
+@lru_cache(maxsize=None)
+def like_pattern(pattern, escape):
+    regex, i = "", 0
+    while i < len(pattern):
+        char = pattern[i]
+        if escape and char == escape and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 1
+        elif char == "%":
+            regex += ".*"
+        elif char == "_":
+            regex += "."
+        elif char == "[":
+            end = pattern.index("]", i + 1)
+            regex += "[" + pattern[i + 1 : end].replace("\\", "\\\\") + "]"
+            i = end
+        else:
+            regex += re.escape(char)
+        i += 1
+    return re.compile(regex, re.DOTALL | re.IGNORECASE)
+
+
+def tsql_like(pattern, string, escape=None):
+    if pattern is None or string is None:
+        return None
+    return like_pattern(pattern, escape).fullmatch(string) is not None
+
+
+# SQLite joins at most 64 tables in a query (the final join of
+# study_definition has more): the tables of the variables are merged into
+# tables of JOINS_PER_TABLE variables each, and the final join joins these
+LEFT_JOIN = re.compile(r"LEFT JOIN (temp_\w+) ON \1\.patient_id = ([\w.]+)\s*")
+MAX_JOINS = 60
+JOINS_PER_TABLE = 60
+
+
+def merge_joins(cursor, sql):
+    joins = LEFT_JOIN.findall(sql)
+    if len(joins) <= MAX_JOINS:
+        return sql
+    # the merged tables are joined where the first join was
+    first = LEFT_JOIN.search(sql).start()
+    sql = sql[:first] + "{merged_joins}" + LEFT_JOIN.sub("", sql[first:])
+    merged_joins = []
+    for k, start in enumerate(range(0, len(joins), JOINS_PER_TABLE)):
+        batch = joins[start : start + JOINS_PER_TABLE]
+        patient_id = batch[0][1]
+        primary_table = patient_id.split(".")[0]
+        merged = temp_table(f"joined_{k}")
+        columns = [f"{patient_id} AS patient_id"]
+        for table, _ in batch:
+            for _, column, *_ in cursor.execute(f"PRAGMA table_info({table})").fetchall():
+                if column != "patient_id":
+                    columns.append(f"{table}.[{column}] AS [{table}__{column}]")
+            sql = re.sub(rf"\b{table}\.\[?(\w+)\]?", rf"{merged}.[{table}__\1]", sql)
+        cursor.execute(f"DROP TABLE IF EXISTS {merged}")
+        cursor.execute(
+            f"CREATE TEMP TABLE {merged} AS SELECT {', '.join(columns)} FROM {primary_table} "
+            + " ".join(f"LEFT JOIN {table} ON {table}.patient_id = {patient_id}" for table, patient_id in batch)
+        )
+        cursor.execute(f"CREATE INDEX {merged}_ix ON {merged} (patient_id)")
+        merged_joins.append(f"LEFT JOIN {merged} ON {merged}.patient_id = {patient_id} ")
+    return sql.replace("{merged_joins}", "".join(merged_joins))
+
+
+class Cursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, log_desc=None):
+        self.cursor.execute(merge_joins(self.cursor, translate(query)))
+        return self
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+class Connection:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.create_function("TSQL_DATEADD", 3, tsql_dateadd, deterministic=True)
+        self.connection.create_function("TSQL_DATEDIFF", 3, tsql_datediff, deterministic=True)
+        self.connection.create_function("STUFF", 4, tsql_stuff, deterministic=True)
+        self.connection.create_function("CHARINDEX", 2, tsql_charindex, deterministic=True)
+        self.connection.create_function("SQUARE", 1, lambda x: None if x is None else x * x, deterministic=True)
+        self.connection.create_function("like", 2, tsql_like, deterministic=True)
+        self.connection.create_function("like", 3, tsql_like, deterministic=True)
+
+    def cursor(self):
+        return Cursor(self.connection.cursor())
+
+    def close(self):
+        self.connection.close()
+
+
+# TPPBackend on a local SQLite database
+# Input:
+# - database_url: 'sqlite:///<path>'
+# - covariate_definitions: as in study.covariate_definitions
+class LocalBackend(TPPBackend):
+    def modify_dsn(self, dsn):
+        return dsn
+
+    def get_db_connection(self, force_reconnect=False):
+        if self._db_connection is None:
+            self._db_connection = Connection(self.database_url[len(SQLITE_URL) :])
+        return self._db_connection
+
+
+class BatchedLocalBackend(BatchedQueries, LocalBackend):
+    pass
+
+
+# Backend of a database url: LocalBackend for 'sqlite:///<path>', otherwise
+# TPPBackend
+# Input:
+# - batched: compute the variables on the same events table in batches (see
+#   batched.py)
+def backend_for_url(database_url, covariate_definitions=None, dummy_data=False, batched=False):
+    if database_url and database_url.startswith(SQLITE_URL):
+        backend_class = BatchedLocalBackend if batched else LocalBackend
+        return backend_class(database_url, covariate_definitions)
+    backend_class = BatchedTPPBackend if batched else TPPBackend
+    return backend_class(database_url, covariate_definitions, dummy_data=dummy_data)
+
+
+###############################################################################
+# Synthetic patients
+###############################################################################
+INTERVENTIONS = ["Paxlovid", "Sotrovimab", "Molnupiravir", "Remdesivir", "Casirivimab and imdevimab"]
+RISK_COHORTS = [
+    "Patients with a solid organ transplant", "Patients with a haematological diseases",
+    "Patients with renal disease", "Patients with liver disease", "immune-mediated inflammatory disorders (IMID)",
+    "Patients with Down's syndrome", "",
+]
+VACCINES = [
+    "COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)",
+    "COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)",
+    "COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)",
+]
+REGIONS = ["East", "East Midlands", "London", "North East", "North West", "South East", "South West", "West Midlands", "Yorkshire and The Humber"]
+ADMISSION_METHODS = ["11", "12", "13", "21", "22", "23", "24", "25", "2A", "2B", "2C", "2D", "28", "31", "32"]
+EMERGENCY_ADMISSION_METHODS = ["21", "22", "23", "24", "25", "2A", "2B", "2C", "2D", "28"]
+COVID_DIAGNOSES = ["U071", "U072"]
+MABS_PROCEDURES = ["X891", "X892"]
+# fraction of the patients with an event of a codelist (clinical events) and
+# with prescriptions of a codelist (medications)
+EVENTS_INCIDENCE = 0.02
+PRESCRIPTIONS_INCIDENCE = 0.05
+
+
+# Codes of the codelists of a study definition, by coding system
+# Output:
+# - dict of system (e.g. 'snomed', 'ctv3', 'dmd', 'icd10', 'opcs4') -> sorted
+#   list of codes
+def study_codes(covariate_definitions):
+    codes = {}
+    for query_type, query_args in covariate_definitions.values():
+        for argument, value in query_args.items():
+            if isinstance(value, list) and hasattr(value, "system"):
+                system = value.system
+                # dm+d codelists have the system snomed
+                if query_type == "with_these_medications":
+                    system = "dmd"
+                items = [item[0] if isinstance(item, tuple) else item for item in value]
+                codes.setdefault(system, set()).update(items)
+    return {system: sorted(items) for system, items in codes.items()}
+
+
+# Codelists of a study definition, by coding system (as study_codes())
+# Output:
+# - dict of system -> list of sorted lists of codes (one per codelist)
+def study_codelists(covariate_definitions):
+    codelists = {}
+    for query_type, query_args in covariate_definitions.values():
+        for value in query_args.values():
+            if isinstance(value, list) and hasattr(value, "system"):
+                system = "dmd" if query_type == "with_these_medications" else value.system
+                items = tuple(sorted({item[0] if isinstance(item, tuple) else item for item in value}))
+                codelists.setdefault(system, set()).add(items)
+    return {system: [list(items) for items in sorted(lists)] for system, lists in codelists.items()}
+
+
+def days_after(rng, dates, low, high):
+    days = rng.integers(low, high + 1, len(dates))
+    return (np.array(dates, dtype="datetime64[D]") + days).astype(str)
+
+
+def random_dates(rng, n, earliest, latest):
+    earliest, latest = np.datetime64(earliest, "D"), np.datetime64(latest, "D")
+    days = rng.integers(0, (latest - earliest).astype(int) + 1, n)
+    return (earliest + days).astype(str)
+
+
+# Create the tables and populate them with synthetic patients
+# Input:
+# - path: path of the SQLite database (replaced)
+# - covariate_definitions: the codes of their codelists are recorded
+# - n_patients: number of patients
+# - study_dates: dict with start_date and end_date of the study period
+def populate(path, covariate_definitions, n_patients, study_dates, seed=0):
+    rng = np.random.default_rng(seed)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.unlink(missing_ok=True)
+    connection = sqlite3.connect(path)
+    for table, columns in SCHEMA.items():
+        connection.execute(f"CREATE TABLE {table} ({', '.join(columns)})")
+    codes = study_codes(covariate_definitions)
+    codelists = study_codelists(covariate_definitions)
+    start, end = study_dates["start_date"], study_dates["end_date"]
+    patient_ids = np.arange(1, n_patients + 1)
+
+    def insert(table, columns, rows):
+        placeholders = ", ".join("?" for _ in columns)
+        connection.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+            (tuple(value.item() if isinstance(value, np.generic) else value for value in row) for row in rows),
+        )
+
+    def some_patients(fraction):
+        return rng.choice(patient_ids, rng.binomial(n_patients, fraction), replace=False)
+
+    dates_of_birth = random_dates(rng, n_patients, "1925-01-01", "2004-12-31")
+    insert("Patient", ["Patient_ID", "DateOfBirth", "Sex"],
+           zip(patient_ids, dates_of_birth, rng.choice(["F", "M"], n_patients)))
+    insert("AllowedPatientsWithTypeOneDissent", ["Patient_ID"], ((patient_id,) for patient_id in patient_ids))
+    n_practices = 50
+    insert("Organisation", ["Organisation_ID", "STPCode", "Region", "MSOACode"],
+           ((i, f"E540000{i % 42:02d}", REGIONS[i % len(REGIONS)], f"E0200{i:04d}") for i in range(1, n_practices + 1)))
+    insert("RegistrationHistory", ["Patient_ID", "Organisation_ID", "StartDate", "EndDate"],
+           zip(patient_ids, rng.integers(1, n_practices + 1, n_patients),
+               random_dates(rng, n_patients, "1990-01-01", "2021-06-30"),
+               np.where(rng.random(n_patients) < 0.02, random_dates(rng, n_patients, start, end), "9999-12-31")))
+    insert("PatientAddress",
+           ["Patient_ID", "StartDate", "EndDate", "ImdRankRounded", "RuralUrbanClassificationCode", "MSOACode"],
+           zip(patient_ids, random_dates(rng, n_patients, "1990-01-01", "2021-06-30"), ["9999-12-31"] * n_patients,
+               rng.integers(0, 329, n_patients) * 100, rng.integers(1, 9, n_patients),
+               [f"E0200{i % 9000:04d}" for i in patient_ids]))
+
+    # positive tests: most patients in the study period, some before
+    tested = some_patients(0.8)
+    test_dates = random_dates(rng, len(tested), start, end)
+    earlier = some_patients(0.1)
+    insert("SGSS_AllTests_Positive", ["Patient_ID", "Specimen_Date", "Symptomatic"],
+           [*zip(tested, test_dates, ["Y"] * len(tested)),
+            *zip(earlier, random_dates(rng, len(earlier), "2020-03-01", start), ["N"] * len(earlier))])
+    # treatment within 5 days of the test, and some treated in the 90 days
+    # before (prev_treated)
+    treated = rng.random(len(tested)) < 0.15
+    treatment_dates = days_after(rng, test_dates[treated], 0, 5)
+    treated_before = rng.random(len(tested)) < 0.02
+    treated = np.concatenate([np.flatnonzero(treated), np.flatnonzero(treated_before)])
+    treatment_dates = np.concatenate([treatment_dates, days_after(rng, test_dates[treated_before], -90, -1)])
+    insert("Therapeutics",
+           ["Patient_ID", "TreatmentStartDate", "Received", "Intervention", "CurrentStatus", "COVID_Indication",
+            "Region", "MOL1_high_risk_cohort", "SOT02_risk_cohorts", "CASIM05_risk_cohort", "Count"],
+           zip(tested[treated], treatment_dates, treatment_dates, rng.choice(INTERVENTIONS, len(treated)),
+               ["Approved"] * len(treated), ["non_hospitalised"] * len(treated),
+               rng.choice(REGIONS, len(treated)), rng.choice(RISK_COHORTS, len(treated)),
+               rng.choice(RISK_COHORTS, len(treated)), rng.choice(RISK_COHORTS, len(treated)),
+               [1] * len(treated)))
+
+    # clinical events and medications: for each codelist, events of random
+    # codes of the codelist for a fraction of the patients (so a codelist of
+    # many codes, e.g. the ~2400 drugs_consider_risk, is not matched by every
+    # patient), 'repeats' events per patient
+    def events(system, incidence, earliest="2000-01-01", repeats=1):
+        rows = []
+        for codelist in codelists.get(system, []):
+            patients = np.repeat(rng.choice(patient_ids, max(1, rng.binomial(n_patients, incidence))), repeats)
+            rows += zip(patients, rng.choice(codelist, len(patients)), rng.normal(80, 30, len(patients)).round(1),
+                        random_dates(rng, len(patients), earliest, end))
+        return rows
+
+    insert("CodedEvent_SNOMED", ["Patient_ID", "ConceptID", "NumericValue", "ConsultationDate"],
+           events("snomed", EVENTS_INCIDENCE))
+    ctv3_events = events("ctv3", EVENTS_INCIDENCE)
+    # weight, height and BMI (most_recent_bmi)
+    measured = some_patients(0.5)
+    for code, mean, sd in [("X76C7", 80, 15), ("XM01E", 1.7, 0.1), ("22K..", 27, 5)]:
+        ctv3_events += zip(measured, [code] * len(measured), rng.normal(mean, sd, len(measured)).round(2),
+                           random_dates(rng, len(measured), "2018-01-01", end))
+    insert("CodedEvent", ["Patient_ID", "CTV3Code", "NumericValue", "ConsultationDate"], ctv3_events)
+    connection.execute(
+        "INSERT INTO CodedEventRange (CodedEvent_ID, LowerBound, UpperBound, Comparator) "
+        "SELECT CodedEvent_ID, 0, 1000, 4 FROM CodedEvent"
+    )
+    multilex_ids = {code: f"{i};0;0" for i, code in enumerate(codes.get("dmd", []))}
+    insert("MedicationDictionary", ["MultilexDrug_ID", "DMD_ID", "FullName"],
+           ((multilex_id, code, code) for code, multilex_id in multilex_ids.items()))
+    # repeat prescriptions of the last months
+    insert("MedicationIssue", ["Patient_ID", "MultilexDrug_ID", "ConsultationDate"],
+           ((patient, multilex_ids[code], date)
+            for patient, code, _, date in events("dmd", PRESCRIPTIONS_INCIDENCE, "2021-06-01", repeats=3)))
+
+    # admissions: a diagnosis or procedure of the codelists, COVID admissions
+    # in the 90 days before the positive test (some of the patients still in
+    # hospital when tested) and admissions within 28 days of the test; a third
+    # of the patients admitted after the test are admitted again on other days
+    # (up to 9 admissions, most in the first week) and some twice on a day,
+    # with COVID as the primary diagnosis, as another diagnosis or not at all
+    diagnoses = codes.get("icd10", []) or ["J189"]
+    procedures = codes.get("opcs4", []) or ["X999"]
+    other = some_patients(0.1)
+    admitted_before = np.flatnonzero(rng.random(len(tested)) < 0.03)
+    admitted_after = np.flatnonzero(rng.random(len(tested)) < 0.08)
+    n_after = np.where(rng.random(len(admitted_after)) < 1 / 3, rng.integers(2, 10, len(admitted_after)), 1)
+    days = np.concatenate([
+        # distinct days, 0-6 more likely than 7-28
+        rng.choice(29, n, replace=False, p=np.r_[np.full(7, 3.0), np.ones(22)] / 43) for n in n_after
+    ])
+    after = np.repeat(admitted_after, n_after)
+    twice = rng.random(len(after)) < 0.05
+    after, days = np.concatenate([after, after[twice]]), np.concatenate([days, days[twice]])
+    admitted = np.concatenate([other, tested[admitted_before], tested[after]])
+    n_admissions = len(admitted)
+    admission_dates = np.concatenate([
+        random_dates(rng, len(other), "2015-01-01", end),
+        days_after(rng, test_dates[admitted_before], -91, -1),
+        (np.array(test_dates[after], dtype="datetime64[D]") + days).astype(str),
+    ])
+    discharge_dates = days_after(rng, admission_dates, 0, 14)
+    # a third of the patients admitted before the test are discharged after it
+    in_hospital = rng.random(len(admitted_before)) < 1 / 3
+    discharge_dates[len(other) + np.flatnonzero(in_hospital)] = days_after(
+        rng, test_dates[admitted_before[in_hospital]], 1, 10
+    )
+    covid_admission = np.arange(n_admissions) >= len(other)
+    covid_primary = covid_admission & (rng.random(n_admissions) < 0.6)
+    primary = np.where(covid_primary, rng.choice(COVID_DIAGNOSES, n_admissions), rng.choice(diagnoses, n_admissions))
+    secondary = np.where(
+        covid_admission & ~covid_primary & (rng.random(n_admissions) < 0.5),
+        rng.choice(COVID_DIAGNOSES, n_admissions),
+        rng.choice(diagnoses, n_admissions),
+    )
+    procedure = np.where(
+        covid_admission & (rng.random(n_admissions) < 0.2),
+        rng.choice(MABS_PROCEDURES, n_admissions),
+        rng.choice(procedures, n_admissions),
+    )
+    admission_method = np.where(
+        covid_admission & (rng.random(n_admissions) < 0.8),
+        rng.choice(EMERGENCY_ADMISSION_METHODS, n_admissions),
+        rng.choice(ADMISSION_METHODS, n_admissions),
+    )
+    insert("APCS_ARCHIVED",
+           ["APCS_Ident", "Patient_ID", "Admission_Date", "Discharge_Date", "Admission_Method",
+            "Patient_Classification", "Der_Diagnosis_All", "Der_Procedure_All", "Ethnic_group"],
+           zip(range(1, n_admissions + 1), admitted, admission_dates, discharge_dates,
+               admission_method, rng.choice(["1", "1", "1", "1", "1", "2"], n_admissions),
+               [f"||{a} ,{b}" for a, b in zip(primary, secondary)],
+               [f"||{code}" for code in procedure],
+               rng.choice(["A", "B", "C", "D", "H", "J", "M", "R", "S", "99", "Z"], n_admissions)))
+    insert("APCS_Der_ARCHIVED", ["APCS_Ident", "Spell_Primary_Diagnosis"],
+           zip(range(1, n_admissions + 1), primary))
+
+    insert("VaccinationReference", ["VaccinationName_ID", "VaccinationName", "VaccinationContent"],
+           ((i, name, "SARS-2 CORONAVIRUS") for i, name in enumerate(VACCINES, 1)))
+    vaccination_rows = []
+    doses = rng.integers(0, 5, n_patients)
+    for dose in range(1, 5):
+        patients = patient_ids[doses >= dose]
+        vaccination_rows += zip(patients, rng.integers(1, len(VACCINES) + 1, len(patients)),
+                                random_dates(rng, len(patients), f"{2020 + (dose + 1) // 2}-0{dose * 2}-01",
+                                             f"{2020 + (dose + 1) // 2}-0{dose * 2 + 1}-28"))
+    insert("Vaccination", ["Patient_ID", "VaccinationName_ID", "VaccinationDate"], vaccination_rows)
+
+    # deaths, some within 28 days of the positive test
+    died = some_patients(0.01)
+    died_after_test = rng.random(len(tested)) < 0.01
+    death_dates = np.concatenate(
+        [random_dates(rng, len(died), "2021-01-01", end), days_after(rng, test_dates[died_after_test], 0, 40)]
+    )
+    died = np.concatenate([died, tested[died_after_test]])
+    insert("ONS_Deaths", ["Patient_ID", "dod", "icd10u", "ICD10001"],
+           zip(died, death_dates, rng.choice(["U071", "I219", "J189", "C349"], len(died)),
+               rng.choice(["U071", "U072", "I10X"], len(died))))
+
+    for table, columns in INDEXES.items():
+        for column in columns:
+            connection.execute(f"CREATE INDEX ix_{table}_{column} ON {table} ({column})")
+    connection.commit()
+    connection.close()
+
+
+# Query plans of the queries of every variable
+# Output:
+# - text with the plan of each query (EXPLAIN QUERY PLAN)
+def query_plans(backend, covariate_definitions):
+    from .profiler import variable_queries
+
+    queries, final_join = variable_queries(backend, covariate_definitions)
+    cursor = backend.get_db_connection().cursor()
+    lines = []
+    for name, sql_list in [*queries.items(), ("(final join)", [final_join])]:
+        lines.append(f"== {name}")
+        for query in sql_list:
+            translated = merge_joins(cursor.cursor, translate(query))
+            # the plan of the select (of 'CREATE TEMP TABLE ... AS SELECT')
+            select = re.sub(r"^(?:\s*--[^\n]*\n)*\s*(?:CREATE TEMP TABLE \w+ AS\s+)?", "", translated)
+            if select.upper().startswith(("SELECT", "WITH")):
+                cursor.cursor.execute(f"EXPLAIN QUERY PLAN {select}")
+                lines += [f"  {row[3]}" for row in cursor.cursor.fetchall()]
+            # run it, the next queries use its tables
+            cursor.cursor.execute(translated)
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    import json
+
+    from .study import REPO_DIR
+
+    parser = argparse.ArgumentParser(
+        description="Extract a study definition on a local SQLite stand-in of the TPP database"
+    )
+    parser.add_argument("--study-definition", default="study_definition", choices=study_definition_names())
+    parser.add_argument("--patients", type=int, default=10000)
+    parser.add_argument("--database", default=str(DEFAULT_DATABASE))
+    parser.add_argument("--reuse", action="store_true", help="use the existing database")
+    parser.add_argument("--output", help="cohort file (default output/local/input<...>.feather)")
+    parser.add_argument("--plans", help="write the query plans to this file")
+    parser.add_argument("--batched", action="store_true", help="batch the queries on the same events table")
+    args = parser.parse_args()
+
+    study = load_study(args.study_definition)
+    if not (args.reuse and Path(args.database).exists()):
+        with open(REPO_DIR / "lib" / "design" / "study-dates.json") as f:
+            study_dates = json.load(f)
+        start = time.perf_counter()
+        populate(args.database, study.covariate_definitions, args.patients, study_dates)
+        print(f"{args.database}: {args.patients} patients ({time.perf_counter() - start:.1f}s)")
+    database_url = f"{SQLITE_URL}{args.database}"
+    if args.plans:
+        backend = backend_for_url(database_url, batched=args.batched)
+        Path(args.plans).write_text(query_plans(backend, study.covariate_definitions))
+        backend.close()
+        print(f"query plans written to {args.plans}")
+    output = args.output or str(
+        Path(args.database).parent / f"input{args.study_definition[len('study_definition'):]}.feather"
+    )
+    start = time.perf_counter()
+    backend = backend_for_url(database_url, study.covariate_definitions, batched=args.batched)
+    backend.to_file(output)
+    backend.close()
+    print(f"{output} extracted ({time.perf_counter() - start:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# Extraction of study_definition in partitions of patients
+#
+# The patients of the population (the output of step 1 of population-first
+# extraction, output/input_population.csv.gz, see population_first.py) are
+# split into n partitions by a hash of their patient_id. Each partition is
+# extracted by a cohortextractor process of its own with the params of
+# generate_study_population in project.yaml (e.g. the batched queries) and
+# --param population=<the patients of the partition>, so the processes run
+# independently (on as many cores as there are workers) and each only holds
+# the patients of its partition. The partitions are written to
+# output/partitions/part_<k>/input.feather and listed in a manifest,
+# output/input_parts.json; read_cohort() (analysis/data_import/functions/
+# read_cohort.R) reads the parts of the manifest as one cohort (and stops if
+# output/input.feather exists too).
+#
+# A partition can be re-extracted on its own with --parts; the manifest is
+# rewritten after every run. Each part records the number of partitions it
+# was extracted with (part_<k>/partition.json), so parts left over from a run
+# with another --partitions are not listed in the manifest.
+#
+# Usage (from the root of the repository, after the action generate_population):
+# python -m analysis.extraction.partitions --partitions 8 --workers 4
+#   [--parts 3 5] [--expectations-population 5000]
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .study import REPO_DIR, generate_cohort, project_action
+
+POPULATION_FILE = Path("output") / "input_population.csv.gz"
+PARTITIONS_DIR = Path("output") / "partitions"
+MANIFEST_FILE = Path("output") / "input_parts.json"
+# Fibonacci hashing, consecutive patient ids are spread over the partitions
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+# Partition of each patient
+# Input:
+# - patient_ids: integer array
+# - n_partitions: number of partitions
+# Output:
+# - integer array with values 0, ..., n_partitions - 1
+def patient_partition(patient_ids, n_partitions):
+    hashed = np.asarray(patient_ids).astype(np.uint64) * HASH_MULTIPLIER
+    return ((hashed >> np.uint64(32)) % np.uint64(n_partitions)).astype(np.int64)
+
+
+def partition_dir(part):
+    return PARTITIONS_DIR / f"part_{part}"
+
+
+def partition_file(part):
+    return REPO_DIR / partition_dir(part) / "partition.json"
+
+
+# Split the population file into one file per partition
+# Output:
+# - list of paths of the population files of the partitions
+def split_population(population_file, n_partitions):
+    population = pd.read_csv(REPO_DIR / population_file, dtype=str)
+    partition = patient_partition(population["patient_id"].astype(np.int64), n_partitions)
+    paths = []
+    for part in range(n_partitions):
+        path = partition_dir(part) / "input_population.csv.gz"
+        (REPO_DIR / path).parent.mkdir(parents=True, exist_ok=True)
+        population[partition == part].to_csv(REPO_DIR / path, index=False)
+        paths.append(path)
+    return paths
+
+
+# Extract partitions with cohortextractor (in parallel)
+# Output:
+# - dict of part -> (return code, seconds)
+def extract_partitions(parts, population_files, workers, expectations_population=None):
+    params = project_action("study_definition")["params"]
+
+    def extract(part):
+        partition_file(part).unlink(missing_ok=True)
+        returncode, seconds = generate_cohort(
+            "study_definition",
+            partition_dir(part),
+            {**params, "population": population_files[part]},
+            expectations_population=expectations_population,
+        )
+        if returncode == 0:
+            with open(partition_file(part), "w") as f:
+                json.dump({"part": part, "partitions": len(population_files)}, f)
+        return returncode, seconds
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(parts, executor.map(extract, parts)))
+
+
+# Manifest of the partitions of the cohort
+# Output:
+# - dict with the number of partitions, the hash of the patient ids and the
+#   parts (path relative to the manifest and number of patients)
+def write_manifest(n_partitions, manifest_file=MANIFEST_FILE):
+    import pyarrow.feather as feather
+
+    parts = []
+    for part in range(n_partitions):
+        path = REPO_DIR / partition_dir(part) / "input.feather"
+        if not path.exists() or not partition_file(part).exists():
+            raise FileNotFoundError(f"Partition {part} has not been extracted ({path})")
+        with open(partition_file(part)) as f:
+            extracted_with = json.load(f)["partitions"]
+        if extracted_with != n_partitions:
+            raise ValueError(
+                f"Partition {part} was extracted with {extracted_with} partitions, not {n_partitions}, "
+                f"extract it again with --parts {part}"
+            )
+        parts.append(
+            {
+                "path": str(path.relative_to((REPO_DIR / manifest_file).parent)),
+                "patients": feather.read_table(path, columns=["patient_id"]).num_rows,
+            }
+        )
+    manifest = {
+        "study_definition": "study_definition",
+        "partitions": n_partitions,
+        "hash": "fibonacci(patient_id) >> 32 mod partitions",
+        "patients": sum(part["patients"] for part in parts),
+        "parts": parts,
+    }
+    with open(REPO_DIR / manifest_file, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extraction of study_definition in partitions of patients")
+    parser.add_argument("--partitions", type=int, default=8)
+    parser.add_argument("--parts", type=int, nargs="+", help="partitions to extract (default all)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--population", default=str(POPULATION_FILE))
+    parser.add_argument("--expectations-population", type=int)
+    args = parser.parse_args()
+    parts = args.parts if args.parts is not None else list(range(args.partitions))
+    if not (REPO_DIR / args.population).exists():
+        sys.exit(f"{args.population} does not exist, run the action generate_population first")
+
+    start = time.perf_counter()
+    population_files = split_population(args.population, args.partitions)
+    results = extract_partitions(parts, population_files, args.workers, args.expectations_population)
+    for part, (returncode, seconds) in results.items():
+        status = "ok" if returncode == 0 else f"failed, see {partition_dir(part) / 'extract.log'}"
+        print(f"part {part}: {seconds:.1f}s {status}")
+    serial = sum(seconds for _, seconds in results.values())
+    print(f"wall time {time.perf_counter() - start:.1f}s, {serial:.1f}s one after another")
+    if any(returncode != 0 for returncode, _ in results.values()):
+        sys.exit(1)
+    manifest = write_manifest(args.partitions)
+    print(f"{manifest['patients']} patients in {manifest['partitions']} partitions, see {MANIFEST_FILE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# Population-first extraction
+#
+# The population of study_definition (patients.satisfying('NOT has_died AND
+# high_risk_group AND ...')) only depends on a fraction of the variables, but
+# the backend runs the query of every variable before the population is
+# applied in the final join. Queries with a date expression referring to
+# another variable (e.g. on_or_before='covid_test_positive_date') are joined to
+# the table of that variable, so they are only computed for the patients who
+# have that date: the 'anchor' of the query.
+#
+# Population-first extraction runs in two steps:
+# 1. population_study(): only the variables the population depends on, the
+#    output has the anchors of the patients in the population
+#    (study_definition_population.py, writing output/input_population.csv.gz)
+# 2. restrict_to_population(): the study definition with the population read
+#    from that file (patients.which_exist_in_file) and the anchors taken from
+#    it (patients.with_value_from_file), so all queries anchored on them are
+#    computed for the patients in the population only
+# (study_definition.py with --param population=output/input_population.csv.gz)
+#
+# Usage (from the root of the repository):
+# python -m analysis.extraction.population_first --study-definition study_definition
+import argparse
+
+from cohortextractor import patients
+from cohortextractor.process_covariate_definitions import process_covariate_definitions
+
+from .prune import used_variables
+from .schedule import query_dependencies, waves
+from .study import load_study, study_definition_names, with_definitions
+
+DEFAULT_ANCHORS = ["covid_test_positive_date"]
+
+
+# Study definition with only the variables the population depends on, the
+# variables other than the anchors are hidden
+# Input:
+# - study: StudyDefinition
+# - anchors: names of the variables in the output
+# Output:
+# - StudyDefinition
+def population_study(study, anchors=DEFAULT_ANCHORS):
+    keep = used_variables(study.covariate_definitions, anchors)
+    definitions = {}
+    for name, (query_type, query_args) in study._original_covariates.items():
+        if name in keep:
+            hidden = name not in anchors and name != "population"
+            definitions[name] = (query_type, {**query_args, "hidden": hidden})
+    return with_definitions(study, definitions)
+
+
+# Study definition with the population and the anchors read from the output of
+# population_study()
+# Input:
+# - study: StudyDefinition
+# - f_path: csv(.gz) file with columns patient_id and the anchors
+# - anchors: names of the variables to read from f_path
+# Output:
+# - StudyDefinition
+def restrict_to_population(study, f_path, anchors=DEFAULT_ANCHORS):
+    from_file = {"population": patients.which_exist_in_file(f_path)}
+    for anchor in anchors:
+        query_args = study.covariate_definitions[anchor][1]
+        from_file[anchor] = patients.with_value_from_file(
+            f_path,
+            returning=anchor,
+            returning_type=query_args["column_type"],
+            **({"date_format": query_args["date_format"]} if query_args.get("date_format") else {}),
+        )
+    from_file = process_covariate_definitions(from_file)
+    definitions = {}
+    for name, (query_type, query_args) in study._original_covariates.items():
+        if name in from_file:
+            query_type, file_args = from_file[name]
+            query_args = {**file_args, "hidden": query_args["hidden"]}
+        definitions[name] = (query_type, query_args)
+    return with_definitions(study, definitions)
+
+
+# Queries that depend (directly or not) on one of the anchors
+def anchored_queries(dependencies, anchors):
+    anchored = set()
+    for wave in waves(dependencies):
+        for name in wave:
+            if dependencies[name] & (anchored | set(anchors)):
+                anchored.add(name)
+    return anchored
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Queries run in each step of population-first extraction"
+    )
+    parser.add_argument("--study-definition", default="study_definition", choices=study_definition_names())
+    parser.add_argument("--anchor", action="append", dest="anchors")
+    args = parser.parse_args()
+    anchors = args.anchors or DEFAULT_ANCHORS
+
+    study = load_study(args.study_definition)
+    dependencies = query_dependencies(study.covariate_definitions)
+    population_queries = set(query_dependencies(population_study(study, anchors).covariate_definitions))
+    anchored = anchored_queries(dependencies, anchors)
+    rest = set(dependencies) - population_queries
+    print(f"{args.study_definition}: {len(dependencies)} queries, anchors: {', '.join(anchors)}")
+    print(f"  step 1 (population): {len(population_queries)} queries")
+    print(
+        f"  step 2: {len(dependencies)} queries, {len(anchored)} anchored (computed for "
+        f"the population only), {len(rest)} not needed for the population"
+    )
+    unanchored = sorted(set(dependencies) - anchored - set(anchors))
+    if unanchored:
+        print(f"  not anchored in step 2: {', '.join(unanchored)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# Per-variable profile of the extraction of a study definition
+#
+# The TPP backend runs the queries of each variable (uploading its codelists
+# and writing its temporary table #<name>) one after another, then the final
+# join. profile_variables() runs the same queries on a connection of the
+# backend and records for every variable:
+# - seconds: wall time of its queries
+# - rows_returned: rows in its temporary table (patients with a value)
+# - rows_scanned: rows in the tables its queries read (e.g. CodedEvent,
+#   APCS), an upper bound of the rows the database scans
+# - max_rss_growth_kb: growth of the peak resident memory of this process
+#   (the memory of the client, and of the database if it is embedded)
+# Variables that are an expression in the final join (patients.satisfying,
+# patients.categorised_as, ...) have no queries; their cost is part of the
+# final join, profiled as '(final join)'.
+#
+# The report (json and csv) is sorted by seconds and summarised per query
+# family (the patients.* function: admitted_to_hospital,
+# with_these_clinical_events, with_these_medications,
+# with_covid_therapeutics, ...). Without a database only the queries are
+# generated: the number of queries, the codes uploaded and the tables read.
+#
+# Usage (from the root of the repository):
+# DATABASE_URL=mssql://... python -m analysis.extraction.profiler
+#   --study-definition study_definition [--output output/profile]
+# or on the local stand-in of the backend (see local_backend.py):
+# python -m analysis.extraction.profiler --database-url sqlite:///output/local/tpp.sqlite
+import argparse
+import csv
+import json
+import os
+import re
+import resource
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from .local_backend import backend_for_url
+from .schedule import EXPRESSION_TYPES
+from .study import load_study, study_definition_names
+
+TABLE_REFERENCE = re.compile(r"\b(?:FROM|JOIN)\s+([A-Za-z_][\w.]*)", re.IGNORECASE)
+# string literals and comments
+LITERAL_OR_COMMENT = re.compile(r"'(?:[^']|'')*'|--[^\n]*")
+FIELDS = [
+    "name", "family", "queries", "codes", "tables", "seconds",
+    "rows_scanned", "rows_returned", "max_rss_growth_kb",
+]
+
+
+# Queries of each variable, as generated by the backend
+# Output:
+# - tuple (dict of name -> list of sql, for the variables with a temporary
+#   table, in the order they are run; final join)
+def variable_queries(backend, covariate_definitions):
+    queries = {}
+    get_queries_for_column = backend.get_queries_for_column
+
+    def recorded(name, *args):
+        # get_queries() adds the query writing #<name> to the same list
+        queries[name] = get_queries_for_column(name, *args)
+        return queries[name]
+
+    backend.get_queries_for_column = recorded
+    try:
+        final_join = backend.get_queries(covariate_definitions)[-1]
+    finally:
+        del backend.get_queries_for_column
+    return queries, final_join
+
+
+# Tables of the database read by queries (not temporary tables)
+def source_tables(queries):
+    return sorted(
+        {table for query in queries for table in TABLE_REFERENCE.findall(LITERAL_OR_COMMENT.sub("", query))}
+        - {"t", "VALUES"}
+    )
+
+
+def codes_uploaded(query_args):
+    return sum(len(value) for value in query_args.values() if isinstance(value, list) and hasattr(value, "system"))
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Profile of every variable
+# Input:
+# - backend: TPPBackend (or a subclass), with a connection if 'execute'
+# - covariate_definitions: dict of name -> (query_type, query_args), as in
+#   study.covariate_definitions
+# - execute: run the queries, otherwise only generate them
+# Output:
+# - list of dicts with the FIELDS
+def profile_variables(backend, covariate_definitions, execute=True):
+    queries, final_join = variable_queries(backend, covariate_definitions)
+    cursor = backend.get_db_connection().cursor() if execute else None
+    table_rows = {}
+
+    def count(table):
+        cursor.execute(f"SELECT COUNT(*) FROM {table}")
+        return list(cursor)[0][0]
+
+    def run(name, sql_list):
+        tables = source_tables(sql_list)
+        profile = {"name": name, "queries": len(sql_list), "tables": " ".join(tables)}
+        if execute:
+            # counted first, the cursor holds the result of the last query
+            for table in tables:
+                if table not in table_rows:
+                    table_rows[table] = count(table)
+            profile["rows_scanned"] = sum(table_rows[table] for table in tables)
+            rss = max_rss_kb()
+            start = time.perf_counter()
+            for query in sql_list:
+                cursor.execute(query)
+            profile["seconds"] = time.perf_counter() - start
+            profile["max_rss_growth_kb"] = max_rss_kb() - rss
+        return profile
+
+    profiles = []
+    for name, (query_type, query_args) in covariate_definitions.items():
+        if name in queries:
+            profile = run(name, queries[name])
+            if execute:
+                profile["rows_returned"] = count(f"#{name}")
+        else:
+            profile = {"name": name, "queries": 0}
+        family = "expression" if query_type in EXPRESSION_TYPES else query_type
+        profiles.append({**profile, "family": family, "codes": codes_uploaded(query_args)})
+    final = run("(final join)", [final_join])
+    if execute:
+        final["rows_returned"] = len(list(cursor))
+    profiles.append({**final, "family": "(final join)", "codes": 0})
+    return [{field: profile.get(field) for field in FIELDS} for profile in profiles]
+
+
+# Totals per query family
+def family_summary(profiles):
+    families = defaultdict(lambda: {"variables": 0, "queries": 0, "codes": 0, "seconds": None})
+    for profile in profiles:
+        family = families[profile["family"]]
+        family["variables"] += 1
+        family["queries"] += profile["queries"]
+        family["codes"] += profile["codes"]
+        if profile["seconds"] is not None:
+            family["seconds"] = (family["seconds"] or 0) + profile["seconds"]
+    return dict(
+        sorted(families.items(), key=lambda item: (-(item[1]["seconds"] or 0), -item[1]["queries"]))
+    )
+
+
+def write_report(profiles, output):
+    output = Path(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    profiles = sorted(profiles, key=lambda profile: (-(profile["seconds"] or 0), -profile["queries"]))
+    with open(f"{output}.json", "w") as f:
+        json.dump({"families": family_summary(profiles), "variables": profiles}, f, indent=2)
+    with open(f"{output}.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(profiles)
+    return profiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-variable profile of the extraction of a study definition")
+    parser.add_argument("--study-definition", default="study_definition", choices=study_definition_names())
+    parser.add_argument("--database-url", default=os.environ.get("DATABASE_URL"))
+    parser.add_argument("--output", default="output/profile", help="path of the report, without .json/.csv")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--batched", action="store_true", help="batch the queries on the same events table")
+    args = parser.parse_args()
+
+    study = load_study(args.study_definition)
+    execute = args.database_url is not None
+    # without a database the backend generates the queries as for dummy data
+    backend = backend_for_url(args.database_url, None, dummy_data=not execute, batched=args.batched)
+    profiles = write_report(profile_variables(backend, study.covariate_definitions, execute), args.output)
+    print(f"{args.study_definition}: report written to {args.output}.json and {args.output}.csv")
+    for family, summary in family_summary(profiles).items():
+        seconds = "" if summary["seconds"] is None else f", {summary['seconds']:.1f}s"
+        print(
+            f"  {family}: {summary['variables']} variables, {summary['queries']} queries, "
+            f"{summary['codes']} codes{seconds}"
+        )
+    if execute:
+        print("  slowest variables:")
+        for profile in profiles[: args.top]:
+            print(f"    {profile['name']} ({profile['family']}): {profile['seconds']:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# Elimination of variables that are not used downstream
+#
+# Every variable of a study definition is a query on the backend. A variable is
+# used if it is read by the R scripts processing the extracted cohort (the
+# columns in their readr column specifications, cols_only(...)), or if a used
+# variable depends on it: through its expression (patients.satisfying,
+# patients.categorised_as), its date expressions (e.g. between=
+# ['covid_test_positive_date', ...]), as the source of a date (returning the
+# date of a match) or as a column of an aggregate (patients.minimum_of, ...).
+# The population is always used. prune_unused_variables() returns the study
+# definition without the variables that are not used, so their queries are not
+# run; study_definition.py calls it with --param prune=1 only.
+# The columns read are found with regular expressions over the R source, so a
+# column read another way (e.g. through a helper or any_of()) is not seen and
+# would not be extracted: list the unused variables with the command below
+# before extracting with --param prune=1. Pruning fails if no R script reads
+# the cohort or no column of the study definition is found in them.
+#
+# The R scripts reading a cohort are the scripts in analysis/ referring to its
+# output file (e.g. 'input.feather' for study_definition) and the scripts they
+# source().
+#
+# Usage (from the root of the repository):
+# python -m analysis.extraction.prune --study-definition study_definition
+import argparse
+import re
+
+import sqlparse
+from sqlparse import tokens as ttypes
+
+from .date_expressions import referenced_variable
+from .study import ANALYSIS_DIR, REPO_DIR, load_study, project_action, study_definition_names, with_definitions
+
+COLUMN_SPEC = re.compile(r"\b(\w+)\s*=\s*col_\w+\(")
+SOURCE = re.compile(r"source\(\s*here(?:::here)?\(([^)]*)\)")
+DATE_ARGUMENTS = ("on_or_before", "on_or_after", "reference_date", "date")
+
+
+# Names of the variables referenced in an expression (e.g. 'NOT has_died AND
+# covid_test_positive'), as tokenised by cohortextractor
+def expression_names(expression):
+    tokens = sqlparse.parse(expression)[0].flatten()
+    return {token.value for token in tokens if token.ttype is ttypes.Name}
+
+
+# Variables each variable depends on
+# Input:
+# - covariate_definitions: dict of name -> (query_type, query_args) as in
+#   study.covariate_definitions
+# Output:
+# - dict of name -> set of names of variables
+def variable_dependencies(covariate_definitions):
+    dependencies = {}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        names = set()
+        for expression in query_args.get("category_definitions", {}).values():
+            if expression != "DEFAULT":
+                names |= expression_names(expression)
+        if query_args.get("source"):
+            names.add(query_args["source"])
+        names.update(query_args.get("column_names") or [])
+        expressions = list(query_args.get("between") or [])
+        expressions += [query_args.get(argument) for argument in DATE_ARGUMENTS]
+        for expression in expressions:
+            if isinstance(expression, str):
+                names.add(referenced_variable(expression))
+        names.discard(None)
+        dependencies[name] = names & set(covariate_definitions)
+    return dependencies
+
+
+# Name of the file a study definition is extracted to in project.yaml (with
+# the --output-format of its generate_cohort action)
+def cohort_filename(study_name):
+    extension = project_action(study_name)["output_format"]
+    return f"input{study_name[len('study_definition'):]}.{extension}"
+
+
+# R scripts sourced by an R script (recursively)
+def sourced_scripts(path, seen=None):
+    seen = set() if seen is None else seen
+    seen.add(path)
+    for match in SOURCE.finditer(path.read_text()):
+        parts = re.findall(r"\"([^\"]+)\"", match.group(1))
+        sourced = REPO_DIR.joinpath(*parts)
+        if sourced.exists() and sourced not in seen:
+            sourced_scripts(sourced, seen)
+    return seen
+
+
+# R scripts reading the cohort of a study definition
+def reader_scripts(study_name):
+    filename = cohort_filename(study_name)
+    scripts = set()
+    for path in sorted(ANALYSIS_DIR.rglob("*.R")):
+        if filename in path.read_text():
+            scripts |= sourced_scripts(path)
+    return sorted(scripts)
+
+
+# Columns read by R scripts (names in their column specifications)
+def read_columns(scripts):
+    columns = set()
+    for path in scripts:
+        columns.update(COLUMN_SPEC.findall(path.read_text()))
+    return columns
+
+
+# Variables needed to compute the columns read downstream
+# Input:
+# - covariate_definitions: dict of name -> (query_type, query_args)
+# - columns: names of variables of covariate_definitions, an unknown name
+#   (e.g. a column derived in R) is an error
+# Output:
+# - set of names of variables (the population and the variables in columns,
+#   with the variables they depend on)
+def used_variables(covariate_definitions, columns):
+    unknown = sorted(set(columns) - set(covariate_definitions))
+    if unknown:
+        raise ValueError(f"Not variables of the study definition: {', '.join(unknown)}")
+    dependencies = variable_dependencies(covariate_definitions)
+    used = set()
+    stack = ["population", *columns]
+    while stack:
+        name = stack.pop()
+        if name not in used:
+            used.add(name)
+            stack.extend(dependencies[name])
+    return used
+
+
+# Study definition without the variables that are not in 'keep'
+# The variables are removed from the original (unevaluated) definitions, so
+# the pruned study definition can be re-evaluated with another index date and
+# has a backend and dummy data of its own. The study definition before pruning
+# is kept as 'unpruned'.
+def prune_study(study, keep):
+    pruned = with_definitions(
+        study,
+        {
+            name: definition
+            for name, definition in study._original_covariates.items()
+            if name in keep
+        },
+    )
+    pruned.unpruned = study
+    return pruned
+
+
+# Remove the variables of a study definition that are not used downstream
+# Input:
+# - study: StudyDefinition
+# - name: name of the study definition, e.g. 'study_definition'
+# Output:
+# - pruned StudyDefinition
+def prune_unused_variables(study, name):
+    scripts = reader_scripts(name)
+    if not scripts:
+        raise ValueError(f"No R script in analysis/ reads {cohort_filename(name)}, {name} cannot be pruned")
+    columns = read_columns(scripts) & set(study.covariate_definitions)
+    if not columns:
+        raise ValueError(
+            f"No variable of {name} found in the column specifications of "
+            f"{', '.join(str(path.relative_to(REPO_DIR)) for path in scripts)}"
+        )
+    return prune_study(study, used_variables(study.covariate_definitions, columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="List the variables of study definitions that are not used downstream"
+    )
+    parser.add_argument(
+        "--study-definition", action="append", choices=study_definition_names()
+    )
+    args = parser.parse_args()
+
+    for name in args.study_definition or study_definition_names():
+        study = load_study(name)
+        study = getattr(study, "unpruned", study)
+        scripts = reader_scripts(name)
+        print(f"{name} ({cohort_filename(name)}): {len(study.covariate_definitions)} variables")
+        if not scripts:
+            print("  not read by any R script, not pruned")
+            continue
+        for path in scripts:
+            if read_columns([path]):
+                print(f"  read by {path.relative_to(REPO_DIR)}")
+        columns = read_columns(scripts)
+        keep = used_variables(study.covariate_definitions, columns & set(study.covariate_definitions))
+        hidden = {
+            variable
+            for variable, (_, query_args) in study.covariate_definitions.items()
+            if query_args.get("hidden")
+        }
+        unused = [variable for variable in study.covariate_definitions if variable not in keep]
+        print(
+            f"  {len(keep)} used ({len(keep & columns)} read, "
+            f"{len(keep - columns)} only as dependency), {len(unused)} unused:"
+        )
+        for variable in unused:
+            print(f"    {variable}{' (hidden)' if variable in hidden else ''}")
+        missing = sorted(columns - set(study.covariate_definitions) - {"patient_id"})
+        if missing:
+            print(f"  read but not extracted: {', '.join(missing)}")
+
+
+if __name__ == "__main__":
+    main()
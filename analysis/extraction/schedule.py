@@ -0,0 +1,145 @@
+# Dependency graph of the queries of a study definition
+#
+# On the backend each variable is one query writing a temporary table (e.g.
+# patients.with_these_clinical_events), or an expression over the tables of
+# other variables that is part of the final join and does not run a query of
+# its own (patients.satisfying, patients.categorised_as, the date of a match,
+# patients.minimum_of, ...). A query depends on the queries of the variables
+# in its date expressions (e.g. between=['covid_test_positive_date',
+# 'covid_test_positive_date + 28 days'] depends on the query of
+# covid_test_positive_date), through expressions if these refer to
+# expressions. Queries that do not depend on each other, such as the ~40
+# high risk group queries, are in the same wave.
+#
+# The queries are not run concurrently: the temporary tables they write
+# (#<name>) only exist in the session of the backend writing them, so the
+# backend runs them one after another on one connection. The waves and the
+# critical path (the longest chain of queries depending on each other, with
+# the seconds of each query from the report of profiler.py) show which
+# queries the others wait for, e.g. the queries of the population used by
+# population_first.py.
+#
+# Usage (from the root of the repository):
+# python -m analysis.extraction.schedule --study-definition study_definition
+#   [--profile output/profile.json]
+import argparse
+import json
+
+from .prune import variable_dependencies
+from .study import load_study, study_definition_names
+
+# variables that are an expression in the final join instead of a query
+EXPRESSION_TYPES = ["categorised_as", "value_from", "aggregate_of", "fixed_value"]
+
+
+# Queries each query depends on
+# Input:
+# - covariate_definitions: dict of name -> (query_type, query_args) as in
+#   study.covariate_definitions
+# Output:
+# - dict of name -> set of names, for the variables that run a query
+def query_dependencies(covariate_definitions):
+    dependencies = variable_dependencies(covariate_definitions)
+
+    def is_query(name):
+        return covariate_definitions[name][0] not in EXPRESSION_TYPES
+
+    # queries of the variables of an expression
+    def queries_of(name, visiting=()):
+        if is_query(name):
+            return {name}
+        if name in visiting:
+            raise ValueError(f"Circular references: {' -> '.join(visiting + (name,))}")
+        return set().union(
+            *(queries_of(reference, visiting + (name,)) for reference in dependencies[name])
+        )
+
+    return {
+        name: set().union(*(queries_of(reference) for reference in references))
+        for name, references in dependencies.items()
+        if is_query(name)
+    }
+
+
+# Queries grouped in waves: the queries of a wave only depend on queries in
+# earlier waves
+# Output:
+# - list of lists of names
+def waves(dependencies):
+    wave_of = {}
+
+    def visit(name, visiting=()):
+        if name not in wave_of:
+            if name in visiting:
+                raise ValueError(f"Circular references: {' -> '.join(visiting + (name,))}")
+            wave_of[name] = 1 + max(
+                (visit(reference, visiting + (name,)) for reference in dependencies[name]),
+                default=-1,
+            )
+        return wave_of[name]
+
+    for name in dependencies:
+        visit(name)
+    grouped = [[] for _ in range(max(wave_of.values(), default=-1) + 1)]
+    for name, wave in wave_of.items():
+        grouped[wave].append(name)
+    return grouped
+
+
+# Longest chain of queries depending on each other
+# Output:
+# - tuple (total duration, list of names)
+def critical_path(dependencies, durations):
+    longest = {}
+    for wave in waves(dependencies):
+        for name in wave:
+            previous = max(
+                (longest[reference] for reference in dependencies[name]),
+                key=lambda path: path[0],
+                default=(0, []),
+            )
+            longest[name] = (previous[0] + durations[name], previous[1] + [name])
+    return max(longest.values(), key=lambda path: path[0], default=(0, []))
+
+
+# Seconds of the queries of each variable in a report of profiler.py
+# Output:
+# - dict of name -> seconds, for the variables with queries
+def profiled_durations(path):
+    with open(path) as f:
+        report = json.load(f)
+    return {
+        profile["name"]: profile["seconds"]
+        for profile in report["variables"]
+        if profile["queries"] and profile["seconds"] is not None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dependency graph of the queries of a study definition")
+    parser.add_argument("--study-definition", default="study_definition", choices=study_definition_names())
+    parser.add_argument(
+        "--profile",
+        help="report of profiler.py (.json) with the seconds of each query, "
+        "default 1 second per query",
+    )
+    args = parser.parse_args()
+
+    study = load_study(args.study_definition)
+    dependencies = query_dependencies(study.covariate_definitions)
+    durations = dict.fromkeys(dependencies, 1.0)
+    if args.profile:
+        durations.update(profiled_durations(args.profile))
+
+    print(
+        f"{args.study_definition}: {len(study.covariate_definitions)} variables, "
+        f"{len(dependencies)} queries"
+    )
+    for i, wave in enumerate(waves(dependencies)):
+        print(f"  wave {i}: {len(wave)} queries ({', '.join(sorted(wave)[:5])}{', ...' if len(wave) > 5 else ''})")
+    length, path = critical_path(dependencies, durations)
+    print(f"  critical path ({length:.1f}s of {sum(durations.values()):.1f}s): {' -> '.join(path)}")
+
+
+if __name__ == "__main__":
+    main()
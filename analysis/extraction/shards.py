@@ -0,0 +1,241 @@
+# Extraction of study_definition in shards of the study period
+#
+# With --param period_month=<m> study_definition.py only extracts the patients
+# whose first positive test (covid_test_positive_date) is in month m of the
+# study period: the months of period_month in add_period_cuts.R, i.e. the month
+# from start_date + (m - 1) months up to the day before start_date + m months.
+# The test variables (covid_test_positive_date and the variables with the
+# same query, e.g. covid_test_positive) are restricted to the month, and
+# patients with a positive test earlier in the study period are excluded from
+# the population, so every patient is in the shard of the month of their first
+# positive test in the study period. Queries anchored on
+# covid_test_positive_date are computed for the patients of the month only.
+#
+# The shards are extracted by separate cohortextractor runs (in parallel) into
+# output/shards/period_month_<m>/ and merged into one cohort. A month can be
+# re-extracted on its own (e.g. after a failure or when late data arrived).
+# The runs have the params of generate_study_population in project.yaml (e.g.
+# the batched queries) but the population, as a shard selects its patients.
+#
+# This is local only: project.yaml has no actions per month nor a merge action
+# (the merge imports cohortextractor, which the python image of the backend
+# does not have), so on the backend the cohort is extracted in one run by
+# generate_study_population and a failure means re-running it in full.
+#
+# Usage (from the root of the repository):
+# python -m analysis.extraction.shards extract --workers 4 [--months 3 4]
+#   [--expectations-population 5000]
+# python -m analysis.extraction.shards merge --output output/input.feather
+#   [--renumber]
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from .date_expressions import add_to_dates
+from .study import REPO_DIR, generate_cohort, project_action, with_definitions
+
+DEFAULT_ANCHOR = "covid_test_positive_date"
+SHARDS_DIR = Path("output") / "shards"
+# arguments of a query that do not change which events it matches
+RETURN_ARGUMENTS = ["returning", "return_expectations", "date_format", "hidden", "column_type"]
+
+
+def study_dates():
+    with open(REPO_DIR / "lib" / "design" / "study-dates.json") as f:
+        return json.load(f)
+
+
+# Months of the study period, as in add_period_cuts.R
+# Output:
+# - list of (first day, last day) of the months 1, 2, ... (ISO dates)
+def month_periods(start_date, end_date):
+    start = np.datetime64(start_date, "D")
+    end = np.datetime64(end_date, "D")
+    periods = []
+    while start <= end:
+        next_start = add_to_dates(np.array([start]), 1, "month")[0]
+        periods.append((str(start), str(min(next_start - 1, end))))
+        start = next_start
+    return periods
+
+
+def shard_dir(period_month):
+    return SHARDS_DIR / f"period_month_{period_month}"
+
+
+# Variables with the same query as the anchor (other than what they return)
+def period_variables(covariate_definitions, anchor=DEFAULT_ANCHOR):
+    def query(definition):
+        query_type, query_args = definition
+        return query_type, {key: value for key, value in query_args.items() if key not in RETURN_ARGUMENTS}
+
+    return [
+        name
+        for name, definition in covariate_definitions.items()
+        if query(definition) == query(covariate_definitions[anchor])
+    ]
+
+
+# Study definition of the patients with the anchor (their first positive test)
+# in one month of the study period
+# Input:
+# - study: StudyDefinition
+# - period_month: 1, 2, ... (see month_periods())
+# - anchor: date variable with find_first_match_in_period and a 'between'
+#   of the study period
+# Output:
+# - StudyDefinition
+def shard_study(study, period_month, anchor=DEFAULT_ANCHOR):
+    dates = study_dates()
+    periods = month_periods(dates["start_date"], dates["end_date"])
+    if not 1 <= period_month <= len(periods):
+        raise ValueError(f"period_month must be between 1 and {len(periods)}, got {period_month}")
+    first, last = periods[period_month - 1]
+    anchor_args = study.covariate_definitions[anchor][1]
+    if not anchor_args.get("find_first_match_in_period"):
+        raise ValueError(f"{anchor} must find the first match in the period")
+    period_start = anchor_args["between"][0]
+
+    definitions = {}
+    for name, (query_type, query_args) in study._original_covariates.items():
+        if name in period_variables(study.covariate_definitions, anchor):
+            query_args = {**query_args, "between": [first, last]}
+            if name == anchor:
+                query_args["return_expectations"] = {
+                    **query_args["return_expectations"],
+                    "date": {"earliest": first, "latest": last},
+                }
+        definitions[name] = (query_type, query_args)
+    # patients with a match before the month are in the shard of an earlier
+    # month
+    before = f"{anchor}_before_shard"
+    definitions[before] = (
+        study._original_covariates[anchor][0],
+        {
+            **anchor_args,
+            "between": [period_start, str(np.datetime64(first, "D") - 1)],
+            "returning": "binary_flag",
+            "date_format": None,
+            "column_type": "bool",
+            "hidden": True,
+            "return_expectations": {"incidence": 0.1},
+        },
+    )
+    query_type, population_args = definitions["population"]
+    category_definitions = {
+        category: expression if expression.strip() == "DEFAULT" else f"({expression}) AND NOT {before}"
+        for category, expression in population_args["category_definitions"].items()
+    }
+    definitions["population"] = (query_type, {**population_args, "category_definitions": category_definitions})
+    return with_definitions(study, definitions)
+
+
+# Extract shards with cohortextractor (in parallel)
+# Output:
+# - dict of period_month -> (return code, seconds)
+def extract_shards(months, workers, output_format="feather", expectations_population=None):
+    params = project_action("study_definition")["params"]
+    # the shards select their patients by the month of the positive test
+    params.pop("population", None)
+
+    def extract(period_month):
+        return generate_cohort(
+            "study_definition",
+            shard_dir(period_month),
+            {**params, "period_month": period_month},
+            output_format,
+            expectations_population,
+        )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(months, executor.map(extract, months)))
+
+
+# Merge the shards into one cohort
+# Input:
+# - paths: feather files of the shards
+# - output: feather file
+# - renumber: number the patients 1, 2, ... (dummy data, where the patient ids
+#   of each shard start at 1)
+def merge_shards(paths, output, renumber=False):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.feather as feather
+
+    tables = [feather.read_table(path) for path in paths]
+    # dictionaries (categories) differ per shard
+    dictionaries = {
+        field.name for table in tables for field in table.schema if pa.types.is_dictionary(field.type)
+    }
+    tables = [
+        table.cast(
+            pa.schema(
+                [
+                    pa.field(field.name, pa.string()) if field.name in dictionaries else field
+                    for field in table.schema
+                ]
+            )
+        )
+        for table in tables
+    ]
+    table = pa.concat_tables(tables, promote_options="permissive")
+    if renumber:
+        table = table.set_column(
+            table.schema.get_field_index("patient_id"),
+            "patient_id",
+            pa.array(np.arange(1, table.num_rows + 1), type=table.schema.field("patient_id").type),
+        )
+    for name in dictionaries:
+        table = table.set_column(
+            table.schema.get_field_index(name), name, pc.dictionary_encode(table[name])
+        )
+    n_patients = len(pc.unique(table["patient_id"]))
+    if n_patients != table.num_rows:
+        raise RuntimeError(f"Patients in more than one shard ({table.num_rows - n_patients} rows)")
+    feather.write_feather(table, output, compression="zstd")
+    return table.num_rows
+
+
+def main():
+    dates = study_dates()
+    periods = month_periods(dates["start_date"], dates["end_date"])
+    parser = argparse.ArgumentParser(description="Extraction of study_definition by month of the study period")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    extract = subparsers.add_parser("extract")
+    extract.add_argument("--months", type=int, nargs="+", default=list(range(1, len(periods) + 1)))
+    extract.add_argument("--workers", type=int, default=4)
+    extract.add_argument("--expectations-population", type=int)
+    merge = subparsers.add_parser("merge")
+    merge.add_argument("--months", type=int, nargs="+", default=list(range(1, len(periods) + 1)))
+    merge.add_argument("--output", default="output/input.feather")
+    merge.add_argument(
+        "--renumber", action="store_true", help="renumber the patients (shards of dummy data)"
+    )
+    args = parser.parse_args()
+
+    if args.command == "extract":
+        start = time.perf_counter()
+        results = extract_shards(args.months, args.workers, expectations_population=args.expectations_population)
+        for period_month, (returncode, seconds) in results.items():
+            first, last = periods[period_month - 1]
+            status = "ok" if returncode == 0 else f"failed, see {shard_dir(period_month) / 'extract.log'}"
+            print(f"period_month {period_month} ({first} to {last}): {seconds:.1f}s {status}")
+        serial = sum(seconds for _, seconds in results.values())
+        print(f"wall time {time.perf_counter() - start:.1f}s, {serial:.1f}s one after another")
+        if any(returncode != 0 for returncode, _ in results.values()):
+            sys.exit(1)
+    else:
+        paths = [shard_dir(period_month) / "input.feather" for period_month in args.months]
+        missing = [str(path) for path in paths if not path.exists()]
+        if missing:
+            sys.exit(f"Missing shards: {', '.join(missing)}")
+        print(f"{merge_shards(paths, args.output, args.renumber)} patients written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# Loading of the study definitions in analysis/
+#
+# cohortextractor imports a study definition with analysis/ on the python path
+# and the root of the repository as working directory (study definitions read
+# e.g. 'lib/design/study-dates.json'), the functions below do the same.
+import argparse
+import copy
+import importlib
+import shlex
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import yaml
+
+ANALYSIS_DIR = Path(__file__).resolve().parents[1]
+REPO_DIR = ANALYSIS_DIR.parent
+
+
+def add_analysis_dir_to_path():
+    if str(ANALYSIS_DIR) not in sys.path:
+        sys.path.insert(0, str(ANALYSIS_DIR))
+
+
+# Import a study definition
+# Input:
+# - name: name of the study definition, e.g. 'study_definition'
+# Output:
+# - the StudyDefinition object 'study' of the study definition
+def load_study(name):
+    add_analysis_dir_to_path()
+    return importlib.import_module(name).study
+
+
+# Names of the study definitions in analysis/
+def study_definition_names():
+    return sorted(path.stem for path in ANALYSIS_DIR.glob("study_definition*.py"))
+
+
+# Copy of a study definition with other (processed, unevaluated) definitions
+# Input:
+# - definitions: dict of name -> (query_type, query_args) as in
+#   study._original_covariates
+# Output:
+# - StudyDefinition evaluated with the index date of 'study', with a backend
+#   if 'study' has one
+def with_definitions(study, definitions):
+    new_study = copy.copy(study)
+    new_study._original_covariates = definitions
+    # the definitions before pruning (see prune.py) are not those of the copy
+    new_study.__dict__.pop("unpruned", None)
+    new_study.backend = None
+    new_study.set_index_date(study.index_date)
+    new_study.pandas_csv_args = new_study.get_pandas_csv_args(new_study.covariate_definitions)
+    if study.backend:
+        new_study.backend = new_study.create_backend()
+    return new_study
+
+
+# Arguments of the generate_cohort action of a study definition in project.yaml
+# Input:
+# - name: name of the study definition, e.g. 'study_definition'
+# Output:
+# - dict with the output format ('csv', the default of cohortextractor, if not
+#   given) and the params (dict of --param key=value)
+def project_action(name):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--study-definition")
+    parser.add_argument("--output-format", default="csv")
+    parser.add_argument("--param", action="append", default=[])
+    with open(REPO_DIR / "project.yaml") as f:
+        actions = yaml.safe_load(f)["actions"]
+    for action in actions.values():
+        command = shlex.split(action["run"])[1:]
+        if command[:1] != ["generate_cohort"]:
+            continue
+        args, _ = parser.parse_known_args(command[1:])
+        if args.study_definition == name:
+            params = dict(param.split("=", 1) for param in args.param)
+            return {"output_format": args.output_format, "params": params}
+    raise ValueError(f"No generate_cohort action of {name} in project.yaml")
+
+
+# Extract the cohort of a study definition with cohortextractor (in a process
+# of its own)
+# Input:
+# - name: name of the study definition, e.g. 'study_definition'
+# - output_dir: directory of the output (relative to the root of the
+#   repository), the log of cohortextractor is written to extract.log in it
+# - params: dict of --param key=value
+# - expectations_population: number of patients of dummy data, None to
+#   extract from the database
+# Output:
+# - tuple (return code, seconds)
+def generate_cohort(name, output_dir, params=None, output_format="feather", expectations_population=None):
+    output_dir = REPO_DIR / output_dir
+    output_dir.mkdir(parents=True, exist_ok=True)
+    command = [
+        "cohortextractor", "generate_cohort",
+        "--study-definition", name,
+        "--output-dir", str(output_dir),
+        f"--output-format={output_format}",
+    ]
+    for key, value in (params or {}).items():
+        command += ["--param", f"{key}={value}"]
+    if expectations_population:
+        command += ["--expectations-population", str(expectations_population)]
+    start = time.perf_counter()
+    with open(output_dir / "extract.log", "w") as log:
+        returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, cwd=REPO_DIR)
+    return returncode, time.perf_counter() - start
@@ -5,12 +5,20 @@ from cohortextractor import (
   filter_codes_by_category,
   combine_codelists,
   codelist,
+  params,
 )
 
 # Import codelists from codelist.py
 import codelists
 import json
 
+# Import population-first, time-sharded and batched extraction and pruning of
+# variables (not used downstream)
+from extraction.batched import batched_study
+from extraction.population_first import restrict_to_population
+from extraction.prune import prune_study, prune_unused_variables, used_variables
+from extraction.shards import shard_study
+
 # Define study time variables by importing study-dates
 with open('lib/design/study-dates.json', 'r') as f:
     study_dates = json.load(f)
@@ -19,6 +27,9 @@ end_date = study_dates["end_date"]
 
 
 # make a single variables for every code in a codelist
+# With --param batched=...,admitted_to_hospital (as in project.yaml) the
+# variables of the codes and the flag of the whole codelist are computed from
+# one scan of the admissions, see extraction/batched.py
 def make_variable(code):
     return {
         f"solid_organ_transplant_nhsd_opcs4_{code}": (
@@ -41,17 +52,29 @@ def loop_over_codes(code_list):
     return variables
 
 
-# Function to create variable covid_hosp_admission_date
-def make_hosp_admission(day, prefix, diagnoses, primary_diagnoses):
+# Function to create variables covid_hosp_admission_episode_date1, ...
+# Episode k is the first admission in the 28 days after the positive test that
+# is on a later day than episode k - 1. The columns per day after the positive
+# test (e.g. covid_hosp_admission_date0) are derived from the episodes in
+# extract_data.R; 8 episodes cover an admission on each of days 0-6 plus the
+# first admission from day 7. With --param batched=...,admitted_to_hospital (as
+# in project.yaml) the episodes, discharge dates, diagnoses and mabs procedure
+# dates are computed from one scan of the admissions in the 28 days after the
+# positive test, see extraction/batched.py
+def make_hosp_admission_episode(episode, prefix, diagnoses, primary_diagnoses):
+    if episode == 1:
+        from_date = "covid_test_positive_date"
+    else:
+        from_date = f"{prefix}_hosp_admission_episode_date{episode - 1} + 1 day"
     return {
-        f"{prefix}_hosp_admission_date{day}": (
+        f"{prefix}_hosp_admission_episode_date{episode}": (
             patients.admitted_to_hospital(
                 returning="date_admitted",
                 with_these_diagnoses=diagnoses,
                 with_these_primary_diagnoses=primary_diagnoses,
                 with_patient_classification=["1"],  # ordinary admissions only - exclude day cases and regular attenders
                 # see https://docs.opensafely.org/study-def-variables/#sus for more info
-                between=[f"covid_test_positive_date + {day} days", f"covid_test_positive_date + {day} days"],
+                between=[from_date, "covid_test_positive_date + 28 days"],
                 find_first_match_in_period=True,
                 date_format="YYYY-MM-DD",
                 return_expectations={
@@ -63,22 +86,23 @@ def make_hosp_admission(day, prefix, diagnoses, primary_diagnoses):
     }
 
 
-def hosp_admission_loop_over_days(days, prefix, diagnoses, primary_diagnoses):
+def hosp_admission_loop_over_episodes(n_episodes, prefix, diagnoses, primary_diagnoses):
     variables = {}
-    for day in days:
-        variables.update(make_hosp_admission(day=day, prefix=prefix, diagnoses=diagnoses, primary_diagnoses=primary_diagnoses))
+    for episode in range(1, n_episodes + 1):
+        variables.update(make_hosp_admission_episode(episode=episode, prefix=prefix, diagnoses=diagnoses, primary_diagnoses=primary_diagnoses))
     return variables
 
 
-# Function to create variable allcause_hosp_admission_diagnosis
-def make_hosp_admission_diagnosis(day):
+# Function to create variable allcause_hosp_admission_episode_diagnosis
+def make_hosp_admission_episode_diagnosis(episode):
+    episode_date = f"allcause_hosp_admission_episode_date{episode}"
     return {
-        f"allcause_hosp_admission_diagnosis{day}": (
+        f"allcause_hosp_admission_episode_diagnosis{episode}": (
             patients.admitted_to_hospital(
                 returning="primary_diagnosis",
                 with_patient_classification=["1"],  # ordinary admissions only - exclude day cases and regular attenders
                 # see https://docs.opensafely.org/study-def-variables/#sus for more info
-                between=[f"covid_test_positive_date + {day} days", f"covid_test_positive_date + {day} days"],
+                between=[episode_date, episode_date],
                 find_first_match_in_period=True,
                 date_format="YYYY-MM-DD",
                 return_expectations={
@@ -96,10 +120,10 @@ def make_hosp_admission_diagnosis(day):
     }
 
 
-def hosp_admission_diagnosis_loop_over_days(days):
+def hosp_admission_diagnosis_loop_over_episodes(n_episodes):
     variables = {}
-    for day in days:
-        variables.update(make_hosp_admission_diagnosis(day=day))
+    for episode in range(1, n_episodes + 1):
+        variables.update(make_hosp_admission_episode_diagnosis(episode=episode))
     return variables
 
 
@@ -114,22 +138,15 @@ study = StudyDefinition(
   
   index_date=start_date,
 
+  # Population of the flowchart: main and flowchart cohorts are extracted in a
+  # single run, the main cohort is selected using 'eligible' (see below and
+  # data_process.R)
   population=patients.satisfying(
     """
-    age >= 18 AND age < 110
-    AND NOT has_died
-    AND (sex = "M" OR sex = "F")
-    AND NOT stp = ""
-    AND imd != -1
+    NOT has_died
     AND high_risk_group
     AND registered_eligible
-    AND (
-      covid_test_positive
-      AND NOT covid_positive_prev_90_days
-      AND NOT any_covid_hosp_prev_90_days
-      AND NOT prev_treated
-      AND NOT in_hospital_when_tested
-    )
+    AND covid_test_positive
     """,
   ),
 
@@ -180,6 +197,17 @@ study = StudyDefinition(
     },
   ),
 
+  # Date of birth, age at creatinine measurement is derived from this in
+  # add_kidney_vars_to_data.R
+  date_of_birth=patients.date_of_birth(
+    date_format="YYYY-MM",
+    return_expectations={
+      "rate": "uniform",
+      "incidence": 1.0,
+      "date": {"earliest": "1920-01-01", "latest": "2004-01-01"},
+    },
+  ),
+
   # Sex [inclusion: non-missing]
   sex=patients.sex(
     return_expectations={
@@ -232,18 +260,8 @@ study = StudyDefinition(
   ),
 
   # Previous treatment [inclusion: not prev treated]
-  paxlovid_covid_prev=patients.with_covid_therapeutics(
-    with_these_therapeutics="Paxlovid",
-    with_these_indications="non_hospitalised",
-    between=["covid_test_positive_date - 91 days", "covid_test_positive_date - 1 day"],
-    returning="binary_flag",
-    return_expectations={
-      "incidence": 0.01
-    },
-  ),
-
-  sotrovimab_covid_prev=patients.with_covid_therapeutics(
-    with_these_therapeutics="Sotrovimab",
+  prev_treated=patients.with_covid_therapeutics(
+    with_these_therapeutics=["Sotrovimab", "Molnupiravir", "Casirivimab and imdevimab", "Paxlovid", "Remdesivir"],
     with_these_indications="non_hospitalised",
     between=["covid_test_positive_date - 91 days", "covid_test_positive_date - 1 day"],
     returning="binary_flag",
@@ -252,50 +270,6 @@ study = StudyDefinition(
     },
   ),
 
-  remdesivir_covid_prev=patients.with_covid_therapeutics(
-    with_these_therapeutics="Remdesivir",
-    with_these_indications="non_hospitalised",
-    between=["covid_test_positive_date - 91 days", "covid_test_positive_date - 1 day"],
-    returning="binary_flag",
-    return_expectations={
-      "incidence": 0.01
-    },
-  ),
-
-  molnupiravir_covid_prev=patients.with_covid_therapeutics(
-    with_these_therapeutics="Molnupiravir",
-    with_these_indications="non_hospitalised",
-    between=["covid_test_positive_date - 91 days", "covid_test_positive_date - 1 day"],
-    returning="binary_flag",
-    date_format="YYYY-MM-DD",
-    return_expectations={
-      "incidence": 0.01
-    },
-  ),
-
-  casirivimab_covid_prev=patients.with_covid_therapeutics(
-    with_these_therapeutics="Casirivimab and imdevimab",
-    with_these_indications="non_hospitalised",
-    between=["covid_test_positive_date - 91 days", "covid_test_positive_date - 1 day"],
-    returning="binary_flag",
-    return_expectations={
-      "incidence": 0.01
-    },
-  ),
-
-  prev_treated=patients.satisfying(
-    """
-    paxlovid_covid_prev OR
-    sotrovimab_covid_prev OR
-    remdesivir_covid_prev OR
-    molnupiravir_covid_prev OR
-    casirivimab_covid_prev
-    """,
-    return_expectations={
-      "incidence": 0.01,
-    },
-  ),
-
   covid_positive_prev_90_days=patients.with_test_result_in_sgss(
     pathogen="SARS-CoV-2",
     test_result="positive",
@@ -334,6 +308,23 @@ study = StudyDefinition(
    return_expectations={"incidence": 0.05}
   ),
 
+  # Population mask of the main cohort [inclusion: eligible]
+  eligible=patients.satisfying(
+    """
+    age >= 18 AND age < 110
+    AND (sex = "M" OR sex = "F")
+    AND NOT stp = ""
+    AND imd != -1
+    AND NOT covid_positive_prev_90_days
+    AND NOT any_covid_hosp_prev_90_days
+    AND NOT prev_treated
+    AND NOT in_hospital_when_tested
+    """,
+    return_expectations={
+      "incidence": 0.9,
+    },
+  ),
+
   # High risk groups
   # Blueteq ‘high risk’ cohort (useful for validating ehr high risk groups)
   high_risk_cohort_covid_therapeutics=patients.with_covid_therapeutics(
@@ -1184,14 +1175,6 @@ study = StudyDefinition(
     },
   ),
 
-  age_creatinine_ctv3=patients.age_as_of(
-    "creatinine_ctv3_date",
-    return_expectations = {
-      "rate": "universal",
-      "int": {"distribution": "population_ages"},
-    },
-  ),
-
   creatinine_snomed=patients.with_these_clinical_events(
     codelist=codelists.creatinine_codes_snomed,
     find_last_match_in_period=True,
@@ -1224,14 +1207,6 @@ study = StudyDefinition(
     },
   ),  
 
-  age_creatinine_snomed=patients.age_as_of(
-    "creatinine_snomed_date",
-    return_expectations = {
-      "rate": "universal",
-      "int": {"distribution": "population_ages"},
-    },
-  ),  
-
   creatinine_short_snomed=patients.with_these_clinical_events(
     codelist=codelists.creatinine_codes_short_snomed,
     find_last_match_in_period=True,
@@ -1264,14 +1239,6 @@ study = StudyDefinition(
     },
   ),  
 
-  age_creatinine_short_snomed=patients.age_as_of(
-    "creatinine_short_snomed_date",
-    return_expectations={
-      "rate": "universal",
-      "int": {"distribution": "population_ages"},
-    },
-  ),    
-
   #  3-5 CKD based on recorded eGFR value
   eGFR_record=patients.with_these_clinical_events(
     codelist=codelists.eGFR_level_codelist,
@@ -1399,10 +1366,25 @@ study = StudyDefinition(
   ###################################################################
   # TREATMENT - NEUTRALISING MONOCLONAL ANTIBODIES OR ANTIVIRALS ----
   ###################################################################
+  # First treatment with any of the drugs, the per drug treatment dates below
+  # are on or after this date, so these only look up patients that are treated
+  date_treated=patients.with_covid_therapeutics(
+    with_these_therapeutics=["Sotrovimab", "Molnupiravir", "Casirivimab and imdevimab", "Paxlovid", "Remdesivir"],
+    with_these_indications="non_hospitalised",
+    between=["covid_test_positive_date", end_date],
+    find_first_match_in_period=True,
+    returning="date",
+    date_format="YYYY-MM-DD",
+    return_expectations={
+      "date": {"earliest": "index_date"},
+      "incidence": 0.9
+    },
+  ),
+
   paxlovid_covid_therapeutics=patients.with_covid_therapeutics(
     with_these_therapeutics="Paxlovid",
     with_these_indications="non_hospitalised",
-    between=["covid_test_positive_date", end_date],
+    between=["date_treated", end_date],
     find_first_match_in_period=True,
     returning="date",
     date_format="YYYY-MM-DD",
@@ -1415,7 +1397,7 @@ study = StudyDefinition(
   sotrovimab_covid_therapeutics=patients.with_covid_therapeutics(
     with_these_therapeutics="Sotrovimab",
     with_these_indications="non_hospitalised",
-    between=["covid_test_positive_date", end_date],
+    between=["date_treated", end_date],
     find_first_match_in_period=True,
     returning="date",
     date_format="YYYY-MM-DD",
@@ -1428,7 +1410,7 @@ study = StudyDefinition(
   remdesivir_covid_therapeutics=patients.with_covid_therapeutics(
     with_these_therapeutics="Remdesivir",
     with_these_indications="non_hospitalised",
-    between=["covid_test_positive_date", end_date],
+    between=["date_treated", end_date],
     find_first_match_in_period=True,
     returning="date",
     date_format="YYYY-MM-DD",
@@ -1441,7 +1423,7 @@ study = StudyDefinition(
   molnupiravir_covid_therapeutics=patients.with_covid_therapeutics(
     with_these_therapeutics="Molnupiravir",
     with_these_indications="non_hospitalised",
-    between=["covid_test_positive_date", end_date],
+    between=["date_treated", end_date],
     find_first_match_in_period=True,
     returning="date",
     date_format="YYYY-MM-DD",
@@ -1454,7 +1436,7 @@ study = StudyDefinition(
   casirivimab_covid_therapeutics=patients.with_covid_therapeutics(
     with_these_therapeutics="Casirivimab and imdevimab",
     with_these_indications="non_hospitalised",
-    between=["covid_test_positive_date", end_date],
+    between=["date_treated", end_date],
     find_first_match_in_period=True,
     returning="date",
     date_format="YYYY-MM-DD",
@@ -1464,14 +1446,6 @@ study = StudyDefinition(
     },
   ),
 
-  date_treated=patients.minimum_of(
-    "paxlovid_covid_therapeutics",
-    "sotrovimab_covid_therapeutics",
-    "remdesivir_covid_therapeutics",
-    "molnupiravir_covid_therapeutics",
-    "casirivimab_covid_therapeutics",
-  ),
-
   ###################################################################
   # COVARIATES ------------------------------------------------------
   ###################################################################
@@ -1910,38 +1884,25 @@ study = StudyDefinition(
 
   # COVID as primary diagnosis (outcome)
   # Hospitalisation with COVID as the primary cause on day 0 (+ve test), 1, 2, 3, 4, 5 or 6
-  # These events are extracted seperately in case patient is admitted twice, and first admission
-  # was for sotrovimab infusion
-  **hosp_admission_loop_over_days(
-      days={"0", "1", "2", "3", "4", "5", "6"},
+  # and first hospitalisation on day 7 - 28 are derived from these episodes in
+  # extract_data.R. These events are extracted seperately in case patient is
+  # admitted twice, and first admission was for sotrovimab infusion
+  # we're assuming no day case admission (for receiving sotrovimab) after day 7
+  **hosp_admission_loop_over_episodes(
+      n_episodes=8,
       prefix="covid",
       diagnoses=None,
       primary_diagnoses=codelists.covid_icd10_codes),
-  # Day 8 - 28
-  # we're assuming no day case admission (for receiving sotrovimab) after day 7
-  covid_hosp_admission_first_date7_28=patients.admitted_to_hospital(
-    returning="date_admitted",
-    with_these_primary_diagnoses=codelists.covid_icd10_codes,
-    with_patient_classification=["1"],  # ordinary admissions only - exclude day cases and regular attenders
-    # see https://docs.opensafely.org/study-def-variables/#sus for more info
-    between=["covid_test_positive_date + 7 days", "covid_test_positive_date + 28 days"],
-    find_first_match_in_period=True,
-    date_format="YYYY-MM-DD",
-    return_expectations={
-      "date": {"earliest": "index_date + 1 days"},
-      "rate": "uniform",
-      "incidence": 0.1
-    },
-  ),
 
   # associated discharge date used to check if day case for sotrovimab infusion
   # --> if day case for sotrovimab infusion, pt censored at sotrovimab init and hospital admission not counted as outcome
+  # (episode 1 is the first admission on or after covid_test_positive_date)
   covid_hosp_discharge_date=patients.admitted_to_hospital(
     returning="date_discharged",
     with_these_primary_diagnoses=codelists.covid_icd10_codes,
     with_patient_classification=["1"],  # ordinary admissions only - exclude day cases and regular attenders
     # see https://docs.opensafely.org/study-def-variables/#sus for more info
-    between=["covid_test_positive_date", "covid_test_positive_date + 28 days"],
+    between=["covid_hosp_admission_episode_date1", "covid_test_positive_date + 28 days"],
     find_first_match_in_period=True,
     date_format="YYYY-MM-DD",
     return_expectations={
@@ -1959,7 +1920,7 @@ study = StudyDefinition(
     with_patient_classification=["1"],  # ordinary admissions only - exclude day cases and regular attenders
     # see https://docs.opensafely.org/study-def-variables/#sus for more info
     with_these_procedures=codelists.mabs_procedure_codes,
-    between=["covid_test_positive_date", "covid_test_positive_date + 28 days"],
+    between=["covid_hosp_admission_episode_date1", "covid_test_positive_date + 28 days"],
     find_first_match_in_period=True,
     date_format="YYYY-MM-DD",
     return_expectations={
@@ -1970,28 +1931,11 @@ study = StudyDefinition(
   ),
 
   # COVID as one of the diagnoses
-  **hosp_admission_loop_over_days(
-      days={"0", "1", "2", "3", "4", "5", "6"},
+  **hosp_admission_loop_over_episodes(
+      n_episodes=8,
       prefix="covid_any",
       diagnoses=codelists.covid_icd10_codes,
       primary_diagnoses=None),
-  # Day 8 - 28
-  # we're assuming no day case admission (for receiving sotrovimab) after day 7
-  covid_any_hosp_admission_first_date7_28=patients.admitted_to_hospital(
-    returning="date_admitted",
-    with_these_primary_diagnoses=None,
-    with_these_diagnoses=codelists.covid_icd10_codes,
-    with_patient_classification=["1"],  # ordinary admissions only - exclude day cases and regular attenders
-    # see https://docs.opensafely.org/study-def-variables/#sus for more info
-    between=["covid_test_positive_date + 7 days", "covid_test_positive_date + 28 days"],
-    find_first_match_in_period=True,
-    date_format="YYYY-MM-DD",
-    return_expectations={
-      "date": {"earliest": "index_date + 1 days"},
-      "rate": "uniform",
-      "incidence": 0.1
-    },
-  ),
 
   # associated discharge date used to check if day case for sotrovimab infusion
   # --> if day case for sotrovimab infusion, pt censored at sotrovimab init and hospital admission not counted as outcome
@@ -2001,7 +1945,7 @@ study = StudyDefinition(
     with_these_diagnoses=codelists.covid_icd10_codes,
     with_patient_classification=["1"],  # ordinary admissions only - exclude day cases and regular attenders
     # see https://docs.opensafely.org/study-def-variables/#sus for more info
-    between=["covid_test_positive_date", "covid_test_positive_date + 28 days"],
+    between=["covid_any_hosp_admission_episode_date1", "covid_test_positive_date + 28 days"],
     find_first_match_in_period=True,
     date_format="YYYY-MM-DD",
     return_expectations={
@@ -2020,7 +1964,7 @@ study = StudyDefinition(
     with_patient_classification=["1"],  # ordinary admissions only - exclude day cases and regular attenders
     # see https://docs.opensafely.org/study-def-variables/#sus for more info
     with_these_procedures=codelists.mabs_procedure_codes,
-    between=["covid_test_positive_date", "covid_test_positive_date + 28 days"],
+    between=["covid_any_hosp_admission_episode_date1", "covid_test_positive_date + 28 days"],
     find_first_match_in_period=True,
     date_format="YYYY-MM-DD",
     return_expectations={
@@ -2031,50 +1975,15 @@ study = StudyDefinition(
   ),
 
   # ALL CAUSE hospitalisation
-  **hosp_admission_loop_over_days(
-      days={"0", "1", "2", "3", "4", "5", "6"},
+  # assuming no day case admission after day 7
+  **hosp_admission_loop_over_episodes(
+      n_episodes=8,
       prefix="allcause",
       diagnoses=None,
       primary_diagnoses=None),
   # return primary cause of all cause hosp admission
-  **hosp_admission_diagnosis_loop_over_days(
-      days={"0", "1", "2", "3", "4", "5", "6"}),
-
-  # Day 8 - 28
-  # assuming no day case admission after day 7
-  allcause_hosp_admission_first_date7_28=patients.admitted_to_hospital(
-    returning="date_admitted",
-    with_patient_classification=["1"],  # ordinary admissions only - exclude day cases and regular attenders
-    # see https://docs.opensafely.org/study-def-variables/#sus for more info
-    between=["covid_test_positive_date + 7 days", "covid_test_positive_date + 28 days"],
-    find_first_match_in_period=True,
-    date_format="YYYY-MM-DD",
-    return_expectations={
-      "date": {"earliest": "index_date + 1 days", "latest": end_date},
-      "rate": "uniform",
-      "incidence": 0.1
-    },
-  ),
-
-  # return cause
-  allcause_hosp_admission_first_diagnosis7_28=patients.admitted_to_hospital(
-    returning="primary_diagnosis",
-    with_patient_classification=["1"], # ordinary admissions only - exclude day cases and regular attenders
-    # see https://docs.opensafely.org/study-def-variables/#sus for more info
-    between=["covid_test_positive_date + 7 days", "covid_test_positive_date + 28 days"],
-    find_first_match_in_period=True,
-    date_format="YYYY-MM-DD",
-    return_expectations={
-      "rate": "universal",
-      "incidence": 0.05,
-      "category": {
-        "ratios": {
-          "icd1": 0.2,
-          "icd2": 0.2,
-          "icd3": 0.2,
-          "icd4": 0.2,
-          "icd5": 0.2}, }, },
-  ),
+  **hosp_admission_diagnosis_loop_over_episodes(
+      n_episodes=8),
 
   # associated discharge date used to check if day case for sotrovimab infusion
   # --> if day case for sotrovimab infusion, pt censored at sotrovimab init and hospital admission not counted as outcome
@@ -2082,7 +1991,7 @@ study = StudyDefinition(
     returning="date_discharged",
     with_patient_classification=["1"], # ordinary admissions only - exclude day cases and regular attenders
     # see https://docs.opensafely.org/study-def-variables/#sus for more info
-    between=["covid_test_positive_date", "covid_test_positive_date + 28 days"],
+    between=["allcause_hosp_admission_episode_date1", "covid_test_positive_date + 28 days"],
     find_first_match_in_period=True,
     date_format="YYYY-MM-DD",
     return_expectations={
@@ -2098,7 +2007,7 @@ study = StudyDefinition(
     with_patient_classification=["1"], # ordinary admissions only - exclude day cases and regular attenders
     # see https://docs.opensafely.org/study-def-variables/#sus for more info
     with_these_procedures=codelists.mabs_procedure_codes,
-    between=["covid_test_positive_date", "covid_test_positive_date + 28 days"],
+    between=["allcause_hosp_admission_episode_date1", "covid_test_positive_date + 28 days"],
     find_first_match_in_period=True,
     date_format="YYYY-MM-DD",
     return_expectations={
@@ -2108,3 +2017,38 @@ study = StudyDefinition(
     },
   ),
 )
+
+# Population-first extraction: with --param population=<file> (the output of
+# study_definition_population.py) the population and covid_test_positive_date
+# are read from the file, so the queries anchored on covid_test_positive_date
+# are only computed for the patients in the population
+if "population" in params:
+  study = restrict_to_population(study, params["population"])
+
+# Time-sharded extraction: with --param period_month=<m> only the patients
+# with their first positive test in month m of the study period (as
+# period_month in add_period_cuts.R) are extracted, see extraction/shards.py
+if "period_month" in params:
+  study = shard_study(study, int(params["period_month"]))
+
+# Pruning: with --param prune=1 the variables not read by the R scripts
+# processing input.feather (and not needed to compute the ones that are) are
+# not extracted. The columns read are found by scanning the R scripts, check
+# the variables left out with 'python -m analysis.extraction.prune' first
+if params.get("prune") == "1":
+  study = prune_unused_variables(study, "study_definition")
+
+# Extraction of some variables only: with --param variables=<names> (comma
+# separated) only these variables and the variables they depend on are
+# extracted, e.g. the variables that are not cached, see extraction/cache.py
+if "variables" in params:
+  study = prune_study(
+    study,
+    used_variables(study.covariate_definitions, params["variables"].split(",")),
+  )
+
+# Batched extraction: with --param batched=<query types> (comma separated, e.g.
+# with_these_clinical_events) the variables of these query types on the same
+# table are computed in batches of one scan each, see extraction/batched.py
+if "batched" in params:
+  study = batched_study(study, params["batched"].split(","))
@@ -4,12 +4,16 @@ from cohortextractor import (
   patients,
   filter_codes_by_category,
   combine_codelists,
+  params,
 )
 
 # Import codelists from codelist.py
 import codelists
 import json
 
+# Import batched extraction
+from extraction.batched import batched_study
+
 # Define study time variables by importing study-dates
 with open('lib/design/study-dates.json', 'r') as f:
     study_dates = json.load(f)
@@ -1740,3 +1744,8 @@ study = StudyDefinition(
   ),
 )
 
+# Batched extraction: with --param batched=<query types> (comma separated, e.g.
+# with_these_clinical_events) the variables of these query types on the same
+# table are computed in batches of one scan each, see extraction/batched.py
+if "batched" in params:
+  study = batched_study(study, params["batched"].split(","))
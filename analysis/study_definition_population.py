@@ -0,0 +1,10 @@
+# Population of study_definition.py, step 1 of population-first extraction
+# (see analysis/extraction/population_first.py): only the variables the
+# population depends on are extracted, the output has the
+# covid_test_positive_date of the patients in the population and is read by
+# study_definition.py (--param population=output/input_population.csv.gz)
+from extraction.population_first import population_study
+
+from study_definition import study as full_study
+
+study = population_study(full_study)